@@ -1,22 +1,124 @@
-from authorizenet import apicontractsv1
-from authorizenet.apicontrollers import getTransactionListForCustomerController
-from datetime import datetime, timedelta
-from fastapi import FastAPI, Depends, HTTPException
+from datetime import date, datetime, timedelta
+from fastapi import FastAPI, Depends, HTTPException, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.security import APIKeyHeader
-from lxml import etree
+from mysql.connector.pooling import MySQLConnectionPool
 from pydantic import BaseModel
 from pytz import timezone, utc 
 from ratelimit import limits, sleep_and_retry
-from typing import Optional
+from typing import Any, Dict, List, Optional
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from mysql.connector import errorcode, FieldFlag, FieldType
+import asyncio
 import calendar
+import fcntl
+import functools
+import heapq
+import httpx
+import inspect
+import json
+import math
+import mmap
 import mysql.connector
+import numpy as np
 import os
+import random
+import shutil
+import sqlite3
+import struct
+import subprocess
+import tempfile
 import threading
 import time
-
+import urllib.error
+import weakref
+import urllib.request
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # only needed by the /export endpoints
+    pa = pq = None
+
+from backup_store import ChunkStore
+import config
 from config import DB_CONFIG, API_KEY, API_ID, TRANSACTION_KEY, BACK_UP_LOC
 
-last_backup_time = None
+# Optional settings (fall back to defaults when missing from config.py)
+STATE_DIR = getattr(config, "STATE_DIR", os.path.join(tempfile.gettempdir(), "active_orders_api"))
+DEFAULT_SCHEDULED_JOBS = {
+    # job name: cron schedule (minute hour day month weekday, server local time), None to disable
+    "backup": "*/10 * * * *",
+    "activity_histogram": "*/10 * * * *",
+    "activity_forecast": "*/10 * * * *",
+    "sales_rollup": "5 * * * *",
+    "transaction_ledger": "* * * * *",
+    "profile_cache": "*/5 * * * *"
+}
+# Jobs config.py leaves out keep their default schedule
+SCHEDULED_JOBS = {**DEFAULT_SCHEDULED_JOBS, **getattr(config, "SCHEDULED_JOBS", {})}
+SCHEDULER_JITTER = getattr(config, "SCHEDULER_JITTER", 30)
+SCHEDULER_HISTORY = getattr(config, "SCHEDULER_HISTORY", 20)
+SALES_ROLLUP_RECHECK_DAYS = getattr(config, "SALES_ROLLUP_RECHECK_DAYS", 7)
+DB_REPLICAS = getattr(config, "DB_REPLICAS", [])
+REPLICA_ROUTES = getattr(config, "REPLICA_ROUTES", {"probability": "replica", "sales": "replica", "backup": "replica", "export": "replica"})
+REPLICA_MAX_LAG = getattr(config, "REPLICA_MAX_LAG", 30)
+REPLICA_RETRY_AFTER = getattr(config, "REPLICA_RETRY_AFTER", 30)
+REPLICA_LAG_CHECK_INTERVAL = getattr(config, "REPLICA_LAG_CHECK_INTERVAL", 5)
+DB_POOL_SIZE = getattr(config, "DB_POOL_SIZE", 5)
+DB_CONNECT_TIMEOUT = getattr(config, "DB_CONNECT_TIMEOUT", 5)
+DB_READ_TIMEOUT = getattr(config, "DB_READ_TIMEOUT", None)
+DB_MAX_EXECUTION_TIME = getattr(config, "DB_MAX_EXECUTION_TIME", {"probability": 20000, "sales": 10000, "accounts": 10000, "activity": 5000, "batch": 20000})
+DB_PREPARED_STATEMENTS = getattr(config, "DB_PREPARED_STATEMENTS", True)
+AUTHORIZENET_TIMEOUT = getattr(config, "AUTHORIZENET_TIMEOUT", 15)
+# The sandbox, which is what the authorizenet SDK talked to by default
+AUTHORIZENET_ENDPOINT = getattr(config, "AUTHORIZENET_ENDPOINT", "https://apitest.authorize.net/xml/v1/request.api")
+AUTHORIZENET_MAX_CONCURRENCY = getattr(config, "AUTHORIZENET_MAX_CONCURRENCY", 8)
+BREAKER_FAILURE_THRESHOLD = getattr(config, "BREAKER_FAILURE_THRESHOLD", 5)
+BREAKER_FAILURE_WINDOW = getattr(config, "BREAKER_FAILURE_WINDOW", 60)
+BREAKER_RESET_TIMEOUT = getattr(config, "BREAKER_RESET_TIMEOUT", 30)
+FORECAST_WEEKS = getattr(config, "FORECAST_WEEKS", 8)
+FORECAST_ALPHA = getattr(config, "FORECAST_ALPHA", 0.3)
+PROFILE_CACHE_SIZE = getattr(config, "PROFILE_CACHE_SIZE", 10000)
+PROFILE_CACHE_TTL = getattr(config, "PROFILE_CACHE_TTL", 3600)
+PROFILE_CACHE_WATERMARK_INTERVAL = getattr(config, "PROFILE_CACHE_WATERMARK_INTERVAL", 10)
+EXPORT_BATCH_SIZE = getattr(config, "EXPORT_BATCH_SIZE", 10000)
+BACKUP_COMPRESS = getattr(config, "BACKUP_COMPRESS", False)
+BACKUP_STORE = getattr(config, "BACKUP_STORE", None)
+BACKUP_STORE_KEEP = getattr(config, "BACKUP_STORE_KEEP", 84)
+HEALTH_PROBE_INTERVAL = getattr(config, "HEALTH_PROBE_INTERVAL", 10)
+HEALTH_PROBE_TIMEOUT = getattr(config, "HEALTH_PROBE_TIMEOUT", 5)
+HEALTH_REQUIRED = getattr(config, "HEALTH_REQUIRED", ("mysql",))
+AUTHORIZENET_HEALTH_URL = getattr(config, "AUTHORIZENET_HEALTH_URL", AUTHORIZENET_ENDPOINT)
+TRANSACTION_SYNC_INTERVAL = getattr(config, "TRANSACTION_SYNC_INTERVAL", 300)
+TRANSACTION_SYNC_OVERLAP = getattr(config, "TRANSACTION_SYNC_OVERLAP", 2 * 24 * 3600)
+TRANSACTION_LEDGER_MAX_AGE = getattr(config, "TRANSACTION_LEDGER_MAX_AGE", 900)
+TRANSACTION_LEDGER_ACTIVE_DAYS = getattr(config, "TRANSACTION_LEDGER_ACTIVE_DAYS", 30)
+STORE_TIMEZONE = getattr(config, "STORE_TIMEZONE", "America/New_York")
+HOT_SET_REFRESH_INTERVAL = getattr(config, "HOT_SET_REFRESH_INTERVAL", 5)
+HOT_SET_RELOAD_INTERVAL = getattr(config, "HOT_SET_RELOAD_INTERVAL", 900)
+HOT_SET_MAX_STALENESS = getattr(config, "HOT_SET_MAX_STALENESS", 60)
+ADMISSION_MAX_IN_FLIGHT = getattr(config, "ADMISSION_MAX_IN_FLIGHT", 32)
+ADMISSION_PRIORITIES = getattr(config, "ADMISSION_PRIORITIES", ("critical", "interactive", "reports", "bulk"))
+ADMISSION_ROUTES = getattr(config, "ADMISSION_ROUTES", {
+    # path prefix: (priority class, concurrency, queue size, queue timeout in seconds)
+    "/health": ("critical", None, 0, 0),
+    "/metrics": ("critical", None, 0, 0),
+    "/scheduler": ("critical", None, 0, 0),
+    "/version": ("critical", None, 0, 0),
+    "/activity": ("interactive", 16, 32, 5),
+    "/carts": ("interactive", 8, 16, 5),
+    "/transactions": ("interactive", 16, 32, 10),
+    "/probability": ("reports", 4, 8, 10),
+    "/accounts": ("reports", 4, 8, 10),
+    "/sales": ("reports", 4, 8, 10),
+    "/batch": ("bulk", 2, 4, 30),
+    "/export": ("bulk", 2, 2, 30),
+    "/backup": ("bulk", 1, 0, 0)
+})
 
 app = FastAPI()
 
@@ -32,85 +134,1364 @@ class ActiveCart(BaseModel):
     createdAt: datetime
     updatedAt: datetime
 
-def get_db_connection():
-    return mysql.connector.connect(**DB_CONFIG)
 
+class CircuitOpenError(HTTPException):
+    def __init__(self, name):
+        super().__init__(status_code=503, detail=f"{name} is unavailable")
+
+
+class CircuitBreaker:
+    """
+    Fails fast once a dependency keeps failing.
+
+    Opens after `failure_threshold` failures within `failure_window` seconds
+    with no success in between, then rejects calls with CircuitOpenError for
+    `reset_timeout` seconds. After that a single probe call is let through
+    (half open): success closes the circuit, failure opens it again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name, failure_threshold, failure_window, reset_timeout):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.failure_window = failure_window
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = deque()
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+        self.stats = {"failures": 0, "rejections": 0, "opened": 0}
+
+    def before_call(self):
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._probing = False
+
+            if self.state == self.OPEN or (self.state == self.HALF_OPEN and self._probing):
+                self.stats["rejections"] += 1
+                raise CircuitOpenError(self.name)
+
+            if self.state == self.HALF_OPEN:
+                self._probing = True
+
+    def record_success(self, reset=True):
+        # reset=False only closes a half open circuit; used where a success
+        # (e.g. a new connection) says little about the calls that follow
+        with self._lock:
+            if self.state == self.HALF_OPEN or reset:
+                if self.state != self.CLOSED:
+                    print(f"\tCircuit {self.name} closed")
+                self.state = self.CLOSED
+                self._probing = False
+                self._failures.clear()
+
+    def cancel_call(self):
+        # The call ended without telling anything about the dependency (e.g.
+        # it was cancelled), so a half open circuit lets the next call probe
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            now = time.monotonic()
+            self.stats["failures"] += 1
+            self._failures.append(now)
+            while self._failures and now - self._failures[0] > self.failure_window:
+                self._failures.popleft()
+
+            if self.state == self.HALF_OPEN or len(self._failures) >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    print(f"\tCircuit {self.name} opened")
+                    self.stats["opened"] += 1
+                self.state = self.OPEN
+                self._opened_at = now
+                self._probing = False
+
+    def metrics(self):
+        with self._lock:
+            return {"state": self.state, "recentFailures": len(self._failures), **self.stats}
+
+
+circuit_breakers = {}
+circuit_breakers_lock = threading.Lock()
+
+def get_circuit_breaker(name):
+    with circuit_breakers_lock:
+        if name not in circuit_breakers:
+            circuit_breakers[name] = CircuitBreaker(name, BREAKER_FAILURE_THRESHOLD, BREAKER_FAILURE_WINDOW, BREAKER_RESET_TIMEOUT)
+        return circuit_breakers[name]
+
+
+def is_dependency_failure(error):
+    # Lost or failed connections and client timeouts, as opposed to errors in our SQL.
+    # Queries killed by MAX_EXECUTION_TIME (ER_QUERY_TIMEOUT) are slow queries, not
+    # a sick server, and must not open the breaker for every endpoint.
+    return (isinstance(error, (mysql.connector.errors.InterfaceError, mysql.connector.errors.OperationalError))
+            and error.errno != errorcode.ER_QUERY_TIMEOUT)
+
+
+db_pools = {}
+db_pools_lock = threading.Lock()
+
+def open_connection(connect_args):
+    if not DB_POOL_SIZE:
+        return mysql.connector.connect(**connect_args)
+
+    key = (connect_args["host"], connect_args.get("port", 3306), connect_args.get("database"), connect_args["user"])
+    with db_pools_lock:
+        pool = db_pools.get(key)
+        if pool is None:
+            pool = MySQLConnectionPool(pool_name=f"active_orders_{len(db_pools)}", pool_size=DB_POOL_SIZE, **connect_args)
+            db_pools[key] = pool
+
+    try:
+        # Connections are reset when handed back, so no transaction or
+        # session setting leaks from one request to the next
+        return pool.get_connection()
+    except mysql.connector.errors.PoolError:
+        # Pool exhausted, don't make the request wait for a pooled connection
+        return mysql.connector.connect(**connect_args)
+
+
+# Breaker of the database the current thread last connected to, so query
+# errors are charged to the right server
+db_thread_state = threading.local()
+
+def connect_with_breaker(db_config):
+    breaker = get_circuit_breaker(f"mysql:{db_config['host']}:{db_config.get('port', 3306)}")
+    breaker.before_call()
+
+    timeouts = {"connection_timeout": DB_CONNECT_TIMEOUT}
+    if DB_READ_TIMEOUT:
+        timeouts["read_timeout"] = DB_READ_TIMEOUT
+
+    db_thread_state.breaker = None
+    try:
+        connection = open_connection({**timeouts, **db_config})
+    except mysql.connector.Error:
+        breaker.record_failure()
+        raise
+
+    breaker.record_success(reset=False)
+    db_thread_state.breaker = breaker
+    return connection
+
+
+def discard_unread_result(connection):
+    """Reads and drops the rest of a result set a cursor stopped fetching."""
+    if connection.unread_result:
+        connection.consume_results()
+
+
+def log_db_error(error):
+    print(f"Error connecting to MySQL database: {error}")
+    breaker = getattr(db_thread_state, "breaker", None)
+    if breaker is not None and is_dependency_failure(error):
+        breaker.record_failure()
+
+
+class ReplicaRouter:
+    """
+    Picks the database a query class runs against.
+
+    Query classes routed to "replica" in `routes` go to the first healthy
+    replica (round robin) whose replication lag is within `max_lag` seconds.
+    A replica that fails to connect or lags too far is skipped for
+    `retry_after` seconds. Everything else, including the case where no
+    replica qualifies, goes to the primary. A replica's lag is checked at
+    most once per `lag_check_interval` seconds; checkouts in between trust
+    the last check instead of paying a round trip for it.
+    """
+
+    def __init__(self, primary, replicas, routes, max_lag, retry_after, lag_check_interval=0):
+        self.primary = primary
+        self.replicas = replicas
+        self.routes = routes
+        self.max_lag = max_lag
+        self.retry_after = retry_after
+        self.lag_check_interval = lag_check_interval
+        self._skip_until = [0] * len(replicas)
+        self._lag_checked_at = [None] * len(replicas)
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def _candidates(self):
+        with self._lock:
+            start = self._next
+            self._next = (self._next + 1) % max(len(self.replicas), 1)
+
+        now = time.monotonic()
+        for offset in range(len(self.replicas)):
+            index = (start + offset) % len(self.replicas)
+            if self._skip_until[index] <= now:
+                yield index
+
+    def _mark_unhealthy(self, index, reason):
+        print(f"Skipping MySQL replica {self.replicas[index]['host']} for {self.retry_after}s: {reason}")
+        self._lag_checked_at[index] = None
+        self._skip_until[index] = time.monotonic() + self.retry_after
+
+    @staticmethod
+    def replication_lag(connection):
+        # Seconds behind the source; 0 for a server that is not replicating at
+        # all and None when replication is configured but stopped
+        cursor = connection.cursor(dictionary=True)
+        try:
+            try:
+                cursor.execute("SHOW REPLICA STATUS")
+                lag_column = "Seconds_Behind_Source"
+            except mysql.connector.Error:
+                cursor.execute("SHOW SLAVE STATUS")
+                lag_column = "Seconds_Behind_Master"
+            status = cursor.fetchone()
+        finally:
+            cursor.close()
+
+        if status is None:
+            return 0
+        return status[lag_column]
+
+    def connect(self, query_class=None):
+        """Returns (connection, config used) for the query class."""
+        if self.routes.get(query_class) == "replica":
+            for index in self._candidates():
+                replica = self.replicas[index]
+                try:
+                    connection = connect_with_breaker(replica)
+                except CircuitOpenError:
+                    continue
+                except mysql.connector.Error as error:
+                    self._mark_unhealthy(index, error)
+                    continue
+
+                checked_at = self._lag_checked_at[index]
+                if checked_at is not None and time.monotonic() - checked_at < self.lag_check_interval:
+                    return connection, replica
+
+                try:
+                    lag = self.replication_lag(connection)
+                except mysql.connector.Error as error:
+                    log_db_error(error)
+                    connection.close()
+                    self._mark_unhealthy(index, error)
+                    continue
+
+                if lag is not None and lag <= self.max_lag:
+                    self._lag_checked_at[index] = time.monotonic()
+                    return connection, replica
+
+                connection.close()
+                self._mark_unhealthy(index, f"replication lag {lag}")
+
+        return connect_with_breaker(self.primary), self.primary
+
+
+db_router = ReplicaRouter(DB_CONFIG, DB_REPLICAS, REPLICA_ROUTES, REPLICA_MAX_LAG, REPLICA_RETRY_AFTER, REPLICA_LAG_CHECK_INTERVAL)
+
+
+class PreparedStatements:
+    """
+    Registry of named queries run many times per request, as server-side
+    prepared statements.
+
+    MySQL parses and plans a prepared statement once; each later execution
+    only sends the parameters. A StatementCursor prepares a registered
+    statement the first time it runs it and reuses it until it is closed.
+    Pools reset sessions when connections are handed back, which
+    deallocates the statements, so each checkout prepares its own.
+    """
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.statements = {}
+        self._names = {}
+        self._lock = threading.Lock()
+        self.stats = {}
+
+    def register(self, name, sql):
+        self.statements[name] = sql
+        self._names[sql] = name
+        self.stats[name] = {"executions": 0, "prepares": 0}
+        return sql
+
+    def name_of(self, sql):
+        return self._names.get(sql) if self.enabled else None
+
+    def execute(self, cursors, connection, name, params):
+        """Runs a registered statement on its prepared cursor in `cursors` (by name) and returns that cursor."""
+        cursor = cursors.get(name)
+        if cursor is None:
+            cursor = cursors[name] = connection.cursor(prepared=True)
+            with self._lock:
+                self.stats[name]["prepares"] += 1
+
+        # The prepared cursor only re-prepares when handed a different string object
+        cursor.execute(self.statements[name], params)
+
+        with self._lock:
+            self.stats[name]["executions"] += 1
+        return cursor
+
+    def cursor(self, connection):
+        return StatementCursor(self, connection)
+
+    def metrics(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "statements": {name: dict(stats) for name, stats in self.stats.items()}
+            }
+
+
+class StatementCursor:
+    """
+    Cursor that runs registered statements through prepared cursors.
+
+    Any other SQL goes through a plain cursor, so report functions call
+    execute() and fetchone()/fetchall() on it like on any cursor. Fetches
+    read from whichever cursor ran the last statement.
+    """
+
+    def __init__(self, statements, connection):
+        self._statements = statements
+        self._connection = connection
+        self._plain = connection.cursor()
+        self._prepared = {}
+        self._current = self._plain
+        # Set by get_db_connection on this thread just before
+        self._breaker = getattr(db_thread_state, "breaker", None)
+
+    def execute(self, operation, params=()):
+        name = self._statements.name_of(operation)
+        if name is None:
+            self._current = self._plain
+            self._current.execute(operation, params)
+        else:
+            self._current = self._statements.execute(self._prepared, self._connection, name, params)
+
+        # A query went through, so earlier failures were not consecutive
+        if self._breaker is not None:
+            self._breaker.record_success()
 
+    def fetchone(self):
+        return self._current.fetchone()
+
+    def fetchall(self):
+        return self._current.fetchall()
+
+    def close(self):
+        # Rows left unread would make the pool's session reset fail on check-in
+        discard_unread_result(self._connection)
+        for cursor in self._prepared.values():
+            cursor.close()
+        self._prepared.clear()
+        self._plain.close()
+
+
+prepared_statements = PreparedStatements(DB_PREPARED_STATEMENTS)
+
+
+def get_db_connection(query_class=None):
+    connection = db_router.connect(query_class)[0]
+
+    # Let the server kill runaway queries of the heavy query classes
+    max_execution_time = DB_MAX_EXECUTION_TIME.get(query_class)
+    if max_execution_time:
+        cursor = connection.cursor()
+        cursor.execute("SET SESSION MAX_EXECUTION_TIME = %s", (max_execution_time,))
+        cursor.close()
+
+    return connection
+
+
+class LeaderElection:
+    """
+    Elects a single worker per host to run the scheduled jobs.
+
+    Every worker tries to take an exclusive, non-blocking flock on the same
+    lock file; the one that gets it is the leader. The kernel drops the lock
+    when the leader process exits, so a follower picks it up on its next poll.
+    """
+
+    def __init__(self, lock_path):
+        self.lock_path = lock_path
+        self.is_leader = False
+        self._fd = None
+
+    def try_acquire(self):
+        if self.is_leader:
+            return True
+
+        os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+
+        # Record who holds the lock, for humans looking at the state directory
+        os.ftruncate(fd, 0)
+        os.write(fd, f"{os.getpid()}\n".encode())
+
+        self._fd = fd
+        self.is_leader = True
+        print(f"\tWorker {os.getpid()} elected leader for scheduled jobs")
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+        self.is_leader = False
+
+
+leader_election = LeaderElection(os.path.join(STATE_DIR, "leader.lock"))
+
+
+DAY_NAMES = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday")
+
+
+class SharedState:
+    """
+    Host-wide state shared by all workers through a memory-mapped file.
+
+    Holds the raw hour-of-week cart histogram (7 x 24 doubles, Monday first),
+    the date it was calculated for and the time of the last backup. Writers
+    serialize on an flock and bump a sequence number before and after each
+    update (odd while a write is in progress), so readers can take a
+    consistent snapshot without locking and read the histogram in place.
+    """
+
+    _HEADER = struct.Struct("<4sIQqd")  # magic, reserved, seq, calculation date ordinal, last backup timestamp
+    _SEQ = struct.Struct("<Q")
+    _SEQ_OFFSET = 8
+    _MAGIC = b"AOS1"
+    _HISTOGRAM_OFFSET = _HEADER.size
+    _HISTOGRAM_SIZE = 7 * 24
+    _SIZE = _HEADER.size + _HISTOGRAM_SIZE * 8
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+        self._mm = None
+        self._lock = threading.Lock()
+
+    def _map(self):
+        if self._mm is not None:
+            return self._mm
+
+        with self._lock:
+            if self._mm is None:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                try:
+                    if os.fstat(fd).st_size != self._SIZE:
+                        os.ftruncate(fd, 0)
+                        os.ftruncate(fd, self._SIZE)
+                    mm = mmap.mmap(fd, self._SIZE)
+                    if mm[:4] != self._MAGIC:
+                        self._HEADER.pack_into(mm, 0, self._MAGIC, 0, 0, 0, float("nan"))
+                    self._repair_seq(mm)
+                finally:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                self._fd = fd
+                self._mm = mm
+
+        return self._mm
+
+    @contextmanager
+    def _write(self):
+        mm = self._map()
+        # flock only excludes other processes, threads of this one share the fd
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                seq = self._SEQ.unpack_from(mm, self._SEQ_OFFSET)[0] | 1
+                self._SEQ.pack_into(mm, self._SEQ_OFFSET, seq)
+                try:
+                    yield mm
+                finally:
+                    self._SEQ.pack_into(mm, self._SEQ_OFFSET, seq + 1)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _repair_seq(self, mm):
+        # Must hold the flock: an odd sequence then means a writer died mid-update
+        seq = self._SEQ.unpack_from(mm, self._SEQ_OFFSET)[0]
+        if seq % 2:
+            self._SEQ.pack_into(mm, self._SEQ_OFFSET, seq + 1)
+
+    def _read(self, reader):
+        mm = self._map()
+        attempts = 0
+        while True:
+            seq = self._SEQ.unpack_from(mm, self._SEQ_OFFSET)[0]
+            if seq % 2 == 0:
+                result = reader(mm)
+                if self._SEQ.unpack_from(mm, self._SEQ_OFFSET)[0] == seq:
+                    return seq, result
+
+            attempts += 1
+            if attempts % 1000 == 0:
+                with self._lock:
+                    fcntl.flock(self._fd, fcntl.LOCK_EX)
+                    try:
+                        self._repair_seq(mm)
+                    finally:
+                        fcntl.flock(self._fd, fcntl.LOCK_UN)
+            time.sleep(0)
+
+    def _unpack_header(self, mm):
+        _, _, _, date_ordinal, backup_timestamp = self._HEADER.unpack_from(mm, 0)
+        calculation_date = datetime.fromordinal(date_ordinal).date() if date_ordinal else None
+        last_backup_time = None if math.isnan(backup_timestamp) else datetime.fromtimestamp(backup_timestamp)
+        return calculation_date, last_backup_time
+
+    def _pack_header(self, mm, calculation_date, last_backup_time):
+        magic, reserved, seq, _, _ = self._HEADER.unpack_from(mm, 0)
+        date_ordinal = calculation_date.toordinal() if calculation_date else 0
+        backup_timestamp = last_backup_time.timestamp() if last_backup_time else float("nan")
+        self._HEADER.pack_into(mm, 0, magic, reserved, seq, date_ordinal, backup_timestamp)
+
+    @property
+    def version(self):
+        return self._SEQ.unpack_from(self._map(), self._SEQ_OFFSET)[0]
+
+    @property
+    def calculation_date(self):
+        return self._read(self._unpack_header)[1][0]
+
+    @property
+    def last_backup_time(self):
+        return self._read(self._unpack_header)[1][1]
+
+    @last_backup_time.setter
+    def last_backup_time(self, value):
+        with self._write() as mm:
+            calculation_date, _ = self._unpack_header(mm)
+            self._pack_header(mm, calculation_date, value)
+
+    def histogram_view(self):
+        # Zero-copy 7 x 24 view of the histogram, only consistent inside read_histogram()
+        mm = self._map()
+        return np.frombuffer(mm, dtype="<f8", count=self._HISTOGRAM_SIZE, offset=self._HISTOGRAM_OFFSET).reshape(7, 24)
+
+    def read_histogram(self, decode):
+        """Returns (version, decode(histogram view)) from a consistent snapshot."""
+        view = self.histogram_view()
+        return self._read(lambda mm: decode(view))
+
+    def publish_histogram(self, calculation_date, counts):
+        with self._write() as mm:
+            _, last_backup_time = self._unpack_header(mm)
+            self._pack_header(mm, calculation_date, last_backup_time)
+            self.histogram_view()[:] = np.asarray(counts, dtype=float).reshape(7, 24)
+
+    def claim_backup(self, now, interval):
+        """Atomically records a backup at `now` unless one ran within `interval`."""
+        with self._write() as mm:
+            calculation_date, last_backup_time = self._unpack_header(mm)
+            if last_backup_time is not None and (now - last_backup_time) < interval:
+                return False
+            self._pack_header(mm, calculation_date, now)
+            return True
+
+    def release_backup(self, claimed_at):
+        """Undoes claim_backup(claimed_at) after a failed backup, unless the time has changed since."""
+        with self._write() as mm:
+            calculation_date, last_backup_time = self._unpack_header(mm)
+            # Stored as a float timestamp, so compare with some slack
+            if last_backup_time is not None and abs((last_backup_time - claimed_at).total_seconds()) < 0.001:
+                self._pack_header(mm, calculation_date, None)
+
+
+shared_state = SharedState(os.path.join(STATE_DIR, "shared_state.bin"))
+
+
+HOUR_LABELS = tuple(f"{hour_of_day:02d}:00 - {hour_of_day+1:02d}:00" for hour_of_day in range(24))
+
+
+def activity_data_from_counts(counts):
+    counts = np.asarray(counts, dtype=float).reshape(7, 24)
+
+    day_totals = counts.sum(axis=1)
+    max_activity = day_totals.max()
+    if not max_activity:
+        return {}
+
+    day_probability = np.round(day_totals / max_activity, 4)
+    max_hours = counts.max(axis=1, keepdims=True)
+    hour_probability = np.round(np.divide(counts, max_hours, out=np.zeros_like(counts), where=max_hours > 0), 4)
+
+    # Days and hours without any carts are left out, as they always have been
+    data = {}
+    for day in np.flatnonzero(day_totals):
+        data[DAY_NAMES[day]] = {
+            "probability": float(day_probability[day]),
+            "busy_hours": {HOUR_LABELS[hour_of_day]: float(hour_probability[day, hour_of_day]) for hour_of_day in np.flatnonzero(counts[day])}
+        }
+
+    return data
+
+
+# Decoded copy of the shared histogram for this worker, and the version it came from
 activity_data = {}
-last_calculation_date = None
+activity_data_version = None
+
+class SingleFlight:
+    """
+    Lets concurrent calls with the same key share one execution.
+
+    The first caller for a key runs the function; callers arriving while it
+    is still running wait for it and get the same result (or exception).
+    Nothing is cached once the call has finished.
+    """
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.stats = {"executed": 0, "shared": 0}
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            owner = call is None
+            if owner:
+                call = self._calls[key] = self._Call()
+                self.stats["executed"] += 1
+            else:
+                self.stats["shared"] += 1
+
+        if not owner:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+        return call.result
+
+
+request_flights = SingleFlight()
+
+def single_flight(func):
+    # Concurrent requests to the same endpoint with the same parameters share one run
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        key = (func.__name__, tuple(sorted(bound.arguments.items())))
+        return request_flights.do(key, lambda: func(*args, **kwargs))
+
+    return wrapper
+
+
+QUERY_PROFILES_LATEST_UPDATE = "SELECT MAX(updatedAt) FROM ylift_api.profiles"
+QUERY_PROFILES_UPDATED_SINCE = "SELECT id FROM ylift_api.profiles WHERE updatedAt > %s"
+
+
+class ProfileCache:
+    """
+    Bounded LRU cache of profile id -> (email, name, customerid).
+
+    Entries expire after `ttl` seconds. At most once per
+    `watermark_interval` seconds, a lookup compares the newest
+    profiles.updatedAt with the last one seen and drops profiles updated
+    since from the cache; lookups in between are served without a query
+    when every profile is cached. Misses are filled with a single IN query.
+    """
+
+    def __init__(self, max_size, ttl, watermark_interval=0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.watermark_interval = watermark_interval
+        self._entries = OrderedDict()
+        self._watermark = None
+        self._watermark_checked_at = None
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def _sync_watermark(self, cursor):
+        cursor.execute(QUERY_PROFILES_LATEST_UPDATE)
+        latest = cursor.fetchone()[0]
+
+        if self._watermark is not None and latest is not None and latest > self._watermark:
+            cursor.execute(QUERY_PROFILES_UPDATED_SINCE, (self._watermark,))
+            with self._lock:
+                for row in cursor.fetchall():
+                    if self._entries.pop(row[0], None) is not None:
+                        self.stats["invalidations"] += 1
+
+        if latest is not None:
+            self._watermark = latest
+
+    def get_many(self, cursor, profile_ids):
+        now = time.monotonic()
+        if self._watermark_checked_at is None or now - self._watermark_checked_at >= self.watermark_interval:
+            self._sync_watermark(cursor)
+            self._watermark_checked_at = now
+
+        profiles = {}
+        misses = []
+        with self._lock:
+            for profile_id in profile_ids:
+                entry = self._entries.get(profile_id)
+                if entry is not None and entry[0] > now:
+                    self._entries.move_to_end(profile_id)
+                    profiles[profile_id] = entry[1]
+                else:
+                    misses.append(profile_id)
+            self.stats["hits"] += len(profiles)
+            self.stats["misses"] += len(misses)
+
+        if misses:
+            query_profiles = """
+                SELECT id, email, name, customerid
+                FROM ylift_api.profiles
+                WHERE id IN ({})
+            """.format(','.join(['%s'] * len(misses)))
+            cursor.execute(query_profiles, misses)
+            fetched = {row[0]: tuple(row[1:]) for row in cursor.fetchall()}
+
+            with self._lock:
+                for profile_id, profile in fetched.items():
+                    self._entries[profile_id] = (now + self.ttl, profile)
+                    self._entries.move_to_end(profile_id)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+                    self.stats["evictions"] += 1
+
+            profiles.update(fetched)
+
+        return profiles
+
+    def metrics(self):
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return {
+                "size": len(self._entries),
+                "hitRate": round(self.stats["hits"] / lookups, 4) if lookups else 0,
+                **self.stats
+            }
+
+
+profile_cache = ProfileCache(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL, PROFILE_CACHE_WATERMARK_INTERVAL)
+
+
+def store_day_bounds(day):
+    """Returns the start and end of a store date in UTC (naive, like the database's timestamps)."""
+    store_tz = timezone(STORE_TIMEZONE)
+    start = store_tz.localize(datetime.combine(day, datetime.min.time()))
+    end = store_tz.localize(datetime.combine(day + timedelta(days=1), datetime.min.time()))
+    return start.astimezone(utc).replace(tzinfo=None), end.astimezone(utc).replace(tzinfo=None)
+
+
+def store_day(now=None):
+    """Returns the store's current date and its start and end in UTC (naive, like the database's timestamps)."""
+    local_now = (utc.localize(now) if now is not None else datetime.now(utc)).astimezone(timezone(STORE_TIMEZONE))
+    return (local_now.date(), *store_day_bounds(local_now.date()))
+
+
+class HotCart:
+    __slots__ = ("id", "profile_id", "created_at", "updated_at")
+
+    def __init__(self, id, profile_id, created_at, updated_at):
+        self.id = id
+        self.profile_id = profile_id
+        self.created_at = created_at
+        self.updated_at = updated_at
+
+
+class HotCartItem:
+    __slots__ = ("id", "cart_id", "updated_at")
+
+    def __init__(self, id, cart_id, updated_at):
+        self.id = id
+        self.cart_id = cart_id
+        self.updated_at = updated_at
+
+
+QUERY_HOT_SET_CARTS = """
+    SELECT id, profileId, createdAt, updatedAt
+    FROM ylift_api.carts
+    WHERE updatedAt >= %s
+"""
+QUERY_HOT_SET_ITEMS = """
+    SELECT id, cartId, updatedAt
+    FROM ylift_api.cartItems
+    WHERE updatedAt >= %s
+"""
+QUERY_CARTS_LATEST_UPDATE = """
+    SELECT MAX(updatedAt) AS last_active_cart
+    FROM ylift_api.carts
+"""
+
+
+class TodayHotSet:
+    """
+    In-memory index of today's carts and cart items.
+
+    Each worker loads the carts and cart items updated since the start of the
+    store's day (and the hour before, for /activity's last-hour window), then
+    every `refresh_interval` seconds fetches only the rows updated since the
+    newest updatedAt seen. Carts owning those items are loaded too, so every
+    item can be traced to a profile. Everything is reloaded at the store's
+    day boundary and every `reload_interval` seconds, which also drops
+    deleted rows. Until a refresh has succeeded within `max_staleness`
+    seconds the hot set is not ready and endpoints read from MySQL.
+    """
+
+    class _Index:
+        def __init__(self, since):
+            self.carts = {}
+            self.carts_by_profile = {}
+            self.items = {}
+            self.cart_watermark = since
+            self.item_watermark = since
+
+        def apply(self, cart_rows, item_rows):
+            for row in cart_rows:
+                cart = HotCart(*row)
+                previous = self.carts.get(cart.id)
+                if previous is not None and previous.profile_id != cart.profile_id:
+                    self.carts_by_profile[previous.profile_id].discard(cart.id)
+                self.carts[cart.id] = cart
+                self.carts_by_profile.setdefault(cart.profile_id, set()).add(cart.id)
+                self.cart_watermark = max(self.cart_watermark, cart.updated_at)
+
+            for row in item_rows:
+                item = HotCartItem(*row)
+                self.items[item.id] = item
+                self.item_watermark = max(self.item_watermark, item.updated_at)
+
+    def __init__(self, refresh_interval, reload_interval, max_staleness, overlap=5):
+        self.refresh_interval = refresh_interval
+        self.reload_interval = reload_interval
+        self.max_staleness = max_staleness
+        # Seconds re-read behind the watermark, for rows committed out of updatedAt order
+        self.overlap = overlap
+        self.day = None
+        self.last_cart_update = None
+        self.loaded_at = None
+        self.refreshed_at = None
+        self._index = None
+        self._lock = threading.Lock()
+        self.stats = {"reloads": 0, "refreshes": 0, "errors": 0}
+
+    def _fetch(self, cursor, known_carts, carts_since, items_since):
+        cursor.execute(QUERY_HOT_SET_CARTS, (carts_since,))
+        cart_rows = cursor.fetchall()
+
+        cursor.execute(QUERY_HOT_SET_ITEMS, (items_since,))
+        item_rows = cursor.fetchall()
+
+        # Carts not updated today whose items were
+        missing = {row[1] for row in item_rows} - known_carts - {row[0] for row in cart_rows}
+        if missing:
+            cursor.execute("""
+                SELECT id, profileId, createdAt, updatedAt
+                FROM ylift_api.carts
+                WHERE id IN ({})
+            """.format(','.join(['%s'] * len(missing))), list(missing))
+            cart_rows = list(cart_rows) + cursor.fetchall()
+
+        return cart_rows, item_rows
+
+    def refresh(self, now=None):
+        day = store_day(now)
+
+        connection = get_db_connection("hotset")
+        try:
+            cursor = prepared_statements.cursor(connection)
+
+            if self._index is None or self.day[0] != day[0] or time.monotonic() - self.loaded_at >= self.reload_interval:
+                since = day[1] - timedelta(hours=1)
+                cursor.execute(QUERY_CARTS_LATEST_UPDATE)
+                last_cart_update = cursor.fetchone()[0]
+
+                index = self._Index(since)
+                index.apply(*self._fetch(cursor, set(), since, since))
+
+                with self._lock:
+                    self.day, self._index, self.last_cart_update = day, index, last_cart_update
+                self.loaded_at = time.monotonic()
+                self.stats["reloads"] += 1
+            else:
+                index = self._index
+                overlap = timedelta(seconds=self.overlap)
+                cart_rows, item_rows = self._fetch(cursor, set(index.carts), index.cart_watermark - overlap, index.item_watermark - overlap)
+
+                with self._lock:
+                    index.apply(cart_rows, item_rows)
+                    if self.last_cart_update is None or index.cart_watermark > self.last_cart_update:
+                        self.last_cart_update = index.cart_watermark
+                self.stats["refreshes"] += 1
+
+            cursor.close()
+        finally:
+            connection.close()
+
+        self.refreshed_at = time.monotonic()
+
+    def run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as error:
+                self.stats["errors"] += 1
+                print(f"Error refreshing today's carts: {error}")
+            time.sleep(self.refresh_interval)
+
+    def is_ready(self):
+        return (
+            self.refreshed_at is not None
+            and time.monotonic() - self.refreshed_at <= self.max_staleness
+            and self.day[0] == store_day()[0]
+        )
+
+    def _today(self, record):
+        return self.day[1] <= record.updated_at < self.day[2]
+
+    def active_carts(self):
+        with self._lock:
+            carts = [cart for cart in self._index.carts.values() if self._today(cart)]
+        carts.sort(key=lambda cart: cart.id)
+        return [ActiveCart(profileId=cart.profile_id, createdAt=cart.created_at, updatedAt=cart.updated_at) for cart in carts]
+
+    def active_profile_ids(self):
+        """Profiles with a cart, or a cart item, updated today."""
+        with self._lock:
+            carts = self._index.carts
+            profile_ids = {cart.profile_id for cart in carts.values() if self._today(cart)}
+            profile_ids.update(carts[item.cart_id].profile_id for item in self._index.items.values() if self._today(item) and item.cart_id in carts)
+        return list(profile_ids)
+
+    def cart_item_counts(self):
+        """Cart items updated today per profile."""
+        counts = {}
+        with self._lock:
+            carts = self._index.carts
+            for item in self._index.items.values():
+                if self._today(item) and item.cart_id in carts:
+                    profile_id = carts[item.cart_id].profile_id
+                    counts[profile_id] = counts.get(profile_id, 0) + 1
+        return counts
+
+    def hourly_cart_counts(self):
+        """Carts updated today per UTC hour, like HOUR(updatedAt)."""
+        counts = {}
+        with self._lock:
+            for cart in self._index.carts.values():
+                if self._today(cart):
+                    counts[cart.updated_at.hour] = counts.get(cart.updated_at.hour, 0) + 1
+        return counts
+
+    def store_activity(self, since):
+        """Returns the newest cart update, the newest cart item update today and the carts active since `since`."""
+        with self._lock:
+            carts = self._index.carts
+            today_items = [item for item in self._index.items.values() if self._today(item) and item.cart_id in carts]
+            last_active_item = max((item.updated_at for item in today_items), default=None)
+
+            active = {cart.id for cart in carts.values() if cart.updated_at >= since}
+            active.update(item.cart_id for item in self._index.items.values() if item.updated_at >= since and item.cart_id in carts)
+            return self.last_cart_update, last_active_item, len(active)
+
+    def metrics(self):
+        index = self._index
+        return {
+            "ready": self.is_ready(),
+            "day": self.day[0].isoformat() if self.day else None,
+            "carts": len(index.carts) if index else 0,
+            "cartItems": len(index.items) if index else 0,
+            "ageSeconds": round(time.monotonic() - self.refreshed_at, 1) if self.refreshed_at is not None else None,
+            **self.stats
+        }
+
+
+today_hot_set = TodayHotSet(HOT_SET_REFRESH_INTERVAL, HOT_SET_RELOAD_INTERVAL, HOT_SET_MAX_STALENESS)
+
 
 def calculate_activity_probability():
-    global activity_data, last_calculation_date
+    global activity_data, activity_data_version
 
     current_date = datetime.now().date()
 
-    if last_calculation_date == current_date:
-        return
+    if shared_state.calculation_date != current_date:
+        try:
+            connection = get_db_connection("probability")
+            cursor = connection.cursor()
+
+            query = """
+                SELECT WEEKDAY(updatedAt) AS day_of_week, HOUR(updatedAt) AS hour_of_day, COUNT(*) AS cart_count
+                FROM ylift_api.carts
+                GROUP BY day_of_week, hour_of_day
+            """
+            cursor.execute(query)
+
+            counts = np.zeros((7, 24))
+            rows = np.array(cursor.fetchall(), dtype=np.int64).reshape(-1, 3)
+            counts[rows[:, 0], rows[:, 1]] = rows[:, 2]
+
+            cursor.close()
+            connection.close()
+
+        except mysql.connector.Error as error:
+            log_db_error(error)
+            raise HTTPException(status_code=500, detail="Internal server error")
+
+        shared_state.publish_histogram(current_date, counts)
+
+    # Another worker (normally the leader) may already have done today's work
+    if shared_state.version != activity_data_version:
+        activity_data_version, activity_data = shared_state.read_histogram(activity_data_from_counts)
+
+
+def forecast_hour_of_week(weekly_counts, alpha, z=1.96):
+    """
+    Exponentially weighted forecast of hourly counts for one day of the week.
+
+    `weekly_counts` is a (weeks, 24) array of past counts, oldest week first.
+    Returns the expected count per hour and a lower/upper band of `z`
+    weighted standard deviations around it.
+    """
+    weeks = weekly_counts.shape[0]
+    weights = (1 - alpha) ** np.arange(weeks - 1, -1, -1)
+    weights /= weights.sum()
+
+    expected = weights @ weekly_counts
+    spread = np.sqrt(weights @ (weekly_counts - expected) ** 2)
+
+    return expected, np.maximum(expected - z * spread, 0), expected + z * spread
+
+
+# Today's forecast for this worker, as (date, (expected, lower, upper))
+activity_forecast = (None, None)
+
+def calculate_activity_forecast(current_date):
+    """Forecast for the store date `current_date`, by UTC hour like the histogram and ?current."""
+    global activity_forecast
+
+    if activity_forecast[0] == current_date:
+        return activity_forecast[1]
+
+    # The same store weekday in each of the last FORECAST_WEEKS weeks, oldest first, as UTC ranges
+    windows = [store_day_bounds(current_date - timedelta(weeks=weeks_ago)) for weeks_ago in range(FORECAST_WEEKS, 0, -1)]
 
     try:
-        connection = get_db_connection()
+        connection = get_db_connection("probability")
         cursor = connection.cursor()
 
         query = """
-            SELECT DAYNAME(updatedAt) AS day_of_week, HOUR(updatedAt) AS hour_of_day
+            SELECT DATE(updatedAt) AS day, HOUR(updatedAt) AS hour_of_day, COUNT(*) AS cart_count
             FROM ylift_api.carts
+            WHERE updatedAt >= %s AND updatedAt < %s
+            GROUP BY day, hour_of_day
         """
-        cursor.execute(query)
+        cursor.execute(query, (windows[0][0], windows[-1][1]))
 
-        activity_data = {}
-        for row in cursor.fetchall():
-            day_of_week = row[0]
-            hour_of_day = row[1]
+        weekly_counts = np.zeros((FORECAST_WEEKS, 24))
+        for day, hour_of_day, cart_count in cursor.fetchall():
+            hour_start = datetime.combine(day, datetime.min.time()) + timedelta(hours=hour_of_day)
+            for week, (start, end) in enumerate(windows):
+                if start <= hour_start < end:
+                    weekly_counts[week, hour_of_day] += cart_count
 
-            if day_of_week not in activity_data:
-                activity_data[day_of_week] = {
-                    "probability": 0,
-                    "busy_hours": {}
-                }
+        cursor.close()
+        connection.close()
 
-            activity_data[day_of_week]["probability"] += 1
+    except mysql.connector.Error as error:
+        log_db_error(error)
+        raise HTTPException(status_code=500, detail="Internal server error")
 
-            hour_label = f"{hour_of_day:02d}:00 - {hour_of_day+1:02d}:00"
-            if hour_label not in activity_data[day_of_week]["busy_hours"]:
-                activity_data[day_of_week]["busy_hours"][hour_label] = 0
+    activity_forecast = (current_date, forecast_hour_of_week(weekly_counts, FORECAST_ALPHA))
+    return activity_forecast[1]
+
+
+class HealthProber:
+    """
+    Checks dependencies on a background thread every `interval` seconds.
+
+    `probes` maps a dependency name to a callable that raises when the
+    dependency is unhealthy. Health endpoints only read the latest results,
+    so answering a load balancer never touches a dependency.
+    """
+
+    def __init__(self, probes, interval):
+        self.probes = probes
+        self.interval = interval
+        self.results = {}
+
+    def probe_once(self):
+        results = {}
+        for name, probe in self.probes.items():
+            started = time.perf_counter()
+            try:
+                probe()
+                status, error = "OK", None
+            except Exception as probe_error:
+                status, error = "Error", str(probe_error) or type(probe_error).__name__
+            results[name] = {
+                "status": status,
+                "latencyMs": round((time.perf_counter() - started) * 1000, 2),
+                "checkedAt": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+                "error": error
+            }
+        # Swap in the whole set at once so readers never see a mix of rounds
+        self.results = results
+
+    def run(self):
+        while True:
+            self.probe_once()
+            time.sleep(self.interval)
+
+    def is_ready(self, required):
+        results = self.results
+        return all(results.get(name, {}).get("status") == "OK" for name in required)
+
+
+def probe_mysql(db_config):
+    def probe():
+        connection = connect_with_breaker(db_config)
+        try:
+            connection.ping()
+        finally:
+            connection.close()
+    return probe
+
+
+def probe_backup_dir():
+    with tempfile.TemporaryFile(dir=BACK_UP_LOC):
+        pass
+
+
+def probe_authorizenet():
+    try:
+        urllib.request.urlopen(AUTHORIZENET_HEALTH_URL, timeout=HEALTH_PROBE_TIMEOUT).close()
+    except urllib.error.HTTPError as error:
+        # Any answer short of a server error means the gateway is reachable
+        if error.code >= 500:
+            raise
+
+
+health_probes = {"mysql": probe_mysql(DB_CONFIG), "backup_dir": probe_backup_dir}
+for replica in DB_REPLICAS:
+    health_probes[f"mysql_replica:{replica['host']}"] = probe_mysql(replica)
+if AUTHORIZENET_HEALTH_URL:
+    health_probes["authorizenet"] = probe_authorizenet
+
+health_prober = HealthProber(health_probes, HEALTH_PROBE_INTERVAL)
+
+
+class AdmissionRejected(Exception):
+    pass
+
+
+class AdmissionQueue:
+    """
+    Concurrency limit with a bounded wait queue.
+
+    Up to `limit` holders at once; callers beyond that wait in a queue of at
+    most `max_queue`, served by priority (lowest first) and then arrival.
+    Callers are rejected straight away when the queue is full, and give up
+    after waiting `timeout` seconds. Runs on the event loop, so no locking.
+    """
+
+    def __init__(self, limit, max_queue, timeout):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self._waiters = []
+        self._seq = 0
+        self.stats = {"admitted": 0, "queued": 0, "shed": 0, "timedOut": 0}
+
+    async def acquire(self, priority=0, timeout=None):
+        if self.active < self.limit and not self.waiting:
+            self.active += 1
+            self.stats["admitted"] += 1
+            return
+
+        if self.waiting >= self.max_queue:
+            self.stats["shed"] += 1
+            raise AdmissionRejected("Server busy")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._waiters, (priority, self._seq, waiter))
+        self.waiting += 1
+        self.stats["queued"] += 1
+
+        try:
+            await asyncio.wait_for(waiter, self.timeout if timeout is None else timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as error:
+            if waiter.done() and not waiter.cancelled():
+                # Handed a slot just as we gave up, pass it on
+                self.release()
+            else:
+                self.waiting -= 1
+                waiter.cancel()
+            if isinstance(error, asyncio.CancelledError):
+                raise
+            self.stats["timedOut"] += 1
+            raise AdmissionRejected("Timed out waiting for capacity")
+
+        self.stats["admitted"] += 1
+
+    def release(self):
+        # Hand the slot straight to the next live waiter, if any
+        while self._waiters:
+            _, _, waiter = heapq.heappop(self._waiters)
+            if not waiter.done():
+                self.waiting -= 1
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def metrics(self):
+        return {"limit": self.limit, "active": self.active, "waiting": self.waiting, **self.stats}
+
+
+class AdmissionControl:
+    """
+    Per-route admission control with priority classes.
+
+    Each route prefix has its own concurrency limit and wait queue, and every
+    limited request also needs one of `max_in_flight` shared slots, handed
+    out by priority class. Keeping the shared limit below the threadpool
+    size means slow reports cannot take every thread, and higher classes
+    get freed slots first. Routes with no concurrency limit (health checks)
+    and unknown paths skip admission entirely.
+    """
+
+    def __init__(self, routes, max_in_flight, priorities):
+        self.routes = {}
+        for prefix, (priority_class, limit, max_queue, timeout) in routes.items():
+            queue = AdmissionQueue(limit, max_queue, timeout) if limit is not None else None
+            self.routes[prefix] = (priorities.index(priority_class), queue)
+        # Longest prefix first
+        self._prefixes = sorted(self.routes, key=len, reverse=True)
+        self.shared = AdmissionQueue(max_in_flight, max_in_flight * 4, None)
+
+    def route_for(self, path):
+        for prefix in self._prefixes:
+            if path == prefix or path.startswith(prefix.rstrip("/") + "/"):
+                return prefix
+        return None
+
+    @asynccontextmanager
+    async def admit(self, path):
+        prefix = self.route_for(path)
+        priority, queue = self.routes[prefix] if prefix is not None else (None, None)
+        if queue is None:
+            yield
+            return
+
+        deadline = time.monotonic() + queue.timeout
+        await queue.acquire(priority)
+        try:
+            await self.shared.acquire(priority, timeout=max(deadline - time.monotonic(), 0))
+            try:
+                yield
+            finally:
+                self.shared.release()
+        finally:
+            queue.release()
+
+    def metrics(self):
+        return {
+            "inFlight": self.shared.metrics(),
+            "routes": {prefix: queue.metrics() for prefix, (_, queue) in self.routes.items() if queue is not None}
+        }
 
-            activity_data[day_of_week]["busy_hours"][hour_label] += 1
 
-        cursor.close()
-        connection.close()
+class AdmissionMiddleware:
+    # Plain ASGI middleware, so streamed responses keep their slot until the body is sent
+    def __init__(self, app, controller):
+        self.app = app
+        self.controller = controller
 
-        max_activity = max(data["probability"] for data in activity_data.values())
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
 
-        for day_of_week in activity_data:
-            activity_data[day_of_week]["probability"] = round(activity_data[day_of_week]["probability"] / max_activity, 4)
+        try:
+            async with self.controller.admit(scope["path"]):
+                await self.app(scope, receive, send)
+        except AdmissionRejected as rejection:
+            response = JSONResponse(status_code=503, content={"detail": str(rejection)}, headers={"Retry-After": "1"})
+            await response(scope, receive, send)
 
-            max_hours = max(activity_data[day_of_week]["busy_hours"].values())
-            for hour_label in activity_data[day_of_week]["busy_hours"]:
-                activity_data[day_of_week]["busy_hours"][hour_label] = round(activity_data[day_of_week]["busy_hours"][hour_label] / max_hours, 4)
 
-            # Sort the 'busy_hours' dictionary based on hour labels
-            sorted_busy_hours = dict(sorted(activity_data[day_of_week]["busy_hours"].items(), key=lambda x: x[0]))
-            activity_data[day_of_week]["busy_hours"] = sorted_busy_hours
+admission_control = AdmissionControl(ADMISSION_ROUTES, ADMISSION_MAX_IN_FLIGHT, ADMISSION_PRIORITIES)
+app.add_middleware(AdmissionMiddleware, controller=admission_control)
 
-        last_calculation_date = current_date
 
-    except mysql.connector.Error as error:
-        print(f"Error connecting to MySQL database: {error}")
-        raise HTTPException(status_code=500, detail="Internal server error")
+@app.get("/health")
+async def health_check():
+    results = health_prober.results
+    mysql_ok = results.get("mysql", {}).get("status") == "OK"
+    return {
+        "status": "OK" if health_prober.is_ready(HEALTH_REQUIRED) else "Error",
+        "database": "Connected" if mysql_ok else "Not Connected",
+        "dependencies": results
+    }
 
 
-@app.get("/health")
-@limits(calls=10, period=60) 
-def health_check():
-    try:
-        connection = get_db_connection()
-        if connection.is_connected():
-            return {"status": "OK", "database": "Connected"}
-        else:
-            return {"status": "Error", "database": "Not Connected"}
-    except mysql.connector.Error as error:
-        print(f"Error connecting to MySQL database: {error}")
-        return {"status": "Error", "database": "Not Connected"}
+@app.get("/health/live")
+async def health_live():
+    # The process is up and the event loop is answering
+    return {"status": "OK"}
+
+
+@app.get("/health/ready")
+async def health_ready():
+    if not health_prober.is_ready(HEALTH_REQUIRED):
+        return JSONResponse(status_code=503, content={"status": "Error", "dependencies": health_prober.results})
+    return {"status": "OK"}
+
+
+@app.get("/metrics")
+@sleep_and_retry
+@limits(calls=30, period=60)
+def get_metrics():
+    return {
+        "circuitBreakers": {name: breaker.metrics() for name, breaker in list(circuit_breakers.items())},
+        "singleFlight": dict(request_flights.stats),
+        "profileCache": profile_cache.metrics(),
+        "transactionLedger": dict(transaction_ledger.stats),
+        "todayHotSet": today_hot_set.metrics(),
+        "admission": admission_control.metrics(),
+        "preparedStatements": prepared_statements.metrics()
+    }
 
 
 @app.get("/version")
@@ -120,6 +1501,30 @@ def get_version_info():
     return VERSION_INFO
 
 
+QUERY_ACTIVE_CARTS = """
+    SELECT profileId, createdAt, updatedAt
+    FROM ylift_api.carts
+    WHERE updatedAt >= %s AND updatedAt < %s
+"""
+
+
+def report_active_carts(cursor):
+    _, day_start, day_end = store_day()
+
+    cursor.execute(QUERY_ACTIVE_CARTS, (day_start, day_end))
+
+    active_carts = []
+    for row in cursor.fetchall():
+        active_cart = ActiveCart(
+            profileId=row[0],
+            createdAt=row[1],
+            updatedAt=row[2]
+        )
+        active_carts.append(active_cart)
+
+    return active_carts
+
+
 @app.get("/carts")
 @sleep_and_retry
 @limits(calls=2, period=60) 
@@ -127,27 +1532,14 @@ def get_active_carts(api_key: str = Depends(api_key_header)):
     if api_key != API_KEY:
         raise HTTPException(status_code=400, detail="Invalid API key")
 
-    current_date = datetime.now().date()
+    if today_hot_set.is_ready():
+        return today_hot_set.active_carts()
 
     try:
-        connection = get_db_connection()
-        cursor = connection.cursor()
-
-        query = """
-            SELECT profileId, createdAt, updatedAt
-            FROM ylift_api.carts
-            WHERE DATE(updatedAt) = %s
-        """
-        cursor.execute(query, (current_date,))
+        connection = get_db_connection("carts")
+        cursor = prepared_statements.cursor(connection)
 
-        active_carts = []
-        for row in cursor.fetchall():
-            active_cart = ActiveCart(
-                profileId=row[0],
-                createdAt=row[1],
-                updatedAt=row[2]
-            )
-            active_carts.append(active_cart)
+        active_carts = report_active_carts(cursor)
 
         cursor.close()
         connection.close()
@@ -155,39 +1547,52 @@ def get_active_carts(api_key: str = Depends(api_key_header)):
         return active_carts
 
     except mysql.connector.Error as error:
-        print(f"Error connecting to MySQL database: {error}")
+        log_db_error(error)
         raise HTTPException(status_code=500, detail="Internal server error")
 
-@app.get("/accounts")
-@sleep_and_retry
-@limits(calls=50, period=60)
-def get_active_accounts(api_key: str = Depends(api_key_header)):
-    if api_key != API_KEY:
-        raise HTTPException(status_code=400, detail="Invalid API key")
-
-    try:
-        connection = get_db_connection()
-        cursor = connection.cursor()
-
-        current_date = datetime.now().date()
-        yesterday = current_date - timedelta(days=1)
 
+QUERY_ACCOUNTS_CART_IDS = """
+    SELECT DISTINCT cartId
+    FROM ylift_api.cartItems
+    WHERE updatedAt >= %s AND updatedAt < %s
+"""
+QUERY_ACCOUNTS_PROFILE_IDS = """
+    SELECT DISTINCT profileId
+    FROM ylift_api.carts
+    WHERE updatedAt >= %s AND updatedAt < %s
+"""
+# Run once per active profile, so they are the only statements worth preparing:
+# a prepared statement lasts one checkout, and a statement run once per request
+# would pay a prepare and a close on top of the execution
+QUERY_ACCOUNTS_ORDERS = prepared_statements.register("accounts.orders", """
+    SELECT COUNT(*) as num_purchases,
+           SUM(CASE WHEN status != 'COMPLETED' THEN 1 ELSE 0 END) as open_orders
+    FROM ylift_api.orders
+    WHERE profileId = %s AND createdAt >= %s AND createdAt < %s
+""")
+QUERY_ACCOUNTS_CART_ITEMS = prepared_statements.register("accounts.cart_items", """
+    SELECT COUNT(*)
+    FROM ylift_api.cartItems ci
+    JOIN ylift_api.carts c ON ci.cartId = c.id
+    WHERE c.profileId = %s AND ci.updatedAt >= %s AND ci.updatedAt < %s
+""")
+
+
+def report_active_accounts(cursor, hot_set=None):
+    # Today's carts and cart items come from the hot set when given, orders always from MySQL
+    _, day_start, day_end = store_day()
+    _, yesterday_start, _ = store_day(day_start - timedelta(seconds=1))
+
+    if hot_set is not None:
+        profile_ids = hot_set.active_profile_ids()
+        cart_item_counts = hot_set.cart_item_counts()
+    else:
         # Get cartIds from cartItems for the current date
-        query_cart_items = """
-            SELECT DISTINCT cartId
-            FROM ylift_api.cartItems
-            WHERE DATE(updatedAt) = %s
-        """
-        cursor.execute(query_cart_items, (current_date,))
+        cursor.execute(QUERY_ACCOUNTS_CART_IDS, (day_start, day_end))
         cart_ids_from_items = [row[0] for row in cursor.fetchall()]
 
         # Get profileIds from active carts for the current date
-        query_active_carts = """
-            SELECT DISTINCT profileId
-            FROM ylift_api.carts
-            WHERE DATE(updatedAt) = %s
-        """
-        cursor.execute(query_active_carts, (current_date,))
+        cursor.execute(QUERY_ACCOUNTS_PROFILE_IDS, (day_start, day_end))
         profile_ids_from_carts = [row[0] for row in cursor.fetchall()]
 
         # Get profileIds from carts associated with active cartItems
@@ -204,75 +1609,80 @@ def get_active_accounts(api_key: str = Depends(api_key_header)):
 
         # Merge and deduplicate profile IDs
         profile_ids = list(set(profile_ids_from_carts + profile_ids_from_items))
+        cart_item_counts = None
 
-        active_accounts = []
+    active_accounts = []
 
-        for profile_id in profile_ids:
-            query_profile = """
-                SELECT email, name, customerid
-                FROM ylift_api.profiles
-                WHERE id = %s
-            """
-            cursor.execute(query_profile, (profile_id,))
-            result = cursor.fetchone()
-
-            if result:
-                email, name, customer_id = result
-
-                # Check for purchases and open orders
-                query_orders = """
-                    SELECT COUNT(*) as num_purchases, 
-                           SUM(CASE WHEN status != 'COMPLETED' THEN 1 ELSE 0 END) as open_orders
-                    FROM ylift_api.orders
-                    WHERE profileId = %s AND DATE(createdAt) = %s
-                """
-                cursor.execute(query_orders, (profile_id, current_date))
-                order_result = cursor.fetchone()
-                num_purchases = order_result[0] if order_result else 0
-
-                # Check for cart items
-                query_cart_items = """
-                    SELECT COUNT(*) 
-                    FROM ylift_api.cartItems ci
-                    JOIN ylift_api.carts c ON ci.cartId = c.id
-                    WHERE c.profileId = %s AND DATE(ci.updatedAt) = %s
-                """
-                cursor.execute(query_cart_items, (profile_id, current_date))
+    profiles = profile_cache.get_many(cursor, profile_ids)
+
+    for profile_id in profile_ids:
+        result = profiles.get(profile_id)
+
+        if result:
+            email, name, customer_id = result
+
+            # Check for purchases and open orders
+            cursor.execute(QUERY_ACCOUNTS_ORDERS, (profile_id, day_start, day_end))
+            order_result = cursor.fetchone()
+            num_purchases = order_result[0] if order_result else 0
+
+            # Check for cart items
+            if cart_item_counts is not None:
+                has_cart_items = cart_item_counts.get(profile_id, 0) > 0
+            else:
+                cursor.execute(QUERY_ACCOUNTS_CART_ITEMS, (profile_id, day_start, day_end))
                 has_cart_items = cursor.fetchone()[0] > 0
 
-                active_accounts.append({
-                    "id": profile_id,
-                    "email": email,
-                    "name": name,
-                    "customerId": customer_id,
-                    "numPurchases": num_purchases,
-                    "recentlyOrdered": num_purchases > 0,
-                    "hasCartItems": has_cart_items
-                })
-
-        # If we have less than 5 accounts with purchases today, add accounts with purchases from yesterday
-        if sum(account['numPurchases'] > 0 for account in active_accounts) < 5:
-            query_yesterday_purchases = """
-                SELECT DISTINCT o.profileId, p.email, p.name, p.customerid, 
-                       COUNT(*) as num_purchases
-                FROM ylift_api.orders o
-                JOIN ylift_api.profiles p ON o.profileId = p.id
-                WHERE DATE(o.createdAt) = %s AND o.profileId NOT IN ({})
-                GROUP BY o.profileId
-            """.format(','.join(['%s'] * len(profile_ids)))
-            cursor.execute(query_yesterday_purchases, (yesterday, *profile_ids))
-            
-            for row in cursor.fetchall():
-                profile_id, email, name, customer_id, num_purchases = row
-                active_accounts.append({
-                    "id": profile_id,
-                    "email": email,
-                    "name": name,
-                    "customerId": customer_id,
-                    "numPurchases": num_purchases,
-                    "recentlyOrdered": num_purchases > 0,
-                    "hasCartItems": False  # Assuming no cart items for yesterday's purchases
-                })
+            active_accounts.append({
+                "id": profile_id,
+                "email": email,
+                "name": name,
+                "customerId": customer_id,
+                "numPurchases": num_purchases,
+                "recentlyOrdered": num_purchases > 0,
+                "hasCartItems": has_cart_items
+            })
+
+    # If we have less than 5 accounts with purchases today, add accounts with purchases from yesterday
+    if sum(account['numPurchases'] > 0 for account in active_accounts) < 5:
+        query_yesterday_purchases = """
+            SELECT DISTINCT o.profileId, p.email, p.name, p.customerid, 
+                   COUNT(*) as num_purchases
+            FROM ylift_api.orders o
+            JOIN ylift_api.profiles p ON o.profileId = p.id
+            WHERE o.createdAt >= %s AND o.createdAt < %s AND o.profileId NOT IN ({})
+            GROUP BY o.profileId
+        """.format(','.join(['%s'] * len(profile_ids)))
+        cursor.execute(query_yesterday_purchases, (yesterday_start, day_start, *profile_ids))
+
+        for row in cursor.fetchall():
+            profile_id, email, name, customer_id, num_purchases = row
+            active_accounts.append({
+                "id": profile_id,
+                "email": email,
+                "name": name,
+                "customerId": customer_id,
+                "numPurchases": num_purchases,
+                "recentlyOrdered": num_purchases > 0,
+                "hasCartItems": False  # Assuming no cart items for yesterday's purchases
+            })
+
+    return active_accounts
+
+
+@app.get("/accounts")
+@single_flight
+@sleep_and_retry
+@limits(calls=50, period=60)
+def get_active_accounts(api_key: str = Depends(api_key_header)):
+    if api_key != API_KEY:
+        raise HTTPException(status_code=400, detail="Invalid API key")
+
+    try:
+        connection = get_db_connection("accounts")
+        cursor = prepared_statements.cursor(connection)
+
+        active_accounts = report_active_accounts(cursor, hot_set=today_hot_set if today_hot_set.is_ready() else None)
 
         cursor.close()
         connection.close()
@@ -280,21 +1690,46 @@ def get_active_accounts(api_key: str = Depends(api_key_header)):
         return active_accounts
 
     except mysql.connector.Error as error:
-        print(f"Error connecting to MySQL database: {error}")
+        log_db_error(error)
         raise HTTPException(status_code=500, detail="Internal server error")
 
-@app.get("/probability")
-@sleep_and_retry
-@limits(calls=2, period=60) 
-def get_activity_probability(api_key: str = Depends(api_key_header), current: Optional[bool] = None, ):
-    if api_key != API_KEY:
-        raise HTTPException(status_code=400, detail="Invalid API key")
 
-    current = current or False
+def report_activity_forecast(now):
+    # Expected carts for the rest of the store's day, with a 95% band; `now` is UTC
+    current_date, _, day_end = store_day(now)
+    expected, lower, upper = calculate_activity_forecast(current_date)
+    hour_start = now.replace(minute=0, second=0, microsecond=0)
+    remaining_hours = [(hour_start + timedelta(hours=hours)).hour
+                       for hours in range(math.ceil((day_end - hour_start).total_seconds() / 3600))]
+    return {
+        "day": current_date.strftime("%A"),
+        "weeks": FORECAST_WEEKS,
+        "busy_hours": {
+            HOUR_LABELS[hour_of_day]: {
+                "expected": round(float(expected[hour_of_day]), 2),
+                "lower": round(float(lower[hour_of_day]), 2),
+                "upper": round(float(upper[hour_of_day]), 2)
+            }
+            for hour_of_day in remaining_hours
+        },
+        "expected_remaining": round(float(expected[remaining_hours].sum()), 2)
+    }
 
-    calculate_activity_probability()
 
-    current_date = datetime.now().date()
+QUERY_HOURLY_CARTS = """
+    SELECT COUNT(*) AS order_count, HOUR(updatedAt) AS hour_of_day
+    FROM ylift_api.carts
+    WHERE updatedAt >= %s AND updatedAt < %s
+    GROUP BY HOUR(updatedAt)
+"""
+
+
+def report_activity_probability(cursor, current=False, hot_set=None):
+    # Expects calculate_activity_probability() to have run
+    if not current:
+        return activity_data
+
+    current_date, day_start, day_end = store_day()
     current_day_of_week = current_date.strftime("%A")
 
     current_day_data = {
@@ -304,45 +1739,134 @@ def get_activity_probability(api_key: str = Depends(api_key_header), current: Op
         "actual_busy_hours": {hour: 0 for hour in activity_data[current_day_of_week]["busy_hours"]}
     }
 
-    try:
-        connection = get_db_connection()
-        cursor = connection.cursor()
+    if hot_set is not None:
+        rows = [(order_count, hour_of_day) for hour_of_day, order_count in hot_set.hourly_cart_counts().items()]
+    else:
+        cursor.execute(QUERY_HOURLY_CARTS, (day_start, day_end))
+        rows = cursor.fetchall()
 
-        query = """
-            SELECT COUNT(*) AS order_count, HOUR(updatedAt) AS hour_of_day
-            FROM ylift_api.carts
-            WHERE DATE(updatedAt) = %s
-            GROUP BY HOUR(updatedAt)
-        """
-        cursor.execute(query, (current_date,))
+    total_orders = 0
+    for row in rows:
+        order_count = row[0]
+        hour_of_day = row[1]
+        current_day_data["actual_busy_hours"][HOUR_LABELS[hour_of_day]] = order_count
+        total_orders += order_count
 
-        total_orders = 0
-        for row in cursor.fetchall():
-            order_count = row[0]
-            hour_of_day = row[1]
-            hour_label = f"{hour_of_day:02d}:00 - {hour_of_day+1:02d}:00"
-            current_day_data["actual_busy_hours"][hour_label] = order_count
-            total_orders += order_count
+    current_day_data["actual_probability"] = round(total_orders / 24, 4)
+
+    if current_day_of_week in activity_data:
+        current_day_data["expected_probability"] = activity_data[current_day_of_week]["probability"]
+
+    return current_day_data
+
+
+@app.get("/probability")
+@single_flight
+@sleep_and_retry
+@limits(calls=2, period=60) 
+def get_activity_probability(api_key: str = Depends(api_key_header), current: Optional[bool] = None, forecast: Optional[bool] = None):
+    if api_key != API_KEY:
+        raise HTTPException(status_code=400, detail="Invalid API key")
+
+    current = current or False
+    forecast = forecast or False
+
+    if forecast:
+        return report_activity_forecast(datetime.utcnow())
+
+    calculate_activity_probability()
+
+    if current and today_hot_set.is_ready():
+        return report_activity_probability(None, current=True, hot_set=today_hot_set)
+
+    try:
+        connection = get_db_connection("probability")
+        cursor = prepared_statements.cursor(connection)
+
+        probability_data = report_activity_probability(cursor, current=current)
 
         cursor.close()
         connection.close()
 
-        current_day_data["actual_probability"] = round(total_orders / 24, 4)
-
-        if current_day_of_week in activity_data:
-            current_day_data["expected_probability"] = activity_data[current_day_of_week]["probability"]
+        return probability_data
 
     except mysql.connector.Error as error:
-        print(f"Error connecting to MySQL database: {error}")
+        log_db_error(error)
         raise HTTPException(status_code=500, detail="Internal server error")
 
-    if current :
-        return current_day_data
 
-    return activity_data
+QUERY_ACTIVITY_LAST_ITEM = """
+    SELECT MAX(ci.updatedAt) AS last_active_item
+    FROM ylift_api.cartItems ci
+    JOIN ylift_api.carts c ON ci.cartId = c.id
+    WHERE ci.updatedAt >= %s AND ci.updatedAt < %s
+"""
+QUERY_ACTIVITY_ACTIVE_ORDERS = """
+    SELECT COUNT(DISTINCT c.id) AS active_orders
+    FROM ylift_api.carts c
+    LEFT JOIN ylift_api.cartItems ci ON c.id = ci.cartId
+    WHERE GREATEST(c.updatedAt, COALESCE(ci.updatedAt, '1970-01-01')) >= %s
+"""
+
+
+def query_store_activity(cursor, day_start, day_end, since):
+    # get the latest updatedAt from carts
+    cursor.execute(QUERY_CARTS_LATEST_UPDATE)
+    last_active_cart_utc = cursor.fetchone()[0]
+
+    # get the latest updatedAt from cartItems for the current date
+    cursor.execute(QUERY_ACTIVITY_LAST_ITEM, (day_start, day_end))
+    last_active_item_utc = cursor.fetchone()[0]
+
+    # count active orders since `since`
+    cursor.execute(QUERY_ACTIVITY_ACTIVE_ORDERS, (since,))
+    active_orders = cursor.fetchone()[0]
+
+    return last_active_cart_utc, last_active_item_utc, active_orders
+
+
+def report_store_activity(cursor, hot_set=None):
+    _, day_start, day_end = store_day()
+    one_hour_ago_utc = datetime.utcnow() - timedelta(hours=1)
+
+    if hot_set is not None:
+        last_active_cart_utc, last_active_item_utc, active_orders = hot_set.store_activity(one_hour_ago_utc)
+    else:
+        last_active_cart_utc, last_active_item_utc, active_orders = query_store_activity(cursor, day_start, day_end, one_hour_ago_utc)
+
+    # Determine the most recent activity
+    last_active_utc = max(last_active_cart_utc, last_active_item_utc) if last_active_item_utc else last_active_cart_utc
+
+    elapsed_idle = "00:00:00"
+    active_idle = "00:00:00"
+    is_active = False
+
+    if active_orders > 0:
+        active_idle = str(datetime.utcnow() - last_active_utc)
+        is_active = True
+    else:
+        elapsed_idle = str(datetime.utcnow() - last_active_utc)
+        # Check if the last activity was from cartItems and if it's been more than 20 mins
+        if last_active_utc == last_active_item_utc and (datetime.utcnow() - last_active_utc) > timedelta(minutes=20):
+            is_active = False
+        else:
+            is_active = (datetime.utcnow() - last_active_utc) <= timedelta(hours=1)
+
+    # Convert last_active from UTC to the store's timezone
+    last_active_local = utc.localize(last_active_utc).astimezone(timezone(STORE_TIMEZONE))
+
+    store_activity_data = {
+        "last_active": last_active_local.strftime("%Y-%m-%d %H:%M:%S"),
+        "elapsed_idle": elapsed_idle,
+        "active_idle": active_idle,
+        "is_active": is_active
+    }
+
+    return store_activity_data
 
 
 @app.get("/activity")
+@single_flight
 @sleep_and_retry
 @limits(calls=10, period=30)
 def get_store_activity():
@@ -350,183 +1874,694 @@ def get_store_activity():
     #     if api_key != API_KEY:
     #         raise HTTPException(status_code=400, detail="Invalid API key")
 
-    try:
-        connection = get_db_connection()
-        cursor = connection.cursor()
+    if today_hot_set.is_ready():
+        return report_store_activity(None, hot_set=today_hot_set)
 
-        current_date = datetime.utcnow().date()
-        one_hour_ago_utc = datetime.utcnow() - timedelta(hours=1)
+    try:
+        connection = get_db_connection("activity")
+        cursor = prepared_statements.cursor(connection)
 
-        using_carts_activity_date = False
-
-        # get the latest updatedAt from carts
-        query_carts = """
-            SELECT MAX(updatedAt) AS last_active_cart
-            FROM ylift_api.carts
-        """
-        cursor.execute(query_carts)
-        last_active_cart_utc = cursor.fetchone()[0]
-
-        # get the latest updatedAt from cartItems for the current date
-        query_cart_items = """
-            SELECT MAX(ci.updatedAt) AS last_active_item
-            FROM ylift_api.cartItems ci
-            JOIN ylift_api.carts c ON ci.cartId = c.id
-            WHERE DATE(ci.updatedAt) = %s
-        """
-        cursor.execute(query_cart_items, (current_date,))
-        last_active_item_utc = cursor.fetchone()[0]
-
-        # Determine the most recent activity
-        last_active_utc = max(last_active_cart_utc, last_active_item_utc) if last_active_item_utc else last_active_cart_utc
-
-        # count active orders in the last hour
-        query_active_orders = """
-            SELECT COUNT(DISTINCT c.id) AS active_orders
-            FROM ylift_api.carts c
-            LEFT JOIN ylift_api.cartItems ci ON c.id = ci.cartId
-            WHERE GREATEST(c.updatedAt, COALESCE(ci.updatedAt, '1970-01-01')) >= %s
-        """
-        cursor.execute(query_active_orders, (one_hour_ago_utc,))
-        active_orders = cursor.fetchone()[0]
+        store_activity_data = report_store_activity(cursor)
 
         cursor.close()
         connection.close()
 
-        elapsed_idle = "00:00:00"
-        active_idle = "00:00:00"
-        is_active = False
+        return store_activity_data
 
-        if active_orders > 0:
-            active_idle = str(datetime.utcnow() - last_active_utc)
-            is_active = True
+    except mysql.connector.Error as error:
+        log_db_error(error)
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+
+class AuthorizeNetError(Exception):
+    pass
+
+
+class AuthorizeNetClient:
+    """
+    Async client for the Authorize.Net JSON API.
+
+    Requests go through a shared httpx client, so connections to the gateway
+    are kept alive and reused, and at most `max_concurrency` requests are in
+    flight at once. httpx clients belong to the event loop they were created
+    on, so there is one per loop.
+    """
+
+    def __init__(self, endpoint, api_id, transaction_key, max_concurrency, timeout):
+        self.endpoint = endpoint
+        self.api_id = api_id
+        self.transaction_key = transaction_key
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self._clients = weakref.WeakKeyDictionary()
+
+    def _client(self):
+        loop = asyncio.get_running_loop()
+        if loop not in self._clients:
+            limits = httpx.Limits(max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency)
+            self._clients[loop] = (httpx.AsyncClient(timeout=self.timeout, limits=limits), asyncio.Semaphore(self.max_concurrency))
+        return self._clients[loop]
+
+    async def request(self, request_name, body):
+        # Field order matters to the gateway, it must follow the XML schema
+        payload = {request_name: {"merchantAuthentication": {"name": self.api_id, "transactionKey": self.transaction_key}, **body}}
+
+        breaker = get_circuit_breaker("authorizenet")
+        breaker.before_call()
+
+        try:
+            client, semaphore = self._client()
+            async with semaphore:
+                response = await client.post(self.endpoint, content=json.dumps(payload), headers={"Content-Type": "application/json"})
+                response.raise_for_status()
+        except httpx.HTTPError:
+            breaker.record_failure()
+            raise
+        except BaseException:
+            breaker.cancel_call()
+            raise
+        breaker.record_success()
+
+        # Responses start with a byte order mark
+        result = json.loads(response.content.decode("utf-8-sig"))
+        if result["messages"]["resultCode"] != "Ok":
+            messages = result["messages"].get("message", [])
+            raise AuthorizeNetError("; ".join(f"{message['code']}: {message['text']}" for message in messages))
+
+        return result
+
+    async def get_customer_transactions(self, customer_id, limit=1000, offset=1):
+        """Returns one page of the customer's transactions, newest first, and the total count."""
+        result = await self.request("getTransactionListForCustomerRequest", {
+            "customerProfileId": customer_id,
+            "sorting": {"orderBy": "submitTimeUTC", "orderDescending": True},
+            "paging": {"limit": limit, "offset": offset}
+        })
+        return result.get("transactions", []), result.get("totalNumInResultSet", 0)
+
+    async def get_customer_transactions_since(self, customer_id, since, page_size=1000):
+        """Returns the customer's transactions submitted at or after `since` (UTC)."""
+        transactions = []
+        offset = 1
+        while True:
+            page, total = await self.get_customer_transactions(customer_id, limit=page_size, offset=offset)
+            for transaction in page:
+                if parse_submit_time(transaction["submitTimeUTC"]) < since:
+                    return transactions
+                transactions.append(transaction)
+
+            if len(page) < page_size or offset * page_size >= total:
+                return transactions
+            offset += 1
+
+    async def aclose(self):
+        for client, _ in list(self._clients.values()):
+            await client.aclose()
+        self._clients.clear()
+
+
+def parse_submit_time(submit_time):
+    # e.g. 2024-07-03T12:00:00Z or 2024-07-03T12:00:00.123Z
+    return datetime.strptime(submit_time.rstrip("Z").split(".")[0], "%Y-%m-%dT%H:%M:%S")
+
+
+authorizenet_client = AuthorizeNetClient(AUTHORIZENET_ENDPOINT, API_ID, TRANSACTION_KEY, AUTHORIZENET_MAX_CONCURRENCY, AUTHORIZENET_TIMEOUT)
+
+
+class TransactionLedger:
+    """
+    Local copy of customers' Authorize.Net transactions, kept in SQLite.
+
+    Transactions are stored by transId and indexed by customer and
+    submitTimeUTC. Each customer records when it was last synced and the
+    newest submit time seen, so a sync only asks the gateway for what came
+    after that, less `overlap` seconds so status changes on recent
+    transactions (e.g. settlement) are picked up. Customers are registered
+    when /transactions asks about them and stop being synced once nobody
+    has asked for `active_days`.
+    """
+
+    # Seconds between updates of a customer's requested_at
+    REQUEST_REFRESH = 3600
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS transactions (
+            trans_id TEXT PRIMARY KEY,
+            customer_id TEXT NOT NULL,
+            submit_time TEXT NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS transactions_customer_time ON transactions (customer_id, submit_time);
+        CREATE TABLE IF NOT EXISTS customers (
+            customer_id TEXT PRIMARY KEY,
+            requested_at REAL NOT NULL,
+            synced_at REAL,
+            synced_through TEXT
+        );
+    """
+
+    def __init__(self, path, overlap, active_days):
+        self.path = path
+        self.overlap = overlap
+        self.active_days = active_days
+        self._initialized = False
+        self._lock = threading.Lock()
+        self.stats = {"ledgerHits": 0, "gatewayFallbacks": 0, "customersSynced": 0, "syncErrors": 0}
+
+    @contextmanager
+    def _connect(self):
+        if not self._initialized:
+            with self._lock:
+                if not self._initialized:
+                    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                    connection = sqlite3.connect(self.path, timeout=30)
+                    try:
+                        # WAL lets every worker read while the leader syncs
+                        connection.execute("PRAGMA journal_mode=WAL")
+                        connection.executescript(self._SCHEMA)
+                    finally:
+                        connection.close()
+                    self._initialized = True
+
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def register(self, customer_id):
+        """Marks the customer as requested and returns when it was last synced (or None)."""
+        now = time.time()
+        with self._connect() as connection:
+            row = connection.execute("SELECT requested_at, synced_at FROM customers WHERE customer_id = ?", (customer_id,)).fetchone()
+            # requested_at only has to be right to the day, so most requests only read
+            # and don't queue up behind the other workers for SQLite's write lock
+            if row is None or now - row[0] >= self.REQUEST_REFRESH:
+                connection.execute("""
+                    INSERT INTO customers (customer_id, requested_at) VALUES (?, ?)
+                    ON CONFLICT (customer_id) DO UPDATE SET requested_at = excluded.requested_at
+                """, (customer_id, now))
+        return row[1] if row is not None else None
+
+    def transactions(self, customer_id, start, end=None):
+        """Returns the customer's transactions submitted in [start, end) (UTC), newest first."""
+        query = "SELECT data FROM transactions WHERE customer_id = ? AND submit_time >= ?"
+        params = [customer_id, start.isoformat()]
+        if end is not None:
+            query += " AND submit_time < ?"
+            params.append(end.isoformat())
+        query += " ORDER BY submit_time DESC"
+
+        with self._connect() as connection:
+            return [json.loads(row[0]) for row in connection.execute(query, params)]
+
+    def customers_to_sync(self, interval):
+        now = time.time()
+        with self._connect() as connection:
+            return [row[0] for row in connection.execute("""
+                SELECT customer_id FROM customers
+                WHERE requested_at >= ? AND (synced_at IS NULL OR synced_at <= ?)
+            """, (now - self.active_days * 86400, now - interval))]
+
+    def store(self, customer_id, transactions, synced_at):
+        rows = [(transaction["transId"], customer_id, parse_submit_time(transaction["submitTimeUTC"]).isoformat(), json.dumps(transaction))
+                for transaction in transactions]
+
+        with self._connect() as connection:
+            connection.executemany("INSERT OR REPLACE INTO transactions (trans_id, customer_id, submit_time, data) VALUES (?, ?, ?, ?)", rows)
+            newest = max((row[2] for row in rows), default=None)
+            connection.execute("""
+                INSERT INTO customers (customer_id, requested_at, synced_at, synced_through) VALUES (?, ?, ?, ?)
+                ON CONFLICT (customer_id) DO UPDATE SET
+                    synced_at = excluded.synced_at,
+                    synced_through = MAX(COALESCE(synced_through, excluded.synced_through), COALESCE(excluded.synced_through, synced_through))
+            """, (customer_id, synced_at, synced_at, newest))
+
+    def synced_through(self, customer_id):
+        """Returns the newest submit time synced for the customer (or None)."""
+        with self._connect() as connection:
+            row = connection.execute("SELECT synced_through FROM customers WHERE customer_id = ?", (customer_id,)).fetchone()
+        return datetime.fromisoformat(row[0]) if row and row[0] else None
+
+    async def sync_customer(self, client, customer_id):
+        # SQLite calls block, so they run off the event loop
+        synced_through = await run_in_threadpool(self.synced_through, customer_id)
+        since = synced_through - timedelta(seconds=self.overlap) if synced_through else datetime.min
+
+        started = time.time()
+        transactions = await client.get_customer_transactions_since(customer_id, since)
+        await run_in_threadpool(self.store, customer_id, transactions, started)
+        self.count("customersSynced")
+        return started
+
+    async def sync(self, client, interval):
+        """Syncs every active customer not synced within the last `interval` seconds."""
+        customer_ids = await run_in_threadpool(self.customers_to_sync, interval)
+        results = await asyncio.gather(*(self.sync_customer(client, customer_id) for customer_id in customer_ids), return_exceptions=True)
+
+        for customer_id, result in zip(customer_ids, results):
+            if isinstance(result, Exception):
+                self.count("syncErrors")
+                print(f"Error syncing transactions for customer {customer_id}: {result}")
+
+
+transaction_ledger = TransactionLedger(os.path.join(STATE_DIR, "transactions.sqlite3"), TRANSACTION_SYNC_OVERLAP, TRANSACTION_LEDGER_ACTIVE_DAYS)
+
+# The scheduler thread runs each sync on its own event loop, so it gets its own client
+ledger_client = AuthorizeNetClient(AUTHORIZENET_ENDPOINT, API_ID, TRANSACTION_KEY, AUTHORIZENET_MAX_CONCURRENCY, AUTHORIZENET_TIMEOUT)
+
+
+def sync_transaction_ledger():
+    async def sync():
+        try:
+            await transaction_ledger.sync(ledger_client, TRANSACTION_SYNC_INTERVAL)
+        finally:
+            await ledger_client.aclose()
+
+    asyncio.run(sync())
+
+
+def format_synced_at(synced_at):
+    return datetime.utcfromtimestamp(synced_at).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+@contextmanager
+def gateway_errors():
+    try:
+        yield
+    except AuthorizeNetError as error:
+        print(f"Error fetching transactions from Authorize.Net: {error}")
+        raise HTTPException(status_code=500, detail="Error fetching transactions")
+    except httpx.TimeoutException:
+        raise HTTPException(status_code=504, detail="Timed out fetching transactions")
+
+
+@app.get("/transactions/{customer_id}")
+async def get_transactions_today(customer_id: str, response: Response = None):
+    try:
+        today = datetime.combine(datetime.utcnow().date(), datetime.min.time())
+
+        try:
+            synced_at = await run_in_threadpool(transaction_ledger.register, customer_id)
+        except sqlite3.Error as error:
+            print(f"Error reading the transaction ledger: {error}")
+            synced_at = None
+
+        # Served from the ledger while its copy of this customer is fresh enough
+        if synced_at is not None and time.time() - synced_at <= TRANSACTION_LEDGER_MAX_AGE:
+            transactions = await run_in_threadpool(transaction_ledger.transactions, customer_id, today)
+            transaction_ledger.count("ledgerHits")
+            source = "ledger"
         else:
-            elapsed_idle = str(datetime.utcnow() - last_active_utc)
-            # Check if the last activity was from cartItems and if it's been more than 20 mins
-            if last_active_utc == last_active_item_utc and (datetime.utcnow() - last_active_utc) > timedelta(minutes=20):
-                is_active = False
-            else:
-                is_active = (datetime.utcnow() - last_active_utc) <= timedelta(hours=1)
+            with gateway_errors():
+                transactions = await authorizenet_client.get_customer_transactions_since(customer_id, today)
+            transaction_ledger.count("gatewayFallbacks")
+            source, synced_at = "gateway", time.time()
+
+        if response is not None:
+            response.headers["X-Transactions-Source"] = source
+            response.headers["X-Transactions-Synced-At"] = format_synced_at(synced_at)
+        return transactions
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"{e}")
 
-        # Convert last_active from UTC to New York timezone
-        ny_tz = timezone('America/New_York')
-        last_active_ny = utc.localize(last_active_utc).astimezone(ny_tz)
 
-        store_activity_data = {
-            "last_active": last_active_ny.strftime("%Y-%m-%d %H:%M:%S"),
-            "elapsed_idle": elapsed_idle,
-            "active_idle": active_idle,
-            "is_active": is_active
+@app.get("/transactions/{customer_id}/range")
+async def get_transactions_range(customer_id: str, start: date, end: Optional[date] = None):
+    try:
+        end = end or datetime.utcnow().date()
+        if end < start:
+            raise HTTPException(status_code=400, detail="end must not be before start")
+
+        synced_at = await run_in_threadpool(transaction_ledger.register, customer_id)
+        if synced_at is None:
+            # First request for this customer: pull its history now rather than wait for the sync
+            with gateway_errors():
+                synced_at = await transaction_ledger.sync_customer(authorizenet_client, customer_id)
+
+        transactions = await run_in_threadpool(
+            transaction_ledger.transactions,
+            customer_id,
+            datetime.combine(start, datetime.min.time()),
+            datetime.combine(end + timedelta(days=1), datetime.min.time())
+        )
+
+        return {
+            "customerId": customer_id,
+            "syncedAt": format_synced_at(synced_at),
+            "stale": time.time() - synced_at > TRANSACTION_LEDGER_MAX_AGE,
+            "transactions": transactions
         }
 
-        return store_activity_data
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"{e}")
 
-    except mysql.connector.Error as error:
-        print(f"Error connecting to MySQL database: {error}")
-        raise HTTPException(status_code=500, detail="Internal server error")
 
+# Exportable tables and the column their date range applies to
+EXPORT_TABLES = {
+    "carts": "updatedAt",
+    "cartItems": "updatedAt",
+    "orders": "createdAt"
+}
 
-def parse_xml(xml_string: str):
-    # Get the content of xml
-    #     - Remove the first line:     `<getTransactionListForCustomerRequest xmlns="AnetApi/xml/v1/schema/AnetApiSchema.xsd">`
-    #     - Remove the last two lines: `</getTransactionListForCustomerRequest>` and ``
-    lines = [line.strip() for line in xml_string.split("\n")][1:-2]
+EXPORT_FORMATS = {
+    "arrow": ("application/vnd.apache.arrow.stream", "arrows"),
+    "parquet": ("application/vnd.apache.parquet", "parquet")
+}
 
-    def get_key_from_line(index: int):
-        line = lines[index]
-        return line[line.find("<")+1:line.find(">")]
 
-    def get_value_from_line(index: int):
-        line = lines[index]
-        return line[line.find(">")+1:line.find("</")]
+def arrow_type(field_type, flags):
+    if field_type in (FieldType.TINY, FieldType.SHORT, FieldType.LONG, FieldType.INT24, FieldType.LONGLONG, FieldType.YEAR, FieldType.BIT):
+        return pa.int64()
+    if field_type in (FieldType.FLOAT, FieldType.DOUBLE):
+        return pa.float64()
+    if field_type in (FieldType.DATE, FieldType.NEWDATE):
+        return pa.date32()
+    if field_type in (FieldType.DATETIME, FieldType.TIMESTAMP):
+        return pa.timestamp("us")
+    if field_type == FieldType.TIME:
+        return pa.duration("us")
+    if flags & FieldFlag.BINARY and field_type in (FieldType.VAR_STRING, FieldType.STRING, FieldType.BLOB, FieldType.TINY_BLOB, FieldType.MEDIUM_BLOB, FieldType.LONG_BLOB):
+        return pa.binary()
+    # Decimals are kept as text so no precision is lost
+    return pa.string()
 
-    def xml_to_dict(start: int, end: int):
-        dict_result = {}
-        index = start
 
-        while index < end:
-            key = get_key_from_line(index)
-            _key = f'</{key}>'
+def arrow_schema(description):
+    return pa.schema([pa.field(column[0], arrow_type(column[1], column[7] or 0)) for column in description])
 
-            if lines[index].find(_key) != -1:
-                value = get_value_from_line(index)
-                index += 1
-            else:
-                next_index = index + 1
-                while next_index < end and lines[next_index] != _key:
-                    next_index += 1
 
-                if next_index >= end:
-                    raise ValueError("Malformed XML")
+def rows_to_record_batch(rows, schema):
+    columns = list(zip(*rows)) if rows else [()] * len(schema)
+    arrays = []
+    for field, values in zip(schema, columns):
+        if field.type == pa.string():
+            values = [None if value is None else str(value) for value in values]
+        arrays.append(pa.array(values, type=field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
 
-                value = xml_to_dict(index + 1, next_index)
-                index = next_index + 1
 
-            if key in dict_result:
-                if isinstance(dict_result[key], list):
-                    dict_result[key].append(value)
-                else:
-                    dict_result[key] = [dict_result[key], value]
-            else:
-                dict_result[key] = value
+class StreamSink:
+    """Write-only file object that hands out what was written since the last drain()."""
 
-        return dict_result
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+        self.closed = False
 
-    return xml_to_dict(0, len(lines))
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
 
+    def tell(self):
+        return self._position
 
-@app.get("/transactions/{customer_id}")
-def get_transactions_today(customer_id: str):
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def writable(self):
+        return True
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_export(connection, cursor, export_format):
+    """
+    Yields the result set of an executed query as an Arrow IPC stream or a
+    Parquet file, one record batch (row group) of EXPORT_BATCH_SIZE rows at
+    a time, so memory use doesn't grow with the number of rows.
+    """
     try:
-        merchant_auth = apicontractsv1.merchantAuthenticationType()
-        merchant_auth.name = API_ID
-        merchant_auth.transactionKey = TRANSACTION_KEY
+        schema = arrow_schema(cursor.description)
+
+        sink = StreamSink()
+        if export_format == "parquet":
+            writer = pq.ParquetWriter(sink, schema)
+        else:
+            writer = pa.ipc.new_stream(sink, schema)
+
+        while True:
+            rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+            if not rows:
+                break
+            writer.write_batch(rows_to_record_batch(rows, schema))
+            yield sink.drain()
+
+        writer.close()
+        yield sink.drain()
 
-        request = apicontractsv1.getTransactionListForCustomerRequest()
-        request.merchantAuthentication = merchant_auth
-        request.customerProfileId = customer_id
+    except mysql.connector.Error as error:
+        # The response has already started, all we can do is cut it short
+        log_db_error(error)
+        raise
+
+    finally:
+        try:
+            # Rows left behind when the client went away, read off so the pool can reset the session
+            discard_unread_result(connection)
+            cursor.close()
+        except mysql.connector.Error:
+            pass  # the connection is gone, the pool reconnects it
+        connection.close()
 
-        controller = getTransactionListForCustomerController(request)
-        controller.execute()
 
-        response = controller.getresponse()
+@app.get("/export/{table}")
+@sleep_and_retry
+@limits(calls=10, period=60)
+def export_table(table: str, api_key: str = Depends(api_key_header), start: Optional[date] = None, end: Optional[date] = None, format: str = "arrow"):
+    if api_key != API_KEY:
+        raise HTTPException(status_code=400, detail="Invalid API key")
 
-        if response is None or response.messages.resultCode != "Ok":
-            raise HTTPException(status_code=500, detail="Error fetching transactions")
+    if pa is None:
+        raise HTTPException(status_code=501, detail="Exports need pyarrow installed")
 
-        xml_string = etree.tostring(response, pretty_print=True)
-        parsed_xml = parse_xml(xml_string.decode())
+    if table not in EXPORT_TABLES:
+        raise HTTPException(status_code=404, detail=f"Unknown table, expected one of: {', '.join(EXPORT_TABLES)}")
 
-        # Filter transactions for today
-        today = datetime.utcnow().date()
-        today_transactions = [
-            transaction for transaction in parsed_xml["transactions"]["transaction"]
-            if datetime.strptime(transaction["submitTimeUTC"], "%Y-%m-%dT%H:%M:%S.%fZ").date() == today
-        ]
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown format, expected one of: {', '.join(EXPORT_FORMATS)}")
 
-        return today_transactions
+    end = end or datetime.now().date()
+    start = start or end
+    if start > end:
+        raise HTTPException(status_code=400, detail="start must not be after end")
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"{e}")
+    try:
+        connection = get_db_connection("export")
+        # Unbuffered, rows are fetched from the server as the stream is written
+        cursor = connection.cursor()
+
+        query = f"""
+            SELECT *
+            FROM ylift_api.{table}
+            WHERE {EXPORT_TABLES[table]} >= %s AND {EXPORT_TABLES[table]} < %s
+        """
+        cursor.execute(query, (start, end + timedelta(days=1)))
+
+    except mysql.connector.Error as error:
+        log_db_error(error)
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+    media_type, extension = EXPORT_FORMATS[format]
+    filename = f"{table}_{start}_{end}.{extension}"
+
+    return StreamingResponse(
+        stream_export(connection, cursor, format),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
 
 
 @app.get("/backup")
 @sleep_and_retry
 @limits(calls=2, period=3600)
 def backup_database():
-    global last_backup_time
-
     current_time = datetime.now()
 
-    if last_backup_time is None or (current_time - last_backup_time) >= timedelta(hours=2):
-        perform_backup_sync()
+    # The two hour guard is shared by every worker on the host
+    if shared_state.claim_backup(current_time, timedelta(hours=2)):
+        try:
+            perform_claimed_backup(current_time)
+        except Exception:
+            raise HTTPException(status_code=500, detail="Backup failed")
         return {"message": "Backup process started"}
     else:
         return {"message": "Backup skipped. Already performed within the last 2 hours."}
 
 
 
+class SalesRollup:
+    """
+    Completed sales per day, kept in a JSON file in STATE_DIR for all workers.
+
+    The leader's scheduled job sums completed orders by day from January 1st
+    of last year through yesterday, re-summing the last `recheck_days` days
+    on every run to pick up late completions and refunds. /sales adds up the
+    rolled-up days and only sums today's orders in MySQL.
+    """
+
+    def __init__(self, path, recheck_days):
+        self.path = path
+        self.recheck_days = recheck_days
+        self._loaded = (None, None)  # (file mtime, data)
+        self._lock = threading.Lock()
+
+    def load(self):
+        try:
+            mtime = os.path.getmtime(self.path)
+        except FileNotFoundError:
+            return None
+
+        with self._lock:
+            if self._loaded[0] != mtime:
+                with open(self.path) as f:
+                    self._loaded = (mtime, json.load(f))
+            return self._loaded[1]
+
+    def refresh(self, cursor, today):
+        data = self.load()
+        since = date(today.year - 1, 1, 1)
+        through = today - timedelta(days=1)
+
+        if data is not None and data["since"] == since.isoformat():
+            start = max(date.fromisoformat(data["through"]) - timedelta(days=self.recheck_days - 1), since)
+            days = {day: pennies for day, pennies in data["days"].items() if day < start.isoformat()}
+        else:
+            start = since
+            days = {}
+
+        query = """
+            SELECT DATE(completedAt) AS day, COALESCE(SUM(amount), 0) AS total_sales
+            FROM ylift_api.orders
+            WHERE status = 'COMPLETED'
+                AND DATE(completedAt) BETWEEN %s AND %s
+            GROUP BY day
+        """
+        cursor.execute(query, (start, through))
+        for day, pennies in cursor.fetchall():
+            days[day.isoformat()] = int(pennies)
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix=".tmp-")
+        with os.fdopen(fd, "w") as f:
+            json.dump({"since": since.isoformat(), "through": through.isoformat(), "days": days}, f)
+        os.replace(temp_path, self.path)
+
+        return {"since": since.isoformat(), "through": through.isoformat(), "recomputedFrom": start.isoformat()}
+
+    def total(self, start_date, end_date):
+        """Sales in pennies from start_date to end_date, or None when the rollup doesn't cover those days."""
+        if start_date > end_date:
+            return 0
+
+        data = self.load()
+        if data is None or start_date < date.fromisoformat(data["since"]) or end_date > date.fromisoformat(data["through"]):
+            return None
+
+        days = data["days"]
+        return sum(days.get((start_date + timedelta(days=offset)).isoformat(), 0) for offset in range((end_date - start_date).days + 1))
+
+
+sales_rollup = SalesRollup(os.path.join(STATE_DIR, "sales_rollup.json"), SALES_ROLLUP_RECHECK_DAYS)
+
+
+def refresh_sales_rollup():
+    connection = get_db_connection("sales")
+    try:
+        cursor = connection.cursor()
+        result = sales_rollup.refresh(cursor, datetime.now().date())
+        cursor.close()
+    finally:
+        connection.close()
+    print(f"\tSales rollup recomputed from {result['recomputedFrom']} through {result['through']}")
+
+
+QUERY_SALES_TOTAL = """
+    SELECT COALESCE(SUM(amount), 0) AS total_sales
+    FROM ylift_api.orders
+    WHERE status = 'COMPLETED'
+        AND DATE(completedAt) BETWEEN %s AND %s
+"""
+
+
+def report_sales(cursor, prior=False, month=False, lastmonth=False, quarter=False, priorquarter=False, year=False, prioryear=False, rollup=None):
+    current_date = datetime.now().date()
+    start_date = None
+    end_date = None
+
+    if prior:
+        end_date = current_date - timedelta(days=current_date.weekday() + 1)
+        start_date = end_date - timedelta(days=6)
+    elif month:
+        start_date = current_date.replace(day=1)
+        end_date = current_date
+    elif lastmonth:
+        last_month = current_date.replace(day=1) - timedelta(days=1)
+        start_date = last_month.replace(day=1)
+        end_date = last_month
+    elif quarter:
+        current_quarter = (current_date.month - 1) // 3 + 1
+        start_month = (current_quarter - 1) * 3 + 1
+        end_month = start_month + 2
+        start_date = current_date.replace(month=start_month, day=1)
+        end_date = current_date.replace(month=end_month, day=calendar.monthrange(current_date.year, end_month)[1])
+    elif priorquarter:
+        current_quarter = (current_date.month - 1) // 3 + 1
+        prior_year = current_date.year - 1
+        start_month = (current_quarter - 1) * 3 + 1
+        end_month = start_month + 2
+        start_date = current_date.replace(year=prior_year, month=start_month, day=1)
+        end_date = current_date.replace(year=prior_year, month=end_month, day=calendar.monthrange(prior_year, end_month)[1])
+    elif year:
+        start_date = current_date.replace(month=1, day=1)
+        end_date = current_date.replace(month=12, day=31)
+    elif prioryear:
+        prior_year = current_date.year - 1
+        start_date = current_date.replace(year=prior_year, month=1, day=1)
+        end_date = current_date.replace(year=prior_year, month=12, day=31)
+    else:
+        start_date = current_date - timedelta(days=current_date.weekday())
+        end_date = start_date + timedelta(days=6)
+
+    # Days before today come from the rollup when it has them, so only today is summed here
+    total_sales_pennies = rollup.total(start_date, min(end_date, current_date - timedelta(days=1))) if rollup is not None else None
+    if total_sales_pennies is None:
+        cursor.execute(QUERY_SALES_TOTAL, (start_date, end_date))
+        total_sales_pennies = cursor.fetchone()[0]
+    elif end_date >= current_date:
+        cursor.execute(QUERY_SALES_TOTAL, (max(start_date, current_date), end_date))
+        total_sales_pennies += cursor.fetchone()[0]
+
+    total_sales_dollars = total_sales_pennies / 100
+
+    sales_data = {
+        "startDate": start_date.strftime("%Y-%m-%d"),
+        "endDate": end_date.strftime("%Y-%m-%d"),
+        "totalSales": "${:,.2f}".format(total_sales_dollars)
+    }
+
+    return sales_data
+
+
 @app.get("/sales")
+@single_flight
 @sleep_and_retry
 @limits(calls=2, period=60)  # Rate limit: 2 requests per minute
 def get_sales( prior: Optional[bool] = None, month: Optional[bool] = None, lastmonth: Optional[bool] = None, quarter: Optional[bool] = None, priorquarter: Optional[bool] = None, year: Optional[bool] = None, prioryear: Optional[bool] = None):
@@ -544,136 +2579,515 @@ def get_sales( prior: Optional[bool] = None, month: Optional[bool] = None, lastm
     prioryear = prioryear or False
 
     try:
-        connection = get_db_connection()
-        cursor = connection.cursor()
+        connection = get_db_connection("sales")
+        cursor = prepared_statements.cursor(connection)
 
-        current_date = datetime.now().date()
-        start_date = None
-        end_date = None
-
-        if prior:
-            end_date = current_date - timedelta(days=current_date.weekday() + 1)
-            start_date = end_date - timedelta(days=6)
-        elif month:
-            start_date = current_date.replace(day=1)
-            end_date = current_date
-        elif lastmonth:
-            last_month = current_date.replace(day=1) - timedelta(days=1)
-            start_date = last_month.replace(day=1)
-            end_date = last_month
-        elif quarter:
-            current_quarter = (current_date.month - 1) // 3 + 1
-            start_month = (current_quarter - 1) * 3 + 1
-            end_month = start_month + 2
-            start_date = current_date.replace(month=start_month, day=1)
-            end_date = current_date.replace(month=end_month, day=calendar.monthrange(current_date.year, end_month)[1])
-        elif priorquarter:
-            current_quarter = (current_date.month - 1) // 3 + 1
-            prior_year = current_date.year - 1
-            start_month = (current_quarter - 1) * 3 + 1
-            end_month = start_month + 2
-            start_date = current_date.replace(year=prior_year, month=start_month, day=1)
-            end_date = current_date.replace(year=prior_year, month=end_month, day=calendar.monthrange(prior_year, end_month)[1])
-        elif year:
-            start_date = current_date.replace(month=1, day=1)
-            end_date = current_date.replace(month=12, day=31)
-        elif prioryear:
-            prior_year = current_date.year - 1
-            start_date = current_date.replace(year=prior_year, month=1, day=1)
-            end_date = current_date.replace(year=prior_year, month=12, day=31)
-        else:
-            start_date = current_date - timedelta(days=current_date.weekday())
-            end_date = start_date + timedelta(days=6)
+        sales_data = report_sales(cursor, prior=prior, month=month, lastmonth=lastmonth, quarter=quarter, priorquarter=priorquarter, year=year, prioryear=prioryear, rollup=sales_rollup)
 
+        cursor.close()
+        connection.close()
 
-        query = """
-            SELECT COALESCE(SUM(amount), 0) AS total_sales
-            FROM ylift_api.orders
-            WHERE status = 'COMPLETED'
-                AND DATE(completedAt) BETWEEN %s AND %s
-        """
-        cursor.execute(query, (start_date, end_date))
+        return sales_data
 
-        total_sales_pennies = cursor.fetchone()[0]
-        total_sales_dollars = total_sales_pennies / 100
+    except mysql.connector.Error as error:
+        log_db_error(error)
+        raise HTTPException(status_code=500, detail="Internal server error")
 
-        cursor.close()
-        connection.close()
 
-        sales_data = {
-            "startDate": start_date.strftime("%Y-%m-%d"),
-            "endDate": end_date.strftime("%Y-%m-%d"),
-            "totalSales": "${:,.2f}".format(total_sales_dollars)
-        }
+class BatchReport(BaseModel):
+    name: str
+    params: Dict[str, Any] = {}
 
-        return sales_data
+
+class BatchRequest(BaseModel):
+    reports: List[BatchReport]
+
+
+def prepare_activity_probability(current=False, forecast=False):
+    if forecast:
+        calculate_activity_forecast(store_day()[0])
+    else:
+        calculate_activity_probability()
+
+
+def batch_activity_probability(cursor, current=False, forecast=False):
+    if forecast:
+        return report_activity_forecast(datetime.utcnow())
+    return report_activity_probability(cursor, current=current)
+
+
+# name -> (prepare, run, params). prepare(**params) does the work that doesn't
+# read through the snapshot (the daily histogram, the forecast) and runs
+# concurrently with the other reports; run(cursor, **params) reads through
+# the snapshot connection, one report at a time. `params` are the only
+# parameters clients may pass; the report functions' other keyword
+# arguments (hot_set, rollup) are internal.
+BATCH_REPORTS = {
+    "carts": (None, report_active_carts, ()),
+    "accounts": (None, report_active_accounts, ()),
+    "activity": (None, report_store_activity, ()),
+    "sales": (None, report_sales, ("prior", "month", "lastmonth", "quarter", "priorquarter", "year", "prioryear")),
+    "probability": (prepare_activity_probability, batch_activity_probability, ("current", "forecast"))
+}
+
+batch_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="batch")
+
+
+@app.post("/batch")
+@sleep_and_retry
+@limits(calls=2, period=60)
+def run_batch(batch: BatchRequest, api_key: str = Depends(api_key_header)):
+    if api_key != API_KEY:
+        raise HTTPException(status_code=400, detail="Invalid API key")
+
+    for report in batch.reports:
+        if report.name not in BATCH_REPORTS:
+            raise HTTPException(status_code=400, detail=f"Unknown report {report.name}, expected one of: {', '.join(BATCH_REPORTS)}")
+        unknown = set(report.params) - set(BATCH_REPORTS[report.name][2])
+        if unknown:
+            allowed = ', '.join(BATCH_REPORTS[report.name][2]) or 'none'
+            raise HTTPException(status_code=400, detail=f"Invalid params for {report.name}: {', '.join(sorted(unknown))} (allowed: {allowed})")
+
+    preparations = []
+    for report in batch.reports:
+        prepare = BATCH_REPORTS[report.name][0]
+        preparations.append(batch_executor.submit(prepare, **report.params) if prepare else None)
+
+    try:
+        connection = get_db_connection("batch")
+        # The snapshot is ended and the connection handed back whatever a report raises
+        try:
+            # Every report sees the database as of the same moment
+            connection.start_transaction(consistent_snapshot=True, isolation_level="REPEATABLE READ", readonly=True)
+            snapshot_at = datetime.utcnow()
+            cursor = connection.cursor(buffered=True)
+            try:
+                results = []
+                for report, preparation in zip(batch.reports, preparations):
+                    try:
+                        if preparation is not None:
+                            preparation.result()
+                        results.append({"name": report.name, "result": BATCH_REPORTS[report.name][1](cursor, **report.params)})
+                    except mysql.connector.Error as error:
+                        log_db_error(error)
+                        results.append({"name": report.name, "error": {"status": 500, "detail": "Internal server error"}})
+                    except HTTPException as error:
+                        results.append({"name": report.name, "error": {"status": error.status_code, "detail": error.detail}})
+            finally:
+                cursor.close()
+        finally:
+            try:
+                connection.rollback()
+            finally:
+                connection.close()
 
     except mysql.connector.Error as error:
-        print(f"Error connecting to MySQL database: {error}")
+        log_db_error(error)
         raise HTTPException(status_code=500, detail="Internal server error")
 
+    return {
+        "snapshotAt": snapshot_at.strftime("%Y-%m-%d %H:%M:%S"),
+        "reports": results
+    }
 
 
-def perform_backup_sync():
-    global last_backup_time
 
+# Deduplicated snapshots instead of a directory of dumps per run, when configured
+backup_store = ChunkStore(BACKUP_STORE) if BACKUP_STORE else None
+
+
+class BackupError(Exception):
+    pass
+
+
+def perform_backup_sync():
     current_dir = os.getcwd()
     os.chdir(BACK_UP_LOC)
+    try:
+        # Get the current date and format it as "Monday"
+        now = datetime.now()
+        date_str = now.strftime('%b%d_%-I%p')
+
+        # Get the current year
+        year = now.strftime('%Y')
+
+        # Create the output directory with the year if it doesn't exist
+        output_dir = f'{year}/{date_str}/'
+        snapshot_name = f'{year}/{date_str}'
+        if backup_store is not None:
+            exists = backup_store.has_snapshot(snapshot_name)
+        else:
+            exists = os.path.exists(output_dir)
+
+        if not exists:
+            if backup_store is None:
+                os.makedirs(output_dir)
+                print(f'\tBackup directory created: {output_dir}')
+
+            # Get a list of all tables in the database, from a replica when one is routed
+            connection, db_config = db_router.connect("backup")
+            cursor = None
+            try:
+                cursor = connection.cursor()
+                cursor.execute('SHOW TABLES')
+                tables = [row[0] for row in cursor.fetchall()]
+
+                # Create a login path file with the username and password
+                with open('mysql_login.cnf', 'w') as f:
+                    f.write(f'[client]\nuser={db_config["user"]}\npassword={db_config["password"]}\n')
+                try:
+                    # Written alongside the dumps, restore.py uses it to verify row counts
+                    manifest = {"createdAt": now.strftime("%Y-%m-%d %H:%M:%S"), "database": db_config["database"], "tables": {}}
+
+                    # Loop through each table and perform a mysqldump
+                    with backup_store.lock() if backup_store is not None else nullcontext():
+                        for table in tables:
+                            # Counted just before the dump, so tables written to meanwhile may differ slightly
+                            cursor.execute(f'SELECT COUNT(*) FROM `{table}`')
+                            rows = cursor.fetchone()[0]
+
+                            dump_cmd = f'/usr/local/bin/mysqldump --defaults-file="mysql_login.cnf" -h {db_config["host"]} -P {db_config.get("port", 3306)} --skip-column-statistics --no-tablespaces --routines --events --triggers {db_config["database"]} {table}'
+                            started = time.perf_counter()
+
+                            if backup_store is not None:
+                                # Streamed straight into the chunk store, only chunks not stored yet are written
+                                process = subprocess.Popen(dump_cmd, shell=True, stdout=subprocess.PIPE)
+                                try:
+                                    entry, stats = backup_store.add_stream(process.stdout)
+                                finally:
+                                    process.stdout.close()
+                                    status = process.wait()
+                                # Chunks already written are unreferenced and removed by a later gc
+                                if status != 0:
+                                    raise BackupError(f'mysqldump of {table} failed with status {status}')
+                                manifest["tables"][table] = {"file": table + '.sql', "rows": rows, **entry, **stats}
+                            else:
+                                dump_file = output_dir + table + ('.sql.gz' if BACKUP_COMPRESS else '.sql')
+                                with open(dump_file, 'wb') as f:
+                                    if BACKUP_COMPRESS:
+                                        # Piped here rather than by the shell, whose status would be gzip's
+                                        process = subprocess.Popen(dump_cmd, shell=True, stdout=subprocess.PIPE)
+                                        compressor = subprocess.Popen(['gzip'], stdin=process.stdout, stdout=f)
+                                        process.stdout.close()
+                                        gzip_status = compressor.wait()
+                                        status = process.wait()
+                                    else:
+                                        gzip_status = 0
+                                        status = subprocess.call(dump_cmd, shell=True, stdout=f)
+                                if status != 0:
+                                    raise BackupError(f'mysqldump of {table} failed with status {status}')
+                                if gzip_status != 0:
+                                    raise BackupError(f'gzip of {table} failed with status {gzip_status}')
+                                manifest["tables"][table] = {"file": os.path.basename(dump_file), "rows": rows, "bytes": os.path.getsize(dump_file)}
+
+                            manifest["tables"][table]["seconds"] = round(time.perf_counter() - started, 3)
+
+                        if backup_store is not None:
+                            backup_store.commit_snapshot(snapshot_name, manifest)
+                        else:
+                            with open(output_dir + 'manifest.json', 'w') as f:
+                                json.dump(manifest, f, indent=2)
+
+                    print(f'\tBackup completed at {now}')
+
+                    if backup_store is not None:
+                        written = sum(table["bytesWritten"] for table in manifest["tables"].values())
+                        print(f'\tSnapshot {snapshot_name}: {written} bytes written for {sum(table["bytes"] for table in manifest["tables"].values())} bytes of dumps')
+                        removed = backup_store.gc(BACKUP_STORE_KEEP)
+                        if removed["snapshots"]:
+                            print(f'\tRemoved {len(removed["snapshots"])} old snapshots and {removed["chunks"]} chunks ({removed["bytes"]} bytes)')
+                except Exception as error:
+                    print(f'\tBackup failed: {error}')
+                    # A partial backup set would block the retry and look restorable
+                    if backup_store is None:
+                        shutil.rmtree(output_dir, ignore_errors=True)
+                    raise
+                finally:
+                    # Remove the login path file
+                    os.remove('mysql_login.cnf')
+            finally:
+                # Also on failure, or every failed backup would keep a pooled connection
+                if cursor is not None:
+                    cursor.close()
+                connection.close()
+
+            shared_state.last_backup_time = now
+        else:
+            print(f'\tBackup already exists for {date_str}. Skipping backup.')
+    finally:
+        os.chdir(current_dir)
 
-    # Get the current date and format it as "Monday"
-    now = datetime.now()
-    date_str = now.strftime('%b%d_%-I%p')
 
-    # Get the current year
-    year = now.strftime('%Y')
 
-    # Create the output directory with the year if it doesn't exist
-    output_dir = f'{year}/{date_str}/'
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-        print(f'\tBackup directory created: {output_dir}')
+def perform_claimed_backup(claimed_at):
+    # Gives the claim back when the backup fails, so the next attempt doesn't wait out the guard
+    try:
+        perform_backup_sync()
+    except Exception:
+        shared_state.release_backup(claimed_at)
+        raise
 
-        # Create a login path file with the username and password
-        with open('mysql_login.cnf', 'w') as f:
-            f.write(f'[client]\nuser={DB_CONFIG["user"]}\npassword={DB_CONFIG["password"]}\n')
 
-        # Get a list of all tables in the database
-        connection = get_db_connection()
-        cursor = connection.cursor()
-        cursor.execute('SHOW TABLES')
-        tables = [row[0] for row in cursor.fetchall()]
+def automated_backup():
+    claimed_at = datetime.now()
+    if shared_state.claim_backup(claimed_at, timedelta(hours=2)):
+        print("\tAutomated backup triggered")
+        perform_claimed_backup(claimed_at)
+
+
+class CronSchedule:
+    """
+    A five-field cron expression: minute, hour, day of month, month, day of week.
+
+    Fields take `*`, numbers, ranges (`1-5`), steps (`*/10`, `0-30/5`) and
+    comma-separated lists. Days of the week run from 0 (Sunday) to 6, and 7
+    is Sunday too. As in cron, when both day fields are restricted a day
+    matching either one matches. Times are the server's local time.
+    """
+
+    FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Cron expression {expression!r} needs 5 fields")
+
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, weekdays = (self._parse(field, low, high) for field, (low, high) in zip(fields, self.FIELDS))
+        self.weekdays = {weekday % 7 for weekday in weekdays}
+        self._any_day = fields[2].startswith("*")
+        self._any_weekday = fields[4].startswith("*")
+
+    @staticmethod
+    def _parse(field, low, high):
+        values = set()
+        for part in field.split(","):
+            span, _, step = part.partition("/")
+            if span == "*":
+                start, end = low, high
+            elif "-" in span:
+                start, end = (int(value) for value in span.split("-", 1))
+            else:
+                start = int(span)
+                # "5/15" means every 15 starting at 5
+                end = high if step else start
+            step = int(step) if step else 1
+            if not low <= start <= end <= high or step < 1:
+                raise ValueError(f"Invalid cron field {field!r}")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, day):
+        day_matches = day.day in self.days
+        weekday_matches = (day.weekday() + 1) % 7 in self.weekdays
+        if self._any_day or self._any_weekday:
+            return day_matches and weekday_matches
+        return day_matches or weekday_matches
+
+    def next_after(self, moment):
+        """The first matching minute after `moment`."""
+        candidate = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        # February 29th can be eight years away
+        limit = candidate + timedelta(days=9 * 366)
+        while candidate < limit:
+            if candidate.month not in self.months:
+                candidate = (candidate.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(candidate):
+                candidate = candidate.replace(hour=0, minute=0) + timedelta(days=1)
+            elif candidate.hour not in self.hours:
+                candidate = candidate.replace(minute=0) + timedelta(hours=1)
+            elif candidate.minute not in self.minutes:
+                candidate += timedelta(minutes=1)
+            else:
+                return candidate
+        raise ValueError(f"Cron expression {self.expression!r} never matches")
+
+
+class ScheduledJob:
+    def __init__(self, name, schedule, fn, leader_only, history_size):
+        self.name = name
+        self.schedule = schedule
+        self.fn = fn
+        self.leader_only = leader_only
+        self.next_run = None
+        self.due_at = None
+        self.running_since = None
+        self.history = deque(maxlen=history_size)
+        self.stats = {"runs": 0, "errors": 0, "skippedOverlap": 0}
+
+    def status(self):
+        return {
+            "schedule": self.schedule.expression,
+            "leaderOnly": self.leader_only,
+            "nextRun": self.next_run.isoformat(),
+            "runningSince": self.running_since.isoformat(timespec="seconds") if self.running_since else None,
+            **self.stats,
+            "history": list(self.history)
+        }
+
+
+class Scheduler:
+    """
+    Runs periodic jobs on cron-style schedules, ahead of the requests that need their results.
+
+    Each run starts up to `jitter` seconds after its scheduled minute, so
+    workers and jobs sharing a minute don't all hit MySQL at once. A job
+    still running when it comes due again skips that run instead of
+    stacking up. Leader-only jobs (backups, the shared histogram, rollups)
+    run on the elected leader; the others warm caches every worker keeps
+    for itself. The last `history_size` runs of each job are kept for
+    /scheduler.
+    """
+
+    def __init__(self, leader_election, jitter, history_size, max_workers=4, poll_interval=1):
+        self.leader_election = leader_election
+        self.jitter = jitter
+        self.history_size = history_size
+        self.poll_interval = poll_interval
+        self.jobs = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="scheduler")
+
+    def add(self, name, schedule, fn, leader_only=True, now=None):
+        job = ScheduledJob(name, CronSchedule(schedule), fn, leader_only, self.history_size)
+        self._plan(job, now or datetime.now())
+        self.jobs[name] = job
+
+    def _plan(self, job, after):
+        job.next_run = job.schedule.next_after(after)
+        job.due_at = job.next_run + timedelta(seconds=random.uniform(0, self.jitter))
+
+    def run_pending(self, now=None):
+        """Starts the jobs that are due. Returns the futures of the runs started."""
+        now = now or datetime.now()
+        is_leader = None
+        started = []
+
+        for job in self.jobs.values():
+            if now < job.due_at:
+                continue
+            # Planned from now, so runs missed while the process was stalled aren't replayed
+            self._plan(job, now)
+
+            if job.leader_only:
+                # Followers poll the leader lock here, so one takes over when the leader dies
+                if is_leader is None:
+                    is_leader = self.leader_election.try_acquire()
+                if not is_leader:
+                    continue
+
+            with self._lock:
+                if job.running_since is not None:
+                    job.stats["skippedOverlap"] += 1
+                    print(f"\tScheduled job {job.name} is still running, skipping this run")
+                    continue
+                job.running_since = now
+
+            started.append(self._executor.submit(self._run, job))
+
+        return started
+
+    def _run(self, job):
+        started_at = datetime.now()
+        started = time.perf_counter()
+        error = None
+        try:
+            job.fn()
+        except Exception as exc:
+            error = exc
+            print(f"Error running scheduled job {job.name}: {exc}")
+
+        run = {"startedAt": started_at.isoformat(timespec="seconds"), "seconds": round(time.perf_counter() - started, 3), "status": "error" if error else "ok"}
+        if error is not None:
+            run["error"] = str(error)
+
+        with self._lock:
+            job.running_since = None
+            job.stats["runs"] += 1
+            job.stats["errors"] += error is not None
+            job.history.append(run)
+
+    def run(self):
+        while True:
+            try:
+                self.run_pending()
+            except Exception as error:
+                print(f"Error in scheduler: {error}")
+            time.sleep(self.poll_interval)
+
+    def status(self):
+        with self._lock:
+            return {
+                "isLeader": self.leader_election.is_leader,
+                "jitter": self.jitter,
+                "jobs": {name: job.status() for name, job in self.jobs.items()}
+            }
+
+
+def warm_activity_forecast():
+    calculate_activity_forecast(store_day()[0])
+
+
+def warm_profile_cache():
+    # The profiles /accounts will ask for: everyone with a cart today
+    if not today_hot_set.is_ready():
+        return
+    profile_ids = today_hot_set.active_profile_ids()
+    if not profile_ids:
+        return
+
+    connection = get_db_connection("accounts")
+    try:
+        cursor = prepared_statements.cursor(connection)
+        profile_cache.get_many(cursor, profile_ids)
         cursor.close()
+    finally:
         connection.close()
 
-        # Loop through each table and perform a mysqldump
-        for table in tables:
-            dump_file = output_dir + table + '.sql'
-            dump_cmd = f'/usr/local/bin/mysqldump --defaults-file="mysql_login.cnf" -h {DB_CONFIG["host"]} -P {DB_CONFIG["port"]} --skip-column-statistics --no-tablespaces --routines --events --triggers {DB_CONFIG["database"]} {table} > {dump_file}'
-            # print(dump_cmd)
-            os.system(dump_cmd)
 
-        print(f'\tBackup completed at {now}')
+SCHEDULABLE_JOBS = {
+    # name: (function, leader only)
+    "backup": (automated_backup, True),
+    "activity_histogram": (calculate_activity_probability, True),
+    "activity_forecast": (warm_activity_forecast, False),
+    "sales_rollup": (refresh_sales_rollup, True),
+    "transaction_ledger": (sync_transaction_ledger, True),
+    "profile_cache": (warm_profile_cache, False)
+}
+
 
-        # Remove the login path file
-        os.remove('mysql_login.cnf')
+def schedule_jobs(scheduler, schedules):
+    unknown = set(schedules) - set(SCHEDULABLE_JOBS)
+    if unknown:
+        raise ValueError(f"Unknown jobs in SCHEDULED_JOBS: {', '.join(sorted(unknown))} (jobs are {', '.join(SCHEDULABLE_JOBS)})")
 
-        last_backup_time = now
-    else:
-        print(f'\tBackup already exists for {date_str}. Skipping backup.')
+    for job_name, schedule in schedules.items():
+        if schedule is not None:
+            job_fn, leader_only = SCHEDULABLE_JOBS[job_name]
+            scheduler.add(job_name, schedule, job_fn, leader_only=leader_only)
 
-    os.chdir(current_dir)
 
+scheduler = Scheduler(leader_election, SCHEDULER_JITTER, SCHEDULER_HISTORY)
+schedule_jobs(scheduler, SCHEDULED_JOBS)
 
 
-def automated_backup():
-    global last_backup_time
-    while True:
-        current_time = datetime.now()
-        if last_backup_time is None or (current_time - last_backup_time) >= timedelta(hours=2):
-            print("\tAutomated backup triggered")
-            perform_backup_sync()
-        time.sleep(600)  # sleep 10 mins 
-
-# automated backups..
-backup_thread = threading.Thread(target=automated_backup, daemon=True)
-backup_thread.start()
\ No newline at end of file
+@app.get("/scheduler")
+@sleep_and_retry
+@limits(calls=30, period=60)
+def get_scheduler_status():
+    return scheduler.status()
+
+
+@app.on_event("startup")
+def start_scheduled_jobs():
+    # Every worker runs the scheduler; leader-only jobs run on whichever worker holds the lock
+    scheduler_thread = threading.Thread(target=scheduler.run, daemon=True)
+    scheduler_thread.start()
+
+    # Every worker answers its own health checks, so every worker probes
+    health_thread = threading.Thread(target=health_prober.run, daemon=True)
+    health_thread.start()
+
+    # Every worker keeps its own copy of today's carts
+    hot_set_thread = threading.Thread(target=today_hot_set.run, daemon=True)
+    hot_set_thread.start()
@@ -0,0 +1,241 @@
+"""
+Content-addressed, deduplicated storage for backup dumps.
+
+Dumps are cut into variable-size chunks at content-defined boundaries (a
+gear rolling hash over the last 32 bytes), so an insert or update only
+changes the chunks around it. Chunks are stored once, zlib-compressed,
+under the SHA-256 of their contents. A snapshot is a JSON manifest listing
+each table's dump as a sequence of chunk hashes, alongside the row counts
+and timings perform_backup_sync records. Deleting old snapshots and
+sweeping chunks no manifest references reclaims space.
+
+    store/
+        chunks/ab/abcdef...     zlib-compressed chunk
+        snapshots/2024/Jul03_2PM.json
+        lock
+"""
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import io
+import json
+import os
+import tempfile
+import zlib
+
+import numpy as np
+
+# Random but fixed per-byte values for the gear hash; changing them changes every boundary
+GEAR = np.random.default_rng(0x6765617273).integers(0, 2 ** 32, size=256, dtype=np.uint64).astype(np.uint32)
+WINDOW = 32
+
+
+def gear_hashes(data):
+    """Gear hash of the 32 bytes ending at each position of `data` (positions before 31 cover fewer bytes)."""
+    # h[i] = sum(GEAR[data[i - k]] << k for k < 32), built by doubling the window: 5 passes instead of 32
+    hashes = GEAR[np.frombuffer(data, dtype=np.uint8)]
+    width = 1
+    while width < WINDOW:
+        doubled = hashes.copy()
+        doubled[width:] += hashes[:-width] << np.uint32(width)
+        hashes = doubled
+        width *= 2
+    return hashes
+
+
+def chunk_stream(stream, min_size=16 * 1024, avg_size=64 * 1024, max_size=256 * 1024, read_size=4 * 1024 * 1024):
+    """Yields the contents of a binary stream as content-defined chunks."""
+    if min_size < WINDOW:
+        raise ValueError(f"min_size must be at least {WINDOW}")
+
+    # Cut where the top bits of the hash are all zero: one position in avg_size on average
+    bits = max(int(avg_size).bit_length() - 1, 1)
+    mask = np.uint32(((1 << bits) - 1) << (32 - bits))
+
+    pending = b""
+    while True:
+        block = stream.read(read_size)
+        pending += block
+
+        # pending always starts on a chunk boundary and no cut comes before min_size,
+        # so every cut is decided by a full window of bytes
+        candidates = np.flatnonzero((gear_hashes(pending) & mask) == 0) + 1 if pending else []
+        start = 0
+        for cut in candidates:
+            while cut - start > max_size:
+                yield pending[start:start + max_size]
+                start += max_size
+            if cut - start >= min_size:
+                yield pending[start:cut]
+                start = cut
+        while len(pending) - start > max_size:
+            yield pending[start:start + max_size]
+            start += max_size
+        pending = pending[start:]
+
+        if not block:
+            if pending:
+                yield pending
+            return
+
+
+class ChunkReader(io.RawIOBase):
+    """Reads a stored file back as a stream, one chunk in memory at a time."""
+
+    def __init__(self, store, chunks):
+        self._store = store
+        self._chunks = iter(chunks)
+        self._current = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._current:
+            digest = next(self._chunks, None)
+            if digest is None:
+                return 0
+            self._current = self._store.get_chunk(digest)
+        size = min(len(buffer), len(self._current))
+        buffer[:size] = self._current[:size]
+        self._current = self._current[size:]
+        return size
+
+
+class ChunkStore:
+    """
+    Deduplicating chunk store with per-snapshot manifests.
+
+    Writers and garbage collection serialize on an flock on `root/lock`,
+    so a sweep never removes chunks a backup in progress has just written.
+    """
+
+    def __init__(self, root, min_size=16 * 1024, avg_size=64 * 1024, max_size=256 * 1024, compression_level=6):
+        self.root = root
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        self.compression_level = compression_level
+        self._chunk_dir = os.path.join(root, "chunks")
+        self._snapshot_dir = os.path.join(root, "snapshots")
+
+    @contextmanager
+    def lock(self):
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, "lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _chunk_path(self, digest):
+        return os.path.join(self._chunk_dir, digest[:2], digest)
+
+    def _snapshot_path(self, name):
+        return os.path.join(self._snapshot_dir, name + ".json")
+
+    def _write_atomic(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def put_chunk(self, data):
+        """Stores a chunk unless it is already there. Returns its digest and the bytes written."""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._chunk_path(digest)
+        if os.path.exists(path):
+            return digest, 0
+
+        compressed = zlib.compress(data, self.compression_level)
+        self._write_atomic(path, compressed)
+        return digest, len(compressed)
+
+    def get_chunk(self, digest):
+        with open(self._chunk_path(digest), "rb") as f:
+            data = zlib.decompress(f.read())
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise ValueError(f"Chunk {digest} is corrupt")
+        return data
+
+    def add_stream(self, stream):
+        """Chunks and stores a binary stream. Returns its manifest entry (size, chunks) and write stats."""
+        entry = {"bytes": 0, "chunks": []}
+        stats = {"chunkCount": 0, "newChunks": 0, "bytesWritten": 0}
+        for chunk in chunk_stream(stream, self.min_size, self.avg_size, self.max_size):
+            digest, written = self.put_chunk(chunk)
+            entry["bytes"] += len(chunk)
+            entry["chunks"].append(digest)
+            stats["chunkCount"] += 1
+            stats["newChunks"] += written > 0
+            stats["bytesWritten"] += written
+        return entry, stats
+
+    def commit_snapshot(self, name, manifest):
+        """Writes a snapshot manifest once all of its chunks are stored."""
+        self._write_atomic(self._snapshot_path(name), json.dumps(manifest, indent=2).encode())
+
+    def has_snapshot(self, name):
+        return os.path.exists(self._snapshot_path(name))
+
+    def snapshot(self, name):
+        with open(self._snapshot_path(name)) as f:
+            return json.load(f)
+
+    def snapshots(self):
+        """Snapshot names, oldest first."""
+        names = []
+        for directory, _, files in os.walk(self._snapshot_dir):
+            for file in files:
+                if file.endswith(".json") and not file.startswith(".tmp-"):
+                    path = os.path.join(directory, file)
+                    names.append((os.path.getmtime(path), os.path.relpath(path, self._snapshot_dir)[:-len(".json")]))
+        return [name for _, name in sorted(names)]
+
+    def open_table(self, name, table):
+        """Opens a table's dump from a snapshot as a buffered binary stream."""
+        return io.BufferedReader(ChunkReader(self, self.snapshot(name)["tables"][table]["chunks"]))
+
+    def delete_snapshot(self, name):
+        os.remove(self._snapshot_path(name))
+
+    def gc(self, keep):
+        """Deletes all but the newest `keep` snapshots, then the chunks no snapshot uses. Returns what was removed."""
+        with self.lock():
+            names = self.snapshots()
+            expired = names[:-keep] if keep > 0 else names
+            for name in expired:
+                self.delete_snapshot(name)
+
+            live = set()
+            for name in names[len(expired):]:
+                for table in self.snapshot(name)["tables"].values():
+                    live.update(table["chunks"])
+
+            removed_chunks = removed_bytes = 0
+            if os.path.isdir(self._chunk_dir):
+                for prefix in os.listdir(self._chunk_dir):
+                    for digest in os.listdir(os.path.join(self._chunk_dir, prefix)):
+                        if digest not in live:
+                            path = os.path.join(self._chunk_dir, prefix, digest)
+                            removed_bytes += os.path.getsize(path)
+                            os.remove(path)
+                            removed_chunks += 1
+
+        return {"snapshots": expired, "chunks": removed_chunks, "bytes": removed_bytes}
+
+    def usage(self):
+        """Chunk count and bytes on disk."""
+        chunks = size = 0
+        if os.path.isdir(self._chunk_dir):
+            for prefix in os.listdir(self._chunk_dir):
+                for digest in os.listdir(os.path.join(self._chunk_dir, prefix)):
+                    chunks += 1
+                    size += os.path.getsize(os.path.join(self._chunk_dir, prefix, digest))
+        return {"chunks": chunks, "bytes": size}
@@ -0,0 +1,123 @@
+"""
+Measures bytes written per snapshot by the chunk store against full copies.
+
+    python bench_backup_store.py                      # synthetic dumps, 12 snapshots
+    python bench_backup_store.py --sets 2024/Jul03_12PM 2024/Jul03_2PM ...
+
+The synthetic run dumps a table as mysqldump would (extended INSERTs of
+about 1 MB per line) and, between snapshots, updates a fraction of the
+rows and adds some new ones. As with carts and orders, updates go to the
+most recent rows (--hot-fraction). With --sets, existing backup sets under
+BACK_UP_LOC are snapshotted in the order given.
+"""
+import argparse
+import gzip
+import io
+import os
+import random
+import tempfile
+import time
+
+from backup_store import ChunkStore
+
+
+def synthetic_dump(rows, line_bytes=1024 * 1024):
+    out = io.BytesIO()
+    out.write(b"-- MySQL dump\nDROP TABLE IF EXISTS `carts`;\nCREATE TABLE `carts` (\n  `id` int NOT NULL,\n"
+              b"  `profileId` int NOT NULL,\n  `status` varchar(16) NOT NULL,\n  `updatedAt` datetime NOT NULL,\n"
+              b"  PRIMARY KEY (`id`)\n) ENGINE=InnoDB;\n")
+    line = []
+    size = 0
+    for row_id in sorted(rows):
+        value = "({},{},'{}','{}')".format(row_id, *rows[row_id]).encode()
+        line.append(value)
+        size += len(value) + 1
+        if size >= line_bytes:
+            out.write(b"INSERT INTO `carts` VALUES " + b",".join(line) + b";\n")
+            line, size = [], 0
+    if line:
+        out.write(b"INSERT INTO `carts` VALUES " + b",".join(line) + b";\n")
+    return out.getvalue()
+
+
+def synthetic_snapshots(count, rows, change_rate, growth_rate, hot_fraction, seed=1):
+    rng = random.Random(seed)
+    table = {row_id: (rng.randrange(100000), "OPEN", f"2024-07-03 {rng.randrange(24):02d}:{rng.randrange(60):02d}:00") for row_id in range(rows)}
+    for snapshot in range(count):
+        if snapshot:
+            recent = sorted(table)[-max(int(len(table) * hot_fraction), 1):]
+            for row_id in rng.sample(recent, min(int(len(table) * change_rate), len(recent))):
+                profile_id, _, _ = table[row_id]
+                table[row_id] = (profile_id, rng.choice(("OPEN", "COMPLETED", "CANCELLED")), f"2024-07-03 {rng.randrange(24):02d}:{rng.randrange(60):02d}:00")
+            next_id = max(table) + 1
+            for row_id in range(next_id, next_id + int(len(table) * growth_rate)):
+                table[row_id] = (rng.randrange(100000), "OPEN", "2024-07-03 23:59:00")
+        yield f"synthetic/{snapshot:02d}", {"carts": synthetic_dump(table)}
+
+
+def backup_set_snapshots(backup_dir, names):
+    for name in names:
+        path = os.path.join(backup_dir, name)
+        dumps = {}
+        for file in sorted(os.listdir(path)):
+            if file.endswith(".sql") or file.endswith(".sql.gz"):
+                opener = gzip.open if file.endswith(".gz") else open
+                with opener(os.path.join(path, file), "rb") as f:
+                    dumps[file.split(".")[0]] = f.read()
+        yield name, dumps
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sets", nargs="+", help="existing backup sets under BACK_UP_LOC to snapshot, oldest first")
+    parser.add_argument("--snapshots", type=int, default=12)
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--change-rate", type=float, default=0.005, help="fraction of rows updated between snapshots")
+    parser.add_argument("--growth-rate", type=float, default=0.002, help="fraction of rows added between snapshots")
+    parser.add_argument("--hot-fraction", type=float, default=0.05, help="newest fraction of rows the updates go to")
+    parser.add_argument("--avg-chunk", type=int, default=64 * 1024)
+    args = parser.parse_args(argv)
+
+    if args.sets:
+        from config import BACK_UP_LOC
+        snapshots = backup_set_snapshots(BACK_UP_LOC, args.sets)
+    else:
+        snapshots = synthetic_snapshots(args.snapshots, args.rows, args.change_rate, args.growth_rate, args.hot_fraction)
+
+    print(f"{'snapshot':<24} {'dump MB':>9} {'gzip MB':>9} {'written MB':>11} {'chunks':>8} {'new':>6} {'MB/s':>7}")
+    totals = {"dump": 0, "gzip": 0, "written": 0}
+
+    with tempfile.TemporaryDirectory() as root:
+        store = ChunkStore(root, min_size=args.avg_chunk // 4, avg_size=args.avg_chunk, max_size=args.avg_chunk * 4)
+
+        for name, dumps in snapshots:
+            manifest = {"tables": {}}
+            dump_bytes = sum(len(dump) for dump in dumps.values())
+            # What a full gzipped copy per run would cost instead
+            gzip_bytes = sum(len(gzip.compress(dump, 6)) for dump in dumps.values())
+
+            started = time.perf_counter()
+            for table, dump in dumps.items():
+                entry, stats = store.add_stream(io.BytesIO(dump))
+                manifest["tables"][table] = {"file": table + ".sql", "rows": None, **entry, **stats}
+            store.commit_snapshot(name, manifest)
+            seconds = time.perf_counter() - started
+
+            written = sum(table["bytesWritten"] for table in manifest["tables"].values())
+            chunks = sum(table["chunkCount"] for table in manifest["tables"].values())
+            new_chunks = sum(table["newChunks"] for table in manifest["tables"].values())
+            print(f"{name:<24} {dump_bytes / 1e6:>9.2f} {gzip_bytes / 1e6:>9.2f} {written / 1e6:>11.3f} {chunks:>8} {new_chunks:>6} {dump_bytes / 1e6 / seconds:>7.1f}")
+
+            totals["dump"] += dump_bytes
+            totals["gzip"] += gzip_bytes
+            totals["written"] += written
+
+        usage = store.usage()
+
+    print(f"\nFull copies: {totals['dump'] / 1e6:.1f} MB, gzipped copies: {totals['gzip'] / 1e6:.1f} MB, "
+          f"chunk store: {totals['written'] / 1e6:.1f} MB written, {usage['bytes'] / 1e6:.1f} MB on disk in {usage['chunks']} chunks "
+          f"({totals['gzip'] / max(usage['bytes'], 1):.1f}x smaller than gzipped copies)")
+
+
+if __name__ == "__main__":
+    main()
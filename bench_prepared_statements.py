@@ -0,0 +1,92 @@
+"""
+Measures /accounts' per-profile queries sent as text versus prepared, per simulated request.
+
+    python bench_prepared_statements.py                            # 200 requests over today's active profiles
+    python bench_prepared_statements.py --requests 500 --profiles 1 5 20 50 --cart-items
+
+Each request checks a connection out of a pool that resets sessions on
+check-in, as the app's pools do, runs accounts.orders once per profile
+(and accounts.cart_items with --cart-items, as when the in-memory cart set
+isn't ready) with today's store day as the date range, closes its cursor
+and hands the connection back. As text the queries go through a plain
+cursor; prepared, through a StatementCursor, so every request prepares
+each statement again, as production does. Text and prepared requests
+alternate so both see the same server load. Profiles are those with a cart
+today (or the most recent carts when there are none); --profiles sets how
+many each request loops over.
+"""
+import argparse
+import itertools
+import time
+
+from mysql.connector.pooling import MySQLConnectionPool
+
+from active_orders_api import PreparedStatements, QUERY_ACCOUNTS_ORDERS, QUERY_ACCOUNTS_CART_ITEMS, store_day
+from config import DB_CONFIG
+
+
+def simulate_request(pool, make_cursor, queries, profile_ids, day_start, day_end):
+    started = time.perf_counter()
+    connection = pool.get_connection()
+    cursor = make_cursor(connection)
+    for profile_id in profile_ids:
+        for query in queries:
+            cursor.execute(query, (profile_id, day_start, day_end))
+            cursor.fetchone()
+    cursor.close()
+    connection.close()
+    return time.perf_counter() - started
+
+
+def summarize(timings):
+    timings = sorted(timings)
+    return sum(timings) / len(timings), timings[len(timings) // 2], timings[int(len(timings) * 0.99)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200, help="simulated requests of each kind")
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--profiles", type=int, nargs="+", help="profiles per request (default: all active today)")
+    parser.add_argument("--cart-items", action="store_true", help="also run accounts.cart_items per profile")
+    args = parser.parse_args(argv)
+
+    queries = [QUERY_ACCOUNTS_ORDERS] + ([QUERY_ACCOUNTS_CART_ITEMS] if args.cart_items else [])
+    # Its own registry, so the comparison doesn't depend on DB_PREPARED_STATEMENTS
+    statements = PreparedStatements(enabled=True)
+    statements.register("accounts.orders", QUERY_ACCOUNTS_ORDERS)
+    statements.register("accounts.cart_items", QUERY_ACCOUNTS_CART_ITEMS)
+
+    pool = MySQLConnectionPool(pool_name="bench_prepared_statements", pool_size=1, **DB_CONFIG)
+    _, day_start, day_end = store_day()
+
+    connection = pool.get_connection()
+    cursor = connection.cursor()
+    cursor.execute("SELECT DISTINCT profileId FROM ylift_api.carts WHERE updatedAt >= %s AND updatedAt < %s", (day_start, day_end))
+    profile_ids = [row[0] for row in cursor.fetchall()]
+    if not profile_ids:
+        cursor.execute("SELECT profileId FROM ylift_api.carts ORDER BY updatedAt DESC LIMIT 50")
+        profile_ids = [row[0] for row in cursor.fetchall()] or [0]
+    cursor.close()
+    connection.close()
+
+    kinds = {"text": lambda connection: connection.cursor(), "prepared": statements.cursor}
+
+    print(f"{'profiles':>8} {'text ms':>9} {'p50':>7} {'p99':>7} {'prepared ms':>12} {'p50':>7} {'p99':>7} {'speedup':>8}")
+    for count in args.profiles or [len(profile_ids)]:
+        request_profiles = list(itertools.islice(itertools.cycle(profile_ids), count))
+        timings = {kind: [] for kind in kinds}
+        for iteration in range(args.warmup + args.requests):
+            for kind, make_cursor in kinds.items():
+                elapsed = simulate_request(pool, make_cursor, queries, request_profiles, day_start, day_end)
+                # Warm-up requests fill the buffer pool so both kinds read the same cached pages
+                if iteration >= args.warmup:
+                    timings[kind].append(elapsed)
+
+        (text_mean, text_p50, text_p99), (prepared_mean, prepared_p50, prepared_p99) = summarize(timings["text"]), summarize(timings["prepared"])
+        print(f"{count:>8} {text_mean * 1000:>9.3f} {text_p50 * 1000:>7.3f} {text_p99 * 1000:>7.3f} "
+              f"{prepared_mean * 1000:>12.3f} {prepared_p50 * 1000:>7.3f} {prepared_p99 * 1000:>7.3f} {text_mean / prepared_mean:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,342 @@
+"""
+Restores a backup set written by perform_backup_sync into a database.
+
+    python restore.py 2024/Jul03_2PM --database ylift_restore --jobs 4
+
+Tables are loaded concurrently, each through its own mysql client session
+with foreign key and unique checks off and a single commit at the end.
+Dumps are streamed into the client as they are read, decompressing .sql.gz
+files on the fly. With --defer-indexes, secondary indexes and foreign keys
+are stripped from each CREATE TABLE and added back once the rows are in.
+Routines and events, which mysqldump repeats in every table's dump, are
+restored once after all the tables. Row counts are compared with the
+set's manifest.json and a per-table timing report is printed.
+
+With BACKUP_STORE configured, snapshots in the chunk store are restored
+the same way, by snapshot name (e.g. 2024/Jul03_2PM), read back chunk
+by chunk.
+"""
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import argparse
+import functools
+import gzip
+import itertools
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import mysql.connector
+
+from backup_store import ChunkStore
+import config
+from config import DB_CONFIG, BACK_UP_LOC
+
+MYSQL_CLIENT = getattr(config, "MYSQL_CLIENT", "/usr/local/bin/mysql")
+BACKUP_STORE = getattr(config, "BACKUP_STORE", None)
+
+SESSION_PROLOGUE = b"SET SESSION FOREIGN_KEY_CHECKS=0;\nSET SESSION UNIQUE_CHECKS=0;\nSET SESSION autocommit=0;\n"
+SESSION_EPILOGUE = b"COMMIT;\n"
+
+CREATE_TABLE = re.compile(rb"^CREATE TABLE `((?:[^`]|``)+)` \(")
+DEFERRABLE = re.compile(rb"^\s+((?:UNIQUE |FULLTEXT |SPATIAL )?KEY |CONSTRAINT .* FOREIGN KEY )")
+ROUTINES_START = re.compile(rb"^-- Dumping (events|routines) for database ")
+ROUTINES_END = re.compile(rb"^/\*!40103 SET TIME_ZONE=@OLD_TIME_ZONE \*/;")
+
+
+class DumpTransform:
+    """
+    Rewrites a mysqldump stream line by line.
+
+    Routine and event definitions are cut out (and kept when `keep_routines`
+    is set), and with `defer_indexes` the secondary keys and foreign keys of
+    each CREATE TABLE are cut out and kept as ALTER TABLE clauses.
+    """
+
+    def __init__(self, defer_indexes=False, keep_routines=False):
+        self.defer_indexes = defer_indexes
+        self.keep_routines = keep_routines
+        self.deferred = {}
+        self.routines = []
+        self._table = None
+        self._columns = None
+        self._auto_increment = None
+        self._in_routines = False
+
+    def feed(self, line):
+        if self._in_routines:
+            if not ROUTINES_END.match(line):
+                if self.keep_routines:
+                    self.routines.append(line)
+                return b""
+            self._in_routines = False
+        elif ROUTINES_START.match(line):
+            self._in_routines = True
+            if self.keep_routines:
+                self.routines.append(b"--\n" + line)
+            return b""
+
+        if not self.defer_indexes:
+            return line
+
+        if self._table is None:
+            match = CREATE_TABLE.match(line)
+            if match:
+                self._table = match.group(1).decode()
+                self._columns = []
+                self._auto_increment = None
+            return line
+
+        if line.startswith(b")"):
+            table, columns = self._table, self._columns
+            self._table = self._columns = None
+            # The last column or key kept must not end with a comma
+            if columns:
+                columns[-1] = columns[-1].rstrip().rstrip(b",") + b"\n"
+            return b"".join(columns) + line
+
+        if b" AUTO_INCREMENT" in line and line.lstrip().startswith(b"`"):
+            self._auto_increment = line.split(b"`")[1]
+        # An AUTO_INCREMENT column has to stay indexed
+        keeps_auto_increment = self._auto_increment is not None and line.split(b"(", 1)[-1].startswith(b"`" + self._auto_increment + b"`")
+        if DEFERRABLE.match(line) and not keeps_auto_increment:
+            self.deferred.setdefault(self._table, []).append(line.strip().rstrip(b",").decode())
+        else:
+            self._columns.append(line)
+        return b""
+
+    def alter_statements(self):
+        return [
+            "ALTER TABLE `{}` {}".format(table, ", ".join("ADD " + definition for definition in definitions))
+            for table, definitions in self.deferred.items()
+        ]
+
+
+def open_dump(path):
+    # Decompressed as it is read, the whole file is never in memory
+    return gzip.open(path, "rb") if path.endswith(".gz") else open(path, "rb")
+
+
+def mysql_command(target, login_file):
+    return [MYSQL_CLIENT, f"--defaults-extra-file={login_file}", "-h", target["host"], "-P", str(target.get("port", 3306)), target["database"]]
+
+
+def pipe_to_mysql(command, chunks):
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    # Drain stderr on the side so a chatty client can't block on a full pipe
+    errors = []
+    reader = threading.Thread(target=lambda: errors.append(process.stderr.read()), daemon=True)
+    reader.start()
+
+    try:
+        for chunk in chunks:
+            if chunk:
+                process.stdin.write(chunk)
+        process.stdin.close()
+    except BrokenPipeError:
+        pass
+
+    returncode = process.wait()
+    reader.join()
+    if returncode != 0:
+        raise RuntimeError(b"".join(errors).decode(errors="replace").strip() or f"mysql exited with {returncode}")
+
+
+def restore_table(table, open_fn, size, target, login_file, defer_indexes):
+    """Loads one table's dump, re-adds deferred indexes and counts the rows. Returns the timings."""
+    transform = DumpTransform(defer_indexes=defer_indexes)
+    result = {"table": table, "bytes": size}
+
+    started = time.perf_counter()
+    with open_fn() as dump:
+        chunks = itertools.chain([SESSION_PROLOGUE], (transform.feed(line) for line in dump), [SESSION_EPILOGUE])
+        pipe_to_mysql(mysql_command(target, login_file), chunks)
+    result["loadSeconds"] = round(time.perf_counter() - started, 3)
+
+    connection = mysql.connector.connect(**target)
+    try:
+        cursor = connection.cursor()
+
+        started = time.perf_counter()
+        cursor.execute("SET SESSION FOREIGN_KEY_CHECKS=0")
+        for statement in transform.alter_statements():
+            cursor.execute(statement)
+        result["indexSeconds"] = round(time.perf_counter() - started, 3)
+
+        cursor.execute(f"SELECT COUNT(*) FROM `{table}`")
+        result["rows"] = cursor.fetchone()[0]
+        cursor.close()
+    finally:
+        connection.close()
+
+    return result
+
+
+def read_routines(open_fn):
+    """Returns the routine and event definitions in a dump."""
+    transform = DumpTransform(keep_routines=True)
+    with open_fn() as dump:
+        for line in dump:
+            transform.feed(line)
+    return transform.routines
+
+
+def find_dumps(backup_dir):
+    """Returns table -> (open function, size, expected rows or None), from the manifest when there is one."""
+    manifest_path = os.path.join(backup_dir, "manifest.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            files = {table: (entry["file"], entry["rows"]) for table, entry in json.load(f)["tables"].items()}
+    else:
+        files = {}
+        for name in sorted(os.listdir(backup_dir)):
+            for suffix in (".sql.gz", ".sql"):
+                if name.endswith(suffix):
+                    files[name[:-len(suffix)]] = (name, None)
+                    break
+
+    dumps = {}
+    for table, (name, rows) in files.items():
+        path = os.path.join(backup_dir, name)
+        dumps[table] = (functools.partial(open_dump, path), os.path.getsize(path), rows)
+    return dumps
+
+
+def find_snapshot_dumps(store, name):
+    """Same as find_dumps, for a snapshot in the chunk store."""
+    return {
+        table: (functools.partial(store.open_table, name, table), entry["bytes"], entry["rows"])
+        for table, entry in store.snapshot(name)["tables"].items()
+    }
+
+
+def restore(dumps, target, jobs=4, defer_indexes=False, tables=None, report=print):
+    """Restores `dumps` (from find_dumps or find_snapshot_dumps). Returns the per-table results and the wall time."""
+    all_dumps = dumps
+    if tables:
+        missing = set(tables) - set(dumps)
+        if missing:
+            raise ValueError(f"Not in backup set: {', '.join(sorted(missing))}")
+        dumps = {table: dumps[table] for table in tables}
+
+    # Biggest first, so the long loads don't end up last
+    order = sorted(dumps, key=lambda table: dumps[table][1], reverse=True)
+
+    with tempfile.NamedTemporaryFile("w", suffix=".cnf") as login:
+        login.write(f'[client]\nuser={target["user"]}\npassword={target["password"]}\n')
+        login.flush()
+
+        started = time.perf_counter()
+        results = []
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {
+                executor.submit(restore_table, table, dumps[table][0], dumps[table][1], target, login.name, defer_indexes): table
+                for table in order
+            }
+            for future in as_completed(futures):
+                table = futures[future]
+                try:
+                    result = future.result()
+                except Exception as error:
+                    result = {"table": table, "bytes": dumps[table][1], "error": str(error)}
+
+                expected = dumps[table][2]
+                result["expectedRows"] = expected
+                if "error" in result:
+                    result["status"] = "failed"
+                elif expected is not None and result["rows"] != expected:
+                    result["status"] = "mismatch"
+                else:
+                    result["status"] = "ok"
+                results.append(result)
+                report(f"\t{table}: {result['status']}")
+
+        # Every table's dump repeats the routines, so they are read from the smallest
+        # whether or not that table was picked or loaded cleanly
+        if all_dumps:
+            routines = read_routines(all_dumps[min(all_dumps, key=lambda table: all_dumps[table][1])][0])
+            if routines:
+                pipe_to_mysql(mysql_command(target, login.name), routines)
+
+        elapsed = time.perf_counter() - started
+
+    results.sort(key=lambda result: order.index(result["table"]))
+    return results, elapsed
+
+
+def format_report(results, elapsed):
+    lines = [f"{'table':<32} {'rows':>12} {'expected':>12} {'MB':>9} {'load s':>9} {'index s':>9} {'MB/s':>8}  status"]
+    for result in results:
+        megabytes = result["bytes"] / 1e6
+        load = result.get("loadSeconds")
+        lines.append("{:<32} {:>12} {:>12} {:>9.1f} {:>9} {:>9} {:>8}  {}".format(
+            result["table"],
+            result.get("rows", "-"),
+            "-" if result["expectedRows"] is None else result["expectedRows"],
+            megabytes,
+            "-" if load is None else f"{load:.2f}",
+            "-" if result.get("indexSeconds") is None else f"{result['indexSeconds']:.2f}",
+            f"{megabytes / load:.1f}" if load else "-",
+            result["status"] + (f" ({result['error']})" if "error" in result else "")
+        ))
+
+    table_seconds = sum(result.get("loadSeconds", 0) + result.get("indexSeconds", 0) for result in results)
+    lines.append(f"\n{len(results)} tables, {sum(result['bytes'] for result in results) / 1e6:.1f} MB in {elapsed:.2f}s "
+                 f"({table_seconds:.2f}s of table work)")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Restore a backup set written by perform_backup_sync")
+    parser.add_argument("backup", help="backup set directory, absolute or relative to BACK_UP_LOC, or chunk store snapshot (e.g. 2024/Jul03_2PM)")
+    parser.add_argument("--database", required=True, help="database to restore into")
+    parser.add_argument("--host", default=DB_CONFIG["host"])
+    parser.add_argument("--port", type=int, default=DB_CONFIG.get("port", 3306))
+    parser.add_argument("--jobs", type=int, default=4, help="tables restored at once")
+    parser.add_argument("--tables", nargs="+", help="only restore these tables")
+    parser.add_argument("--defer-indexes", action="store_true", help="add secondary indexes and foreign keys after loading")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--force", action="store_true", help="allow restoring over the live database")
+    args = parser.parse_args(argv)
+
+    backup_dir = args.backup if os.path.isabs(args.backup) else os.path.join(BACK_UP_LOC, args.backup)
+    store = ChunkStore(BACKUP_STORE) if BACKUP_STORE else None
+    if os.path.isdir(backup_dir):
+        dumps = find_dumps(backup_dir)
+    elif store is not None and store.has_snapshot(args.backup):
+        backup_dir = f"snapshot {args.backup}"
+        dumps = find_snapshot_dumps(store, args.backup)
+    else:
+        parser.error(f"no backup set at {backup_dir}")
+
+    target = dict(DB_CONFIG, host=args.host, port=args.port, database=args.database)
+    if (target["host"], target["database"]) == (DB_CONFIG["host"], DB_CONFIG["database"]) and not args.force:
+        parser.error("refusing to restore over the live database without --force")
+
+    connection = mysql.connector.connect(**{key: value for key, value in target.items() if key != "database"})
+    connection.cursor().execute(f"CREATE DATABASE IF NOT EXISTS `{args.database}`")
+    connection.close()
+
+    print(f"Restoring {backup_dir} into {args.database} on {args.host} with {args.jobs} jobs")
+    results, elapsed = restore(dumps, target, jobs=args.jobs, defer_indexes=args.defer_indexes, tables=args.tables)
+
+    if args.json:
+        print(json.dumps({"seconds": round(elapsed, 3), "tables": results}, indent=2))
+    else:
+        print(format_report(results, elapsed))
+
+    # The manifest counts rows just before each dump, in another session, so
+    # tables written to meanwhile differ a little without anything being wrong
+    mismatched = [result["table"] for result in results if result["status"] == "mismatch"]
+    if mismatched:
+        print(f"Warning: row counts differ from the manifest for {', '.join(mismatched)} (written to while the backup ran?)")
+
+    return 0 if all(result["status"] != "failed" for result in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -11,4 +11,122 @@ API_KEY = "your_api_key"
 API_ID = "your_api_id"
 TRANSACTION_KEY = "your_transaction_key"
 
-BACK_UP_LOC = '/location/backup/'
\ No newline at end of file
+BACK_UP_LOC = '/location/backup/'
+
+# Optional settings
+
+# Directory shared by all workers on the host (leader lock, published results)
+STATE_DIR = '/tmp/active_orders_api'
+# Cron schedules (minute hour day month weekday, server local time) of the background jobs, None to disable; jobs left out keep their default
+SCHEDULED_JOBS = {
+    "backup": "*/10 * * * *",
+    "activity_histogram": "*/10 * * * *",
+    "activity_forecast": "*/10 * * * *",
+    "sales_rollup": "5 * * * *",
+    "transaction_ledger": "* * * * *",
+    "profile_cache": "*/5 * * * *"
+}
+# Most seconds a scheduled run is delayed by, and how many runs per job /scheduler shows
+SCHEDULER_JITTER = 30
+SCHEDULER_HISTORY = 20
+# Days of the sales rollup re-summed on each run
+SALES_ROLLUP_RECHECK_DAYS = 7
+
+# Read replicas for the analytical endpoints, same keys as DB_CONFIG
+DB_REPLICAS = [
+    # {"host": "replica_host", "user": "your_username", "port": 3306, "password": "your_password", "database": "your_database"},
+]
+# Query class -> "primary" or "replica". Classes: carts, accounts, activity, probability, sales, backup, export, batch, hotset
+REPLICA_ROUTES = {"probability": "replica", "sales": "replica", "backup": "replica", "export": "replica"}
+# Replicas further behind than this many seconds are skipped in favour of the primary
+REPLICA_MAX_LAG = 30
+# Seconds to skip a replica after it failed to connect or lagged too far
+REPLICA_RETRY_AFTER = 30
+# Seconds a replica lag check is trusted before the next checkout runs SHOW REPLICA STATUS again
+REPLICA_LAG_CHECK_INTERVAL = 5
+
+# Pooled MySQL connections per server (0 opens a new connection per request)
+DB_POOL_SIZE = 5
+# Seconds to wait for a MySQL connection / for a query result (read_timeout needs a recent mysql-connector-python)
+DB_CONNECT_TIMEOUT = 5
+DB_READ_TIMEOUT = None
+# Server side MAX_EXECUTION_TIME in milliseconds per query class
+DB_MAX_EXECUTION_TIME = {"probability": 20000, "sales": 10000, "accounts": 10000, "activity": 5000, "batch": 20000}
+# Run /accounts' per-profile queries as prepared statements, reused within a request
+DB_PREPARED_STATEMENTS = True
+# Seconds to wait for Authorize.Net
+AUTHORIZENET_TIMEOUT = 15
+# Authorize.Net JSON API (production: https://api2.authorize.net/xml/v1/request.api)
+AUTHORIZENET_ENDPOINT = "https://apitest.authorize.net/xml/v1/request.api"
+# Maximum concurrent Authorize.Net requests per worker
+AUTHORIZENET_MAX_CONCURRENCY = 8
+# Circuit breakers open after this many failures within the window (seconds)
+# and let a probe through after the reset timeout (seconds)
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_FAILURE_WINDOW = 60
+BREAKER_RESET_TIMEOUT = 30
+
+# /probability?forecast=true: weeks of history and exponential weighting (0-1, higher favours recent weeks)
+FORECAST_WEEKS = 8
+FORECAST_ALPHA = 0.3
+
+# Profile lookups cached by /accounts: max entries and seconds before an entry expires
+PROFILE_CACHE_SIZE = 10000
+PROFILE_CACHE_TTL = 3600
+# Seconds between checks of profiles.updatedAt for profiles to drop from the cache
+PROFILE_CACHE_WATERMARK_INTERVAL = 10
+
+# Rows per record batch / row group written by the /export endpoints
+EXPORT_BATCH_SIZE = 10000
+
+# Seconds between background health probes, and the timeout for each
+HEALTH_PROBE_INTERVAL = 10
+HEALTH_PROBE_TIMEOUT = 5
+# Dependencies that must be healthy for /health/ready (mysql, backup_dir, authorizenet, mysql_replica:<host>)
+HEALTH_REQUIRED = ("mysql",)
+# URL probed to check Authorize.Net is reachable (None to skip)
+AUTHORIZENET_HEALTH_URL = AUTHORIZENET_ENDPOINT
+
+# Transaction ledger: seconds between syncs per customer, seconds of history re-fetched on each sync,
+# max age in seconds of a ledger copy served by /transactions, and days a customer stays synced after its last request
+TRANSACTION_SYNC_INTERVAL = 300
+TRANSACTION_SYNC_OVERLAP = 2 * 24 * 3600
+TRANSACTION_LEDGER_MAX_AGE = 900
+TRANSACTION_LEDGER_ACTIVE_DAYS = 30
+
+# Admission control: shared in-flight slots (keep below the threadpool size, 40 by default),
+# priority classes highest first, and per path prefix (class, concurrency or None for no limit, queue size, queue timeout in seconds)
+ADMISSION_MAX_IN_FLIGHT = 32
+ADMISSION_PRIORITIES = ("critical", "interactive", "reports", "bulk")
+ADMISSION_ROUTES = {
+    "/health": ("critical", None, 0, 0),
+    "/metrics": ("critical", None, 0, 0),
+    "/scheduler": ("critical", None, 0, 0),
+    "/version": ("critical", None, 0, 0),
+    "/activity": ("interactive", 16, 32, 5),
+    "/carts": ("interactive", 8, 16, 5),
+    "/transactions": ("interactive", 16, 32, 10),
+    "/probability": ("reports", 4, 8, 10),
+    "/accounts": ("reports", 4, 8, 10),
+    "/sales": ("reports", 4, 8, 10),
+    "/batch": ("bulk", 2, 4, 30),
+    "/export": ("bulk", 2, 2, 30),
+    "/backup": ("bulk", 1, 0, 0)
+}
+
+# Timezone whose midnight starts "today" for /carts, /accounts, /activity and /probability?current=true
+STORE_TIMEZONE = "America/New_York"
+# In-memory copy of today's carts: seconds between incremental refreshes, seconds between full reloads,
+# and seconds without a successful refresh before endpoints go back to MySQL
+HOT_SET_REFRESH_INTERVAL = 5
+HOT_SET_RELOAD_INTERVAL = 900
+HOT_SET_MAX_STALENESS = 60
+
+# gzip the per-table backup dumps (restore.py reads both)
+BACKUP_COMPRESS = False
+# Directory of a deduplicated chunk store to back up into instead of BACK_UP_LOC (None to keep plain dumps),
+# and how many snapshots it keeps
+BACKUP_STORE = None
+BACKUP_STORE_KEEP = 84
+# mysql client used by restore.py
+MYSQL_CLIENT = "/usr/local/bin/mysql"
@@ -1,142 +1,385 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import gzip
+import httpx
+import inspect
+import io
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import time
 import unittest
-from unittest.mock import patch, MagicMock
-from fastapi import HTTPException
-from datetime import datetime, timedelta
+from unittest.mock import patch, AsyncMock, MagicMock
+from fastapi import HTTPException, Response
+from fastapi.responses import JSONResponse
+from datetime import date, datetime, timedelta
 import mysql.connector
+import sys
+import types
 
-from active_orders_api import app, get_transactions_today, parse_xml, get_active_accounts, get_activity_probability, get_active_carts, ActiveCart
+# The app reads its settings from a deployment's config.py, which isn't in the repo
+config = types.ModuleType("config")
+config.DB_CONFIG = {"host": "localhost", "user": "test", "port": 3306, "password": "test", "database": "test"}
+config.API_KEY = "test_api_key"
+config.API_ID = "test_api_id"
+config.TRANSACTION_KEY = "test_transaction_key"
+config.BACK_UP_LOC = tempfile.gettempdir()
+sys.modules["config"] = config
+
+from active_orders_api import app, get_transactions_today, AuthorizeNetClient, get_active_accounts, get_activity_probability, get_active_carts, ActiveCart
+from active_orders_api import LeaderElection, SharedState, activity_data_from_counts, ReplicaRouter, CircuitBreaker, CircuitOpenError
+from active_orders_api import SingleFlight, forecast_hour_of_week, ProfileCache, stream_export, run_batch, BatchRequest
+from active_orders_api import HealthProber, health_check, health_ready
+from active_orders_api import TransactionLedger, get_transactions_range
+from active_orders_api import TodayHotSet, store_day, calculate_activity_forecast, HOUR_LABELS
+from active_orders_api import AdmissionQueue, AdmissionControl, AdmissionMiddleware, AdmissionRejected
+from active_orders_api import CronSchedule, Scheduler, SalesRollup, report_sales, schedule_jobs, DEFAULT_SCHEDULED_JOBS
+from active_orders_api import PreparedStatements, prepared_statements, is_dependency_failure
+from active_orders_api import BackupError, perform_claimed_backup
+import asyncio
+from mysql.connector import FieldType, errorcode
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
 from config import API_KEY
+import restore
+from backup_store import ChunkStore, chunk_stream
+
+class GatewayStub(ThreadingHTTPServer):
+    """Local stand-in for the Authorize.Net JSON API."""
+
+    def __init__(self, respond, delay=0):
+        super().__init__(("127.0.0.1", 0), GatewayStubHandler)
+        self.respond = respond
+        self.delay = delay
+        self.requests = []
+        self.client_ports = set()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/xml/v1/request.api"
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class GatewayStubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+
+        with server.lock:
+            server.requests.append(body)
+            server.client_ports.add(self.client_address[1])
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+
+        time.sleep(server.delay)
+        data = ("\ufeff" + json.dumps(server.respond(body))).encode("utf-8")
 
-class TestParseXML(unittest.TestCase):
-
-    def test_simple_xml(self):
-        xml_string = '''<getTransactionListForCustomerRequest xmlns="AnetApi/xml/v1/schema/AnetApiSchema.xsd">
-<name>John Doe</name>
-<age>30</age>
-</getTransactionListForCustomerRequest>
-'''
-        expected_result = {'name': 'John Doe', 'age': '30'}
-        self.assertEqual(parse_xml(xml_string), expected_result)
-
-    def test_nested_xml(self):
-        xml_string = '''<getTransactionListForCustomerRequest xmlns="AnetApi/xml/v1/schema/AnetApiSchema.xsd">
-<person>
-<name>John Doe</name>
-<age>30</age>
-</person>
-</getTransactionListForCustomerRequest>
-'''
-        expected_result = {'person': {'name': 'John Doe', 'age': '30'}}
-        self.assertEqual(parse_xml(xml_string), expected_result)
-
-    def test_repeated_tags(self):
-        xml_string = '''<getTransactionListForCustomerRequest xmlns="AnetApi/xml/v1/schema/AnetApiSchema.xsd">
-<name>John Doe</name>
-<name>Jane Doe</name>
-</getTransactionListForCustomerRequest>
-'''
-        expected_result = {'name': ['John Doe', 'Jane Doe']}
-        self.assertEqual(parse_xml(xml_string), expected_result)
-
-    def test_empty_xml(self):
-        xml_string = '''<getTransactionListForCustomerRequest xmlns="AnetApi/xml/v1/schema/AnetApiSchema.xsd">
-</getTransactionListForCustomerRequest>
-'''
-        expected_result = {}
-        self.assertEqual(parse_xml(xml_string), expected_result)
-
-    def test_malformed_xml(self):
-        xml_string = '''<getTransactionListForCustomerRequest xmlns="AnetApi/xml/v1/schema/AnetApiSchema.xsd">
-<name>John Doe</name>
-<start>
-<age>30</age>
-</getTransactionListForCustomerRequest>
-'''
-        with self.assertRaises(ValueError):
-            parse_xml(xml_string)
+        with server.lock:
+            server.in_flight -= 1
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def gateway_response(transactions):
+    return {
+        "transactions": transactions,
+        "totalNumInResultSet": len(transactions),
+        "messages": {"resultCode": "Ok", "message": [{"code": "I00001", "text": "Successful."}]}
+    }
 
 
 class TestGetTransactionsToday(unittest.TestCase):
 
-    @patch('active_orders_api.apicontractsv1.merchantAuthenticationType')
-    @patch('active_orders_api.apicontractsv1.getTransactionListForCustomerRequest')
-    @patch('active_orders_api.getTransactionListForCustomerController')
-    @patch('active_orders_api.etree.tostring')
-    @patch('active_orders_api.parse_xml')
-    def test_get_transactions_today_success(self, mock_parse_xml, mock_etree_tostring, mock_controller, mock_request, mock_merchant_auth):
-        # Mock the merchant authentication
-        mock_merchant_auth_instance = mock_merchant_auth.return_value
-        mock_merchant_auth_instance.name = "mock_api_id"
-        mock_merchant_auth_instance.transactionKey = "mock_transaction_key"
-
-        # Mock the request
-        mock_request_instance = mock_request.return_value
-        mock_request_instance.merchantAuthentication = mock_merchant_auth_instance
-        mock_request_instance.customerProfileId = "12345"
-
-        # Mock the controller
-        mock_controller_instance = mock_controller.return_value
-        mock_controller_instance.getresponse.return_value = MagicMock()
-        mock_controller_instance.getresponse.return_value.messages.resultCode = "Ok"
-
-        # Mock the XML response
-        mock_etree_tostring.return_value = b'<transactions><transaction><submitTimeUTC>2024-07-03T12:00:00.000Z</submitTimeUTC></transaction></transactions>'
-        mock_parse_xml.return_value = {
-            'transactions': {
-                'transaction': [
-                    {'submitTimeUTC': '2024-07-03T12:00:00.000Z'}
-                ]
-            }
-        }
+    def setUp(self):
+        now = datetime.utcnow()
+        self.today = now.strftime("%Y-%m-%dT%H:%M:%S.123Z")
+        self.yesterday = (now - timedelta(days=1)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        self.gateway = None
 
-        # Call the function
-        response = get_transactions_today("12345")
+        self.state_dir = tempfile.TemporaryDirectory()
+        ledger = TransactionLedger(os.path.join(self.state_dir.name, "transactions.sqlite3"), 3600, 30)
+        self.ledger_patch = patch('active_orders_api.transaction_ledger', ledger)
+        self.ledger_patch.start()
 
-        # Assert the result
-        self.assertEqual(len(response), 1)
-        self.assertEqual(response[0]['submitTimeUTC'], '2024-07-03T12:00:00.000Z')
+    def tearDown(self):
+        self.ledger_patch.stop()
+        self.state_dir.cleanup()
+        if self.gateway is not None:
+            self.gateway.stop()
 
-    @patch('active_orders_api.apicontractsv1.merchantAuthenticationType')
-    @patch('active_orders_api.apicontractsv1.getTransactionListForCustomerRequest')
-    @patch('active_orders_api.getTransactionListForCustomerController')
-    def test_get_transactions_today_error_fetching(self, mock_controller, mock_request, mock_merchant_auth):
-        # Mock the merchant authentication
-        mock_merchant_auth_instance = mock_merchant_auth.return_value
+    def make_client(self, respond, max_concurrency=4, delay=0):
+        self.gateway = GatewayStub(respond, delay=delay)
+        return AuthorizeNetClient(self.gateway.url, "mock_api_id", "mock_transaction_key", max_concurrency, timeout=5)
 
-        # Mock the request
-        mock_request_instance = mock_request.return_value
+    def test_get_transactions_today_success(self):
+        transactions = [
+            {"transId": "2", "submitTimeUTC": self.today, "settleAmount": 12.5},
+            {"transId": "1", "submitTimeUTC": self.yesterday, "settleAmount": 30}
+        ]
+        client = self.make_client(lambda body: gateway_response(transactions))
 
-        # Mock the controller
-        mock_controller_instance = mock_controller.return_value
-        mock_controller_instance.getresponse.return_value = MagicMock()
-        mock_controller_instance.getresponse.return_value.messages.resultCode = "Error"
+        with patch('active_orders_api.authorizenet_client', client):
+            response = asyncio.run(get_transactions_today("12345"))
 
-        # Call the function and assert it raises an HTTPException
-        with self.assertRaises(HTTPException) as context:
-            get_transactions_today("12345")
+        self.assertEqual(response, [{"transId": "2", "submitTimeUTC": self.today, "settleAmount": 12.5}])
+
+        request = self.gateway.requests[0]["getTransactionListForCustomerRequest"]
+        self.assertEqual(list(request), ["merchantAuthentication", "customerProfileId", "sorting", "paging"])
+        self.assertEqual(request["merchantAuthentication"], {"name": "mock_api_id", "transactionKey": "mock_transaction_key"})
+        self.assertEqual(request["customerProfileId"], "12345")
+
+    def test_get_transactions_today_error_fetching(self):
+        error = {"messages": {"resultCode": "Error", "message": [{"code": "E00040", "text": "The record cannot be found."}]}}
+        client = self.make_client(lambda body: error)
+
+        with patch('active_orders_api.authorizenet_client', client):
+            with self.assertRaises(HTTPException) as context:
+                asyncio.run(get_transactions_today("12345"))
 
         self.assertEqual(context.exception.status_code, 500)
-        self.assertEqual(context.exception.detail, "500: Error fetching transactions")
+        self.assertEqual(context.exception.detail, "Error fetching transactions")
 
-    @patch('active_orders_api.apicontractsv1.merchantAuthenticationType')
-    @patch('active_orders_api.apicontractsv1.getTransactionListForCustomerRequest')
-    @patch('active_orders_api.getTransactionListForCustomerController')
-    def test_get_transactions_today_exception(self, mock_controller, mock_request, mock_merchant_auth):
-        # Mock the merchant authentication
-        mock_merchant_auth_instance = mock_merchant_auth.return_value
+    def test_ledger_reads_run_off_the_event_loop(self):
+        ledger = TransactionLedger(os.path.join(self.state_dir.name, "transactions.sqlite3"), 3600, 30)
+        ledger.store("12345", [], time.time())
+        threads = []
 
-        # Mock the request
-        mock_request_instance = mock_request.return_value
+        def recording(method):
+            def call(*args):
+                threads.append(threading.get_ident())
+                return method(*args)
+            return call
 
-        # Mock the controller to raise an exception
-        mock_controller.side_effect = Exception("Some error")
+        with patch.object(ledger, 'register', recording(ledger.register)), \
+                patch.object(ledger, 'transactions', recording(ledger.transactions)), \
+                patch('active_orders_api.transaction_ledger', ledger):
+            self.assertEqual(asyncio.run(get_transactions_today("12345")), [])
+            self.assertEqual(asyncio.run(get_transactions_range("12345", start=datetime.utcnow().date()))["transactions"], [])
 
-        # Call the function and assert it raises an HTTPException
-        with self.assertRaises(HTTPException) as context:
-            get_transactions_today("12345")
+        self.assertEqual(len(threads), 4)
+        self.assertNotIn(threading.get_ident(), threads)
 
-        self.assertEqual(context.exception.status_code, 500)
-        self.assertEqual(context.exception.detail, "Some error")
+    def test_pages_until_older_than_today(self):
+        pages = {
+            1: [{"transId": "4", "submitTimeUTC": self.today}, {"transId": "3", "submitTimeUTC": self.today}],
+            2: [{"transId": "2", "submitTimeUTC": self.today}, {"transId": "1", "submitTimeUTC": self.yesterday}],
+            3: [{"transId": "0", "submitTimeUTC": self.yesterday}]
+        }
+
+        def respond(body):
+            offset = body["getTransactionListForCustomerRequest"]["paging"]["offset"]
+            return dict(gateway_response(pages[offset]), totalNumInResultSet=5)
+
+        client = self.make_client(respond)
+        since = datetime.combine(datetime.utcnow().date(), datetime.min.time())
+        transactions = asyncio.run(client.get_customer_transactions_since("12345", since, page_size=2))
+
+        self.assertEqual([transaction["transId"] for transaction in transactions], ["4", "3", "2"])
+        self.assertEqual(len(self.gateway.requests), 2)
+
+    def test_keep_alive_and_concurrency_limit(self):
+        client = self.make_client(lambda body: gateway_response([]), max_concurrency=2, delay=0.05)
+
+        async def fetch_all():
+            results = await asyncio.gather(*(client.get_customer_transactions(str(i)) for i in range(6)))
+            await client.aclose()
+            return results
+
+        results = asyncio.run(fetch_all())
+
+        self.assertEqual(results, [([], 0)] * 6)
+        self.assertEqual(self.gateway.max_in_flight, 2)
+        # Six requests over the two pooled keep-alive connections
+        self.assertEqual(len(self.gateway.client_ports), 2)
+
+
+class TestTransactionLedger(unittest.TestCase):
+
+    def setUp(self):
+        self.state_dir = tempfile.TemporaryDirectory()
+        self.ledger = TransactionLedger(os.path.join(self.state_dir.name, "transactions.sqlite3"), 3600, 30)
+        self.client = MagicMock()
+        self.client.get_customer_transactions_since = AsyncMock()
+
+        self.now = datetime.utcnow().replace(microsecond=0)
+        self.yesterday = self.now - timedelta(days=1)
+
+    def tearDown(self):
+        self.state_dir.cleanup()
+
+    def transaction(self, trans_id, submitted, status="capturedPendingSettlement"):
+        return {"transId": trans_id, "submitTimeUTC": submitted.strftime("%Y-%m-%dT%H:%M:%SZ"), "transactionStatus": status}
+
+    @patch('active_orders_api.time.time')
+    def test_register_only_writes_when_requested_at_is_stale(self, mock_time):
+        def requested_at():
+            with self.ledger._connect() as connection:
+                return connection.execute("SELECT requested_at FROM customers WHERE customer_id = '42'").fetchone()[0]
+
+        mock_time.return_value = 1000
+        self.assertIsNone(self.ledger.register("42"))
+        mock_time.return_value = 1000 + TransactionLedger.REQUEST_REFRESH - 1
+        self.ledger.register("42")
+        self.assertEqual(requested_at(), 1000)
+
+        mock_time.return_value = 1000 + TransactionLedger.REQUEST_REFRESH
+        self.ledger.register("42")
+        self.assertEqual(requested_at(), 1000 + TransactionLedger.REQUEST_REFRESH)
+
+    def test_sync_is_incremental(self):
+        self.ledger.register("42")
+        self.client.get_customer_transactions_since.return_value = [self.transaction("2", self.now), self.transaction("1", self.yesterday)]
+        asyncio.run(self.ledger.sync(self.client, 0))
+
+        # First sync pulls the full history, the next one only since the newest transaction less the overlap
+        self.assertEqual(self.client.get_customer_transactions_since.call_args_list[0].args, ("42", datetime.min))
+
+        self.client.get_customer_transactions_since.return_value = [self.transaction("2", self.now, "settledSuccessfully")]
+        asyncio.run(self.ledger.sync(self.client, 0))
+
+        self.assertEqual(self.client.get_customer_transactions_since.call_args_list[1].args, ("42", self.now - timedelta(hours=1)))
+        self.assertEqual(self.ledger.transactions("42", self.yesterday), [
+            self.transaction("2", self.now, "settledSuccessfully"),
+            self.transaction("1", self.yesterday)
+        ])
+        self.assertEqual(self.ledger.stats["customersSynced"], 2)
+
+    def test_sync_skips_recently_synced_customers(self):
+        self.ledger.register("42")
+        self.client.get_customer_transactions_since.return_value = []
+
+        asyncio.run(self.ledger.sync(self.client, 300))
+        asyncio.run(self.ledger.sync(self.client, 300))
+
+        self.assertEqual(self.client.get_customer_transactions_since.call_count, 1)
+
+    def test_transactions_today_served_from_fresh_ledger(self):
+        self.ledger.store("42", [self.transaction("2", self.now), self.transaction("1", self.yesterday)], time.time())
+        response = Response()
+
+        with patch('active_orders_api.transaction_ledger', self.ledger):
+            transactions = asyncio.run(get_transactions_today("42", response))
+
+        self.assertEqual(transactions, [self.transaction("2", self.now)])
+        self.assertEqual(response.headers["X-Transactions-Source"], "ledger")
+        self.assertIn("X-Transactions-Synced-At", response.headers)
+
+    def test_range_syncs_unknown_customer(self):
+        self.client.get_customer_transactions_since.return_value = [self.transaction("2", self.now), self.transaction("1", self.yesterday)]
+
+        with patch('active_orders_api.transaction_ledger', self.ledger), patch('active_orders_api.authorizenet_client', self.client):
+            result = asyncio.run(get_transactions_range("42", self.yesterday.date(), self.yesterday.date()))
+
+        self.assertEqual(result["transactions"], [self.transaction("1", self.yesterday)])
+        self.assertFalse(result["stale"])
+        self.client.get_customer_transactions_since.assert_called_once_with("42", datetime.min)
+
+
+class TestAdmissionControl(unittest.TestCase):
+
+    def test_sheds_when_queue_is_full(self):
+        async def scenario():
+            queue = AdmissionQueue(1, 1, 1)
+            await queue.acquire()
+            waiting = asyncio.ensure_future(queue.acquire())
+            await asyncio.sleep(0)
+
+            with self.assertRaises(AdmissionRejected):
+                await queue.acquire()
+
+            queue.release()
+            await waiting
+            return queue.metrics()
+
+        metrics = asyncio.run(scenario())
+        self.assertEqual(metrics["active"], 1)
+        self.assertEqual(metrics["waiting"], 0)
+        self.assertEqual((metrics["admitted"], metrics["queued"], metrics["shed"]), (2, 1, 1))
+
+    def test_gives_up_after_queue_timeout(self):
+        async def scenario():
+            queue = AdmissionQueue(1, 1, 0.05)
+            await queue.acquire()
+            with self.assertRaises(AdmissionRejected):
+                await queue.acquire()
+            queue.release()
+            return queue.metrics()
+
+        metrics = asyncio.run(scenario())
+        self.assertEqual((metrics["active"], metrics["waiting"], metrics["timedOut"]), (0, 0, 1))
+
+    def test_higher_priority_admitted_first(self):
+        async def scenario():
+            queue = AdmissionQueue(1, 4, 1)
+            order = []
+            await queue.acquire()
+
+            async def wait(name, priority):
+                await queue.acquire(priority)
+                order.append(name)
+                queue.release()
+
+            waiters = [asyncio.ensure_future(wait("bulk", 3)), asyncio.ensure_future(wait("interactive", 1))]
+            await asyncio.sleep(0)
+            queue.release()
+            await asyncio.gather(*waiters)
+            return order
+
+        self.assertEqual(asyncio.run(scenario()), ["interactive", "bulk"])
+
+    def test_middleware_sheds_reports_but_not_health(self):
+        controller = AdmissionControl({
+            "/health": ("critical", None, 0, 0),
+            "/accounts": ("reports", 1, 0, 1)
+        }, 4, ("critical", "interactive", "reports"))
+
+        async def scenario():
+            release = asyncio.Event()
+
+            async def endpoint(scope, receive, send):
+                if scope["path"] == "/accounts":
+                    await release.wait()
+                await JSONResponse({"path": scope["path"]})(scope, receive, send)
+
+            transport = httpx.ASGITransport(app=AdmissionMiddleware(endpoint, controller))
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                slow = asyncio.ensure_future(client.get("/accounts"))
+                await asyncio.sleep(0.01)
+
+                shed = await client.get("/accounts")
+                health = await client.get("/health")
+                release.set()
+                return shed, health, await slow
+
+        shed, health, slow = asyncio.run(scenario())
+
+        self.assertEqual(shed.status_code, 503)
+        self.assertEqual(shed.headers["Retry-After"], "1")
+        self.assertEqual(health.status_code, 200)
+        self.assertEqual(slow.status_code, 200)
+        self.assertEqual(controller.metrics()["routes"]["/accounts"]["shed"], 1)
 
 
 class TestGetActiveAccounts(unittest.TestCase):
@@ -166,6 +409,7 @@ class TestGetActiveAccounts(unittest.TestCase):
         self.assertEqual(context.exception.status_code, 500)
         self.assertEqual(context.exception.detail, "Internal server error")
     
+    @patch('active_orders_api.profile_cache', ProfileCache(max_size=100, ttl=60))
     @patch('active_orders_api.get_db_connection')
     def test_get_active_accounts(self, mock_get_db_connection):
         mock_connection = MagicMock()
@@ -213,9 +457,10 @@ class TestGetActiveAccounts(unittest.TestCase):
                 mock_cursor.fetchall.return_value = profile_ids_from_carts
             elif "FROM ylift_api.carts" in query and "cartItems" in query:
                 mock_cursor.fetchall.return_value = profile_ids_from_items
+            elif "MAX(updatedAt) FROM ylift_api.profiles" in query:
+                mock_cursor.fetchone.return_value = (datetime(2023, 7, 1, 9, 0, 0),)
             elif "FROM ylift_api.profiles" in query:
-                profile_id = params[0]
-                mock_cursor.fetchone.return_value = profile_data.get(profile_id)
+                mock_cursor.fetchall.return_value = [(profile_id, *profile_data[profile_id]) for profile_id in params if profile_id in profile_data]
             elif "FROM ylift_api.orders" in query and "JOIN ylift_api.profiles" not in query:
                 profile_id = params[0]
                 mock_cursor.fetchone.return_value = order_data.get(profile_id)
@@ -393,5 +638,1095 @@ class TestGetActiveCarts(unittest.TestCase):
         self.assertEqual(result, expected_active_carts)
 
 
+class TestTodayHotSet(unittest.TestCase):
+
+    def setUp(self):
+        _, self.day_start, _ = store_day()
+        self.now = datetime.utcnow().replace(microsecond=0)
+        self.before_today = self.day_start - timedelta(hours=2)
+
+        self.carts = [
+            (1, 10, self.before_today, self.now),
+            (2, 20, self.before_today, self.before_today),
+            (3, 30, self.before_today, self.before_today)
+        ]
+        self.items = [(100, 2, self.now)]
+
+        self.cursor = MagicMock()
+        self.queries = []
+
+        def mock_execute(query, params=None):
+            self.queries.append(query)
+            if "MAX(updatedAt)" in query:
+                self.cursor.fetchone.return_value = (max(cart[3] for cart in self.carts),)
+            elif "FROM ylift_api.carts" in query and "id IN" in query:
+                self.cursor.fetchall.return_value = [cart for cart in self.carts if cart[0] in params]
+            elif "FROM ylift_api.carts" in query:
+                self.cursor.fetchall.return_value = [cart for cart in self.carts if cart[3] >= params[0]]
+            elif "FROM ylift_api.cartItems" in query:
+                self.cursor.fetchall.return_value = [item for item in self.items if item[2] >= params[0]]
+
+        self.cursor.execute.side_effect = mock_execute
+        connection = MagicMock()
+        connection.cursor.return_value = self.cursor
+        self.db_patch = patch('active_orders_api.get_db_connection', return_value=connection)
+        self.db_patch.start()
+
+    def tearDown(self):
+        self.db_patch.stop()
+
+    def test_views_after_load(self):
+        hot_set = TodayHotSet(5, 900, 60)
+        self.assertFalse(hot_set.is_ready())
+        hot_set.refresh()
+        self.assertTrue(hot_set.is_ready())
+
+        self.assertEqual(hot_set.active_carts(), [ActiveCart(profileId=10, createdAt=self.before_today, updatedAt=self.now)])
+        # Cart 2 wasn't updated today, but one of its items was
+        self.assertEqual(sorted(hot_set.active_profile_ids()), [10, 20])
+        self.assertEqual(hot_set.cart_item_counts(), {20: 1})
+        self.assertEqual(hot_set.hourly_cart_counts(), {self.now.hour: 1})
+        self.assertEqual(hot_set.store_activity(self.now - timedelta(hours=1)), (self.now, self.now, 2))
+
+    def test_refresh_reads_from_watermark(self):
+        hot_set = TodayHotSet(5, 900, 60, overlap=0)
+        hot_set.refresh()
+        self.queries.clear()
+
+        later = self.now + timedelta(seconds=1)
+        self.carts[2] = (3, 30, self.before_today, later)
+        hot_set.refresh()
+
+        self.assertFalse(any("MAX(updatedAt)" in query for query in self.queries))
+        self.assertEqual([cart.profileId for cart in hot_set.active_carts()], [10, 30])
+        self.assertEqual(hot_set.store_activity(self.now - timedelta(hours=1))[0], later)
+        self.assertEqual((hot_set.stats["reloads"], hot_set.stats["refreshes"]), (1, 1))
+
+    def test_endpoint_skips_database_when_ready(self):
+        hot_set = TodayHotSet(5, 900, 60)
+        hot_set.refresh()
+
+        with patch('active_orders_api.today_hot_set', hot_set), patch('active_orders_api.get_db_connection') as mock_get_db_connection:
+            result = inspect.unwrap(get_active_carts)(api_key=API_KEY)
+
+        mock_get_db_connection.assert_not_called()
+        self.assertEqual([cart.profileId for cart in result], [10])
+
+
+SAMPLE_DUMP = b"""-- MySQL dump
+/*!40101 SET NAMES utf8mb4 */;
+DROP TABLE IF EXISTS `carts`;
+CREATE TABLE `carts` (
+  `id` int NOT NULL AUTO_INCREMENT,
+  `profileId` int DEFAULT NULL,
+  `token` varchar(64) NOT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `token` (`token`),
+  KEY `profileId` (`profileId`),
+  CONSTRAINT `carts_ibfk_1` FOREIGN KEY (`profileId`) REFERENCES `profiles` (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+INSERT INTO `carts` VALUES (1,10,'a'),(2,20,'b');
+--
+-- Dumping routines for database 'ylift_api'
+--
+DELIMITER ;;
+CREATE PROCEDURE `noop`() BEGIN END ;;
+DELIMITER ;
+/*!40103 SET TIME_ZONE=@OLD_TIME_ZONE */;
+"""
+
+
+class TestRestore(unittest.TestCase):
+
+    def setUp(self):
+        self.backup_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.backup_dir.cleanup()
+
+    def test_defer_indexes_and_routines(self):
+        transform = restore.DumpTransform(defer_indexes=True, keep_routines=True)
+        output = b"".join(transform.feed(line) for line in io.BytesIO(SAMPLE_DUMP))
+
+        self.assertIn(b"  `token` varchar(64) NOT NULL,\n  PRIMARY KEY (`id`)\n) ENGINE=InnoDB", output)
+        self.assertNotIn(b"KEY `profileId`", output)
+        self.assertNotIn(b"PROCEDURE", output)
+        self.assertIn(b"/*!40103 SET TIME_ZONE=@OLD_TIME_ZONE */;", output)
+
+        self.assertEqual(transform.alter_statements(), [
+            "ALTER TABLE `carts` ADD UNIQUE KEY `token` (`token`), ADD KEY `profileId` (`profileId`), "
+            "ADD CONSTRAINT `carts_ibfk_1` FOREIGN KEY (`profileId`) REFERENCES `profiles` (`id`)"
+        ])
+        self.assertIn(b"CREATE PROCEDURE `noop`() BEGIN END ;;\n", transform.routines)
+
+    def test_restore_verifies_row_counts(self):
+        with gzip.open(os.path.join(self.backup_dir.name, "carts.sql.gz"), "wb") as f:
+            f.write(SAMPLE_DUMP)
+        with open(os.path.join(self.backup_dir.name, "orders.sql"), "wb") as f:
+            f.write(SAMPLE_DUMP.replace(b"`carts`", b"`orders`"))
+        with open(os.path.join(self.backup_dir.name, "manifest.json"), "w") as f:
+            json.dump({"tables": {"carts": {"file": "carts.sql.gz", "rows": 2}, "orders": {"file": "orders.sql", "rows": 5}}}, f)
+
+        piped = []
+        cursor = MagicMock()
+        cursor.fetchone.return_value = (2,)
+        target = {"host": "restore_host", "user": "user", "password": "password", "database": "ylift_restore"}
+
+        with patch("restore.pipe_to_mysql", side_effect=lambda command, chunks: piped.append(b"".join(chunks))), \
+             patch("restore.mysql.connector.connect") as mock_connect:
+            mock_connect.return_value.cursor.return_value = cursor
+            results, elapsed = restore.restore(restore.find_dumps(self.backup_dir.name), target, jobs=2, report=lambda line: None)
+
+        self.assertEqual({result["table"]: result["status"] for result in results}, {"carts": "ok", "orders": "mismatch"})
+        # Each table in its own session, decompressed, with checks off; routines restored once afterwards
+        table_loads = [load for load in piped if load.startswith(restore.SESSION_PROLOGUE)]
+        self.assertEqual(len(table_loads), 2)
+        self.assertTrue(all(b"INSERT INTO" in load and load.endswith(restore.SESSION_EPILOGUE) for load in table_loads))
+        self.assertEqual(sum(b"CREATE PROCEDURE" in load for load in piped), 1)
+        self.assertIn("orders", restore.format_report(results, elapsed))
+
+    def test_routines_restored_when_their_table_is_not(self):
+        with open(os.path.join(self.backup_dir.name, "carts.sql"), "wb") as f:
+            f.write(SAMPLE_DUMP + b"-- padding\n" * 100)
+        with open(os.path.join(self.backup_dir.name, "orders.sql"), "wb") as f:
+            f.write(SAMPLE_DUMP.replace(b"`carts`", b"`orders`"))
+
+        def pipe(command, chunks):
+            load = b"".join(chunks)
+            if b"`carts`" in load:
+                raise RuntimeError("ERROR 1064 (42000)")
+            piped.append(load)
+
+        # The smallest dump's table (orders) is either failing or not picked
+        for tables in (None, ["carts"]):
+            piped = []
+            with patch("restore.pipe_to_mysql", side_effect=pipe), patch("restore.mysql.connector.connect") as mock_connect:
+                mock_connect.return_value.cursor.return_value.fetchone.return_value = (2,)
+                results, _ = restore.restore(restore.find_dumps(self.backup_dir.name), {"host": "h", "user": "u", "password": "p", "database": "d"},
+                                             tables=tables, report=lambda line: None)
+
+            self.assertEqual([result["status"] for result in results if result["table"] == "carts"], ["failed"])
+            self.assertEqual(sum(b"CREATE PROCEDURE" in load for load in piped), 1)
+
+    def test_row_count_mismatch_is_only_a_warning(self):
+        results = [
+            {"table": "carts", "bytes": 10, "rows": 2, "expectedRows": 2, "status": "ok"},
+            {"table": "orders", "bytes": 10, "rows": 6, "expectedRows": 5, "status": "mismatch"}
+        ]
+        output = io.StringIO()
+
+        with patch("restore.find_dumps", return_value={}), patch("restore.mysql.connector.connect"), \
+                patch("restore.restore", return_value=(results, 1.0)) as mock_restore, patch("sys.stdout", output):
+            self.assertEqual(restore.main([self.backup_dir.name, "--database", "ylift_restore"]), 0)
+            results.append({"table": "items", "bytes": 10, "expectedRows": 1, "status": "failed", "error": "boom"})
+            self.assertEqual(restore.main([self.backup_dir.name, "--database", "ylift_restore"]), 1)
+
+        self.assertEqual(mock_restore.call_count, 2)
+        self.assertIn("Warning: row counts differ from the manifest for orders", output.getvalue())
+
+
+class TestChunkStore(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.store = ChunkStore(self.root.name, min_size=1024, avg_size=4096, max_size=16384)
+        self.data = np.random.default_rng(7).integers(0, 256, size=200000, dtype=np.uint8).tobytes()
+
+    def tearDown(self):
+        self.root.cleanup()
+
+    def test_boundaries_survive_insertions(self):
+        chunks = list(chunk_stream(io.BytesIO(self.data), 1024, 4096, 16384, read_size=10000))
+
+        self.assertEqual(b"".join(chunks), self.data)
+        self.assertTrue(all(1024 <= len(chunk) <= 16384 for chunk in chunks[:-1]))
+        # Reading in different block sizes doesn't move the boundaries
+        self.assertEqual(chunks, list(chunk_stream(io.BytesIO(self.data), 1024, 4096, 16384)))
+
+        edited = self.data[:100000] + b"INSERT" + self.data[100000:]
+        edited_chunks = list(chunk_stream(io.BytesIO(edited), 1024, 4096, 16384))
+        self.assertLessEqual(len(set(edited_chunks) - set(chunks)), 2)
+
+    def test_snapshots_dedupe_and_gc(self):
+        for name in ("2024/Jul03_12PM", "2024/Jul03_2PM"):
+            entry, stats = self.store.add_stream(io.BytesIO(self.data))
+            self.store.commit_snapshot(name, {"tables": {"carts": {"file": "carts.sql", "rows": 2, **entry, **stats}}})
+
+        first = self.store.snapshot("2024/Jul03_12PM")["tables"]["carts"]
+        second = self.store.snapshot("2024/Jul03_2PM")["tables"]["carts"]
+        self.assertGreater(first["bytesWritten"], 0)
+        self.assertEqual((second["newChunks"], second["bytesWritten"]), (0, 0))
+
+        with self.store.open_table("2024/Jul03_2PM", "carts") as dump:
+            self.assertEqual(dump.read(), self.data)
+
+        entry, stats = self.store.add_stream(io.BytesIO(b"x" * 5000))
+        self.store.commit_snapshot("2024/Jul03_4PM", {"tables": {"carts": {"file": "carts.sql", "rows": 0, **entry, **stats}}})
+
+        removed = self.store.gc(keep=1)
+        self.assertEqual(removed["snapshots"], ["2024/Jul03_12PM", "2024/Jul03_2PM"])
+        self.assertEqual(self.store.snapshots(), ["2024/Jul03_4PM"])
+        self.assertEqual(self.store.usage()["chunks"], len(set(entry["chunks"])))
+
+
+class TestScheduler(unittest.TestCase):
+
+    def test_cron_next_after(self):
+        now = datetime(2024, 7, 3, 14, 7, 30)  # a Wednesday
+        self.assertEqual(CronSchedule("*/10 * * * *").next_after(now), datetime(2024, 7, 3, 14, 10))
+        self.assertEqual(CronSchedule("5 * * * *").next_after(now), datetime(2024, 7, 3, 15, 5))
+        self.assertEqual(CronSchedule("30 2 * * 1-5").next_after(now), datetime(2024, 7, 4, 2, 30))
+        self.assertEqual(CronSchedule("0 0 * * 0").next_after(now), datetime(2024, 7, 7, 0, 0))
+        self.assertEqual(CronSchedule("0 6 1 1,7 *").next_after(now), datetime(2025, 1, 1, 6, 0))
+        self.assertEqual(CronSchedule("0 0 29 2 *").next_after(now), datetime(2028, 2, 29, 0, 0))
+        # Either day field matches when both are restricted
+        self.assertEqual(CronSchedule("0 0 15 * 5").next_after(now), datetime(2024, 7, 5, 0, 0))
+
+        for expression in ("* * * *", "60 * * * *", "*/0 * * * *", "5-1 * * * *"):
+            with self.assertRaises(ValueError):
+                CronSchedule(expression)
+
+    def test_schedule_jobs(self):
+        scheduler = Scheduler(MagicMock(), jitter=0, history_size=5)
+        schedule_jobs(scheduler, {**DEFAULT_SCHEDULED_JOBS, "backup": None, "sales_rollup": "0 3 * * *"})
+
+        self.assertEqual(set(scheduler.jobs), set(DEFAULT_SCHEDULED_JOBS) - {"backup"})
+        self.assertEqual(scheduler.jobs["sales_rollup"].status()["schedule"], "0 3 * * *")
+
+        with self.assertRaises(ValueError) as context:
+            schedule_jobs(Scheduler(MagicMock(), jitter=0, history_size=5), {"bakcup": "* * * * *"})
+        self.assertIn("bakcup", str(context.exception))
+
+    def test_overlapping_runs_are_skipped(self):
+        release = threading.Event()
+        scheduler = Scheduler(MagicMock(try_acquire=MagicMock(return_value=True)), jitter=0, history_size=5)
+        start = datetime(2024, 7, 3, 14, 0, 30)
+        scheduler.add("slow", "* * * * *", release.wait, now=start)
+
+        [first] = scheduler.run_pending(start + timedelta(minutes=1))
+        self.assertEqual(scheduler.run_pending(start + timedelta(minutes=2)), [])
+        release.set()
+        first.result(timeout=5)
+
+        status = scheduler.status()["jobs"]["slow"]
+        self.assertEqual((status["runs"], status["skippedOverlap"]), (1, 1))
+        self.assertEqual(status["nextRun"], "2024-07-03T14:03:00")
+        self.assertEqual(status["history"][0]["status"], "ok")
+
+    def test_leader_only_jobs_and_errors(self):
+        leader_election = MagicMock(try_acquire=MagicMock(return_value=False), is_leader=False)
+        scheduler = Scheduler(leader_election, jitter=0, history_size=5)
+        start = datetime(2024, 7, 3, 14, 0, 30)
+        leader_job = MagicMock()
+        scheduler.add("backup", "* * * * *", leader_job, now=start)
+        scheduler.add("warmer", "* * * * *", MagicMock(side_effect=RuntimeError("boom")), leader_only=False, now=start)
+
+        for future in scheduler.run_pending(start + timedelta(minutes=1)):
+            future.result(timeout=5)
+
+        leader_job.assert_not_called()
+        jobs = scheduler.status()["jobs"]
+        self.assertEqual(jobs["backup"]["runs"], 0)
+        self.assertEqual((jobs["warmer"]["runs"], jobs["warmer"]["errors"]), (1, 1))
+        self.assertEqual(jobs["warmer"]["history"][0]["error"], "boom")
+
+
+class TestSalesRollup(unittest.TestCase):
+
+    def setUp(self):
+        self.state_dir = tempfile.TemporaryDirectory()
+        self.rollup = SalesRollup(os.path.join(self.state_dir.name, "sales_rollup.json"), recheck_days=7)
+
+    def tearDown(self):
+        self.state_dir.cleanup()
+
+    def test_refresh_and_total(self):
+        cursor = MagicMock()
+        cursor.fetchall.return_value = [(date(2024, 7, 1), 1000), (date(2024, 7, 2), 2500)]
+        self.rollup.refresh(cursor, date(2024, 7, 3))
+
+        self.assertEqual(cursor.execute.call_args[0][1], (date(2023, 1, 1), date(2024, 7, 2)))
+        self.assertEqual(self.rollup.total(date(2024, 7, 1), date(2024, 7, 2)), 3500)
+        self.assertIsNone(self.rollup.total(date(2024, 7, 1), date(2024, 7, 3)))
+
+        # Later runs only recompute the last few days
+        cursor.fetchall.return_value = [(date(2024, 7, 1), 1000), (date(2024, 7, 2), 3000), (date(2024, 7, 3), 500)]
+        self.rollup.refresh(cursor, date(2024, 7, 4))
+        self.assertEqual(cursor.execute.call_args[0][1], (date(2024, 6, 26), date(2024, 7, 3)))
+        self.assertEqual(self.rollup.total(date(2024, 7, 1), date(2024, 7, 3)), 4500)
+        self.assertIsNone(self.rollup.total(date(2022, 12, 31), date(2024, 7, 3)))
+
+    @patch('active_orders_api.datetime')
+    def test_report_sales_only_queries_today(self, mock_datetime):
+        mock_datetime.now.return_value = datetime(2024, 7, 3, 12, 0)
+        cursor = MagicMock()
+        cursor.fetchall.return_value = [(date(2024, 7, 1), 1000), (date(2024, 7, 2), 2500)]
+        self.rollup.refresh(cursor, date(2024, 7, 3))
+
+        cursor = MagicMock()
+        cursor.fetchone.return_value = (150,)
+        sales = report_sales(cursor, rollup=self.rollup)
+
+        self.assertEqual(cursor.execute.call_args[0][1], (date(2024, 7, 3), date(2024, 7, 7)))
+        self.assertEqual(sales, {"startDate": "2024-07-01", "endDate": "2024-07-07", "totalSales": "$36.50"})
+
+
+class TestPreparedStatements(unittest.TestCase):
+
+    def setUp(self):
+        self.statements = PreparedStatements(enabled=True)
+        self.sql = self.statements.register("orders.count", "SELECT COUNT(*) FROM ylift_api.orders WHERE profileId = %s")
+        self.connection = MagicMock(server_host="db", server_port=3306, connection_id=7, in_transaction=False)
+        self.connection.cursor.side_effect = lambda **kwargs: MagicMock(prepared=kwargs.get("prepared", False))
+
+    def test_statements_are_prepared_once_per_cursor(self):
+        # Two requests that get the same pooled connection, reset in between
+        for profile_ids in ((1, 2), (3,)):
+            cursor = self.statements.cursor(self.connection)
+            for profile_id in profile_ids:
+                cursor.execute("SELECT COUNT(*) FROM ylift_api.orders WHERE profileId = %s", (profile_id,))
+            cursor.execute("SELECT 1")
+            cursor.close()
+
+        prepared = [call for call in self.connection.cursor.call_args_list if call.kwargs.get("prepared")]
+        self.assertEqual(len(prepared), 2)
+        self.assertEqual(self.statements.metrics()["statements"]["orders.count"], {"executions": 3, "prepares": 2})
+
+    def test_prepared_cursor_runs_the_registered_string(self):
+        cursor = self.statements.cursor(self.connection)
+        cursor.execute("SELECT COUNT(*) FROM ylift_api.orders WHERE profileId = %s", (1,))
+        cursor.fetchone()
+
+        prepared_cursor = cursor._current
+        self.assertTrue(prepared_cursor.prepared)
+        self.assertIs(prepared_cursor.execute.call_args[0][0], self.sql)
+        prepared_cursor.fetchone.assert_called_once()
+
+    def test_close_leaves_the_connection_resettable(self):
+        cursor = self.statements.cursor(self.connection)
+        cursor.execute(self.sql, (1,))
+        prepared_cursor = cursor._current
+
+        self.connection.unread_result = True
+        cursor.close()
+        self.connection.consume_results.assert_called_once()
+        prepared_cursor.close.assert_called_once()
+
+        self.connection.unread_result = False
+        self.statements.cursor(self.connection).close()
+        self.connection.consume_results.assert_called_once()
+
+
+class TestLeaderElection(unittest.TestCase):
+
+    def setUp(self):
+        self.state_dir = tempfile.TemporaryDirectory()
+        self.lock_path = os.path.join(self.state_dir.name, "leader.lock")
+
+    def tearDown(self):
+        self.state_dir.cleanup()
+
+    def test_single_leader(self):
+        first = LeaderElection(self.lock_path)
+        second = LeaderElection(self.lock_path)
+
+        self.assertTrue(first.try_acquire())
+        self.assertFalse(second.try_acquire())
+        self.assertFalse(second.is_leader)
+
+        first.release()
+
+    def test_failover_after_release(self):
+        first = LeaderElection(self.lock_path)
+        second = LeaderElection(self.lock_path)
+
+        self.assertTrue(first.try_acquire())
+        first.release()
+
+        self.assertTrue(second.try_acquire())
+        self.assertFalse(first.try_acquire())
+
+        second.release()
+
+
+class TestSharedState(unittest.TestCase):
+
+    def setUp(self):
+        self.state_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.state_dir.name, "shared_state.bin")
+
+    def tearDown(self):
+        self.state_dir.cleanup()
+
+    def test_histogram_shared_between_instances(self):
+        writer = SharedState(self.path)
+        reader = SharedState(self.path)
+        today = datetime(2023, 7, 1).date()
+
+        counts = [0] * (7 * 24)
+        counts[0 * 24 + 9] = 4    # Monday 09:00
+        counts[0 * 24 + 10] = 2   # Monday 10:00
+        counts[4 * 24 + 17] = 1   # Friday 17:00
+        writer.publish_histogram(today, counts)
+
+        self.assertEqual(reader.calculation_date, today)
+        version, data = reader.read_histogram(activity_data_from_counts)
+        self.assertEqual(version, reader.version)
+        self.assertEqual(data, {
+            "Monday": {
+                "probability": 1.0,
+                "busy_hours": {"09:00 - 10:00": 1.0, "10:00 - 11:00": 0.5}
+            },
+            "Friday": {
+                "probability": 0.1667,
+                "busy_hours": {"17:00 - 18:00": 1.0}
+            }
+        })
+
+    def test_claim_backup_guard(self):
+        first = SharedState(self.path)
+        second = SharedState(self.path)
+        now = datetime(2023, 7, 1, 12, 0, 0)
+
+        self.assertIsNone(first.last_backup_time)
+        self.assertTrue(first.claim_backup(now, timedelta(hours=2)))
+        self.assertFalse(second.claim_backup(now + timedelta(hours=1), timedelta(hours=2)))
+        self.assertTrue(second.claim_backup(now + timedelta(hours=2), timedelta(hours=2)))
+        self.assertEqual(first.last_backup_time, now + timedelta(hours=2))
+
+    def test_failed_backup_releases_claim(self):
+        popen = subprocess.Popen
+
+        def failing_dump(cmd, **kwargs):
+            # Only mysqldump fails, gzip gets its partial output and succeeds
+            return popen('echo partial dump; exit 2' if kwargs.get("shell") else cmd, **kwargs)
+
+        state = SharedState(self.path)
+        for day, compress in enumerate((False, True), 1):
+            now = datetime(2023, 7, day, 12, 0, 0, 123456)
+
+            with tempfile.TemporaryDirectory() as backup_dir, \
+                    patch('active_orders_api.shared_state', state), \
+                    patch('active_orders_api.BACK_UP_LOC', backup_dir), \
+                    patch('active_orders_api.BACKUP_COMPRESS', compress), \
+                    patch('active_orders_api.backup_store', None), \
+                    patch('active_orders_api.db_router') as mock_router, \
+                    patch('active_orders_api.subprocess.Popen', failing_dump):
+                connection = MagicMock()
+                connection.cursor.return_value.fetchall.return_value = [("carts",)]
+                connection.cursor.return_value.fetchone.return_value = (3,)
+                mock_router.connect.return_value = (connection, {"host": "h", "user": "u", "password": "p", "database": "d"})
+                cwd = os.getcwd()
+
+                self.assertTrue(state.claim_backup(now, timedelta(hours=2)))
+                with self.assertRaises(BackupError):
+                    perform_claimed_backup(now)
+
+                self.assertEqual(os.getcwd(), cwd)
+                connection.cursor.return_value.close.assert_called_once()
+                connection.close.assert_called_once()
+                # No login file and no partial backup set left behind
+                year = str(datetime.now().year)
+                self.assertEqual(os.listdir(backup_dir), [year])
+                self.assertEqual(os.listdir(os.path.join(backup_dir, year)), [])
+
+            self.assertIsNone(state.last_backup_time)
+            self.assertTrue(state.claim_backup(now + timedelta(minutes=10), timedelta(hours=2)))
+
+    def test_failed_dump_into_store_is_not_committed(self):
+        state = SharedState(self.path)
+        now = datetime(2023, 7, 1, 12, 0, 0, 123456)
+        popen = subprocess.Popen
+
+        with tempfile.TemporaryDirectory() as backup_dir, tempfile.TemporaryDirectory() as store_dir:
+            store = ChunkStore(store_dir, min_size=1024, avg_size=4096, max_size=16384)
+            with patch('active_orders_api.shared_state', state), \
+                    patch('active_orders_api.BACK_UP_LOC', backup_dir), \
+                    patch('active_orders_api.backup_store', store), \
+                    patch('active_orders_api.db_router') as mock_router, \
+                    patch.object(store, 'gc') as mock_gc, \
+                    patch('active_orders_api.subprocess.Popen', lambda cmd, **kwargs: popen('echo partial dump; exit 2', **kwargs)):
+                connection = MagicMock()
+                connection.cursor.return_value.fetchall.return_value = [("carts",)]
+                connection.cursor.return_value.fetchone.return_value = (3,)
+                mock_router.connect.return_value = (connection, {"host": "h", "user": "u", "password": "p", "database": "d"})
+
+                self.assertTrue(state.claim_backup(now, timedelta(hours=2)))
+                with self.assertRaises(BackupError):
+                    perform_claimed_backup(now)
+
+            self.assertEqual(store.snapshots(), [])
+            mock_gc.assert_not_called()
+            connection.close.assert_called_once()
+            self.assertEqual(os.listdir(backup_dir), [])
+
+        self.assertIsNone(state.last_backup_time)
+        self.assertTrue(state.claim_backup(now + timedelta(minutes=10), timedelta(hours=2)))
+
+
+@patch('active_orders_api.DB_POOL_SIZE', 0)
+class TestReplicaRouter(unittest.TestCase):
+
+    primary = {"host": "primary", "user": "u", "password": "p", "database": "d"}
+    replica = {"host": "replica", "user": "u", "password": "p", "database": "d"}
+
+    def make_router(self):
+        return ReplicaRouter(self.primary, [self.replica], {"sales": "replica"}, max_lag=30, retry_after=60)
+
+    def make_connection(self, lag_status):
+        connection = MagicMock()
+        connection.cursor.return_value.fetchone.return_value = lag_status
+        return connection
+
+    @patch('active_orders_api.mysql.connector.connect')
+    def test_routes_to_replica(self, mock_connect):
+        mock_connect.return_value = self.make_connection({"Seconds_Behind_Source": 2})
+
+        connection, db_config = self.make_router().connect("sales")
+
+        self.assertIs(db_config, self.replica)
+        self.assertEqual(mock_connect.call_args.kwargs["host"], "replica")
+
+    @patch('active_orders_api.mysql.connector.connect')
+    def test_lag_check_is_cached(self, mock_connect):
+        router = ReplicaRouter(self.primary, [self.replica], {"sales": "replica"}, max_lag=30, retry_after=60, lag_check_interval=60)
+        connections = [self.make_connection({"Seconds_Behind_Source": 2}) for _ in range(3)]
+        mock_connect.side_effect = connections
+
+        for _ in range(3):
+            self.assertIs(router.connect("sales")[1], self.replica)
+
+        connections[0].cursor.return_value.execute.assert_called_once_with("SHOW REPLICA STATUS")
+        connections[1].cursor.assert_not_called()
+        connections[2].cursor.assert_not_called()
+
+    @patch('active_orders_api.mysql.connector.connect')
+    def test_unrouted_class_uses_primary(self, mock_connect):
+        connection, db_config = self.make_router().connect("carts")
+
+        self.assertIs(db_config, self.primary)
+        mock_connect.assert_called_once()
+        self.assertEqual(mock_connect.call_args.kwargs["host"], "primary")
+
+    @patch('active_orders_api.mysql.connector.connect')
+    def test_lagging_replica_falls_back_to_primary(self, mock_connect):
+        lagging = self.make_connection({"Seconds_Behind_Source": 120})
+        mock_connect.side_effect = [lagging, MagicMock()]
+
+        connection, db_config = self.make_router().connect("sales")
+
+        self.assertIs(db_config, self.primary)
+        lagging.close.assert_called_once()
+
+    @patch('active_orders_api.mysql.connector.connect')
+    def test_failed_replica_is_skipped_until_retry(self, mock_connect):
+        router = self.make_router()
+        mock_connect.side_effect = [mysql.connector.Error("down"), MagicMock()]
+
+        self.assertIs(router.connect("sales")[1], self.primary)
+
+        mock_connect.side_effect = None
+        mock_connect.reset_mock()
+        self.assertIs(router.connect("sales")[1], self.primary)
+        mock_connect.assert_called_once()
+        self.assertEqual(mock_connect.call_args.kwargs["host"], "primary")
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def make_breaker(self):
+        return CircuitBreaker("mysql", failure_threshold=3, failure_window=60, reset_timeout=30)
+
+    def test_opens_after_consecutive_failures(self):
+        breaker = self.make_breaker()
+
+        for _ in range(3):
+            breaker.before_call()
+            breaker.record_failure()
+
+        with self.assertRaises(CircuitOpenError) as context:
+            breaker.before_call()
+
+        self.assertEqual(context.exception.status_code, 503)
+        self.assertEqual(breaker.metrics()["state"], CircuitBreaker.OPEN)
+        self.assertEqual(breaker.metrics()["rejections"], 1)
+
+    def test_success_resets_failures(self):
+        breaker = self.make_breaker()
+
+        breaker.record_failure()
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_successful_queries_reset_failures(self):
+        breaker = self.make_breaker()
+        connection = MagicMock(server_host="db", server_port=3306, connection_id=1, in_transaction=False)
+
+        with patch('active_orders_api.db_thread_state') as thread_state:
+            thread_state.breaker = breaker
+            breaker.record_failure()
+            breaker.record_failure()
+            prepared_statements.cursor(connection).execute("SELECT 1")
+            breaker.record_failure()
+            breaker.record_failure()
+
+        # Three failures within the window, but never three in a row
+        self.assertEqual(breaker.metrics()["recentFailures"], 2)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_query_timeouts_are_not_dependency_failures(self):
+        timeout = mysql.connector.errors.get_mysql_exception(errorcode.ER_QUERY_TIMEOUT, "Query execution was interrupted", "HY000")
+        lost = mysql.connector.errors.OperationalError(errno=errorcode.CR_SERVER_LOST, msg="Lost connection")
+
+        self.assertFalse(is_dependency_failure(timeout))
+        self.assertTrue(is_dependency_failure(lost))
+
+    @patch('active_orders_api.time.monotonic')
+    def test_half_open_probe(self, mock_monotonic):
+        breaker = self.make_breaker()
+        mock_monotonic.return_value = 100
+        for _ in range(3):
+            breaker.record_failure()
+
+        # One probe is let through after the reset timeout, others still fail fast
+        mock_monotonic.return_value = 131
+        breaker.before_call()
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_call()
+
+        breaker.record_success(reset=False)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        breaker.before_call()
+
+    @patch('active_orders_api.time.monotonic')
+    def test_failed_probe_reopens(self, mock_monotonic):
+        breaker = self.make_breaker()
+        mock_monotonic.return_value = 100
+        for _ in range(3):
+            breaker.record_failure()
+
+        mock_monotonic.return_value = 131
+        breaker.before_call()
+        breaker.record_failure()
+
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_call()
+
+    @patch('active_orders_api.time.monotonic')
+    def test_cancelled_probe_lets_the_next_call_probe(self, mock_monotonic):
+        breaker = self.make_breaker()
+        mock_monotonic.return_value = 100
+        for _ in range(3):
+            breaker.record_failure()
+
+        mock_monotonic.return_value = 131
+        client = AuthorizeNetClient("http://127.0.0.1:9/", "mock_api_id", "mock_transaction_key", 1, timeout=1)
+        with patch('active_orders_api.get_circuit_breaker', return_value=breaker), \
+                patch('httpx.AsyncClient.post', AsyncMock(side_effect=asyncio.CancelledError)):
+            with self.assertRaises(asyncio.CancelledError):
+                asyncio.run(client.request("getTransactionListForCustomerRequest", {}))
+
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        breaker.before_call()
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def run_concurrently(self, flights, key, fn, count):
+        results = []
+        errors = []
+
+        def call():
+            try:
+                results.append(flights.do(key, fn))
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=call) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads, results, errors
+
+    def test_concurrent_calls_share_one_execution(self):
+        flights = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def slow_query():
+            calls.append(1)
+            release.wait(5)
+            return {"totalSales": "$1.00"}
+
+        threads, results, errors = self.run_concurrently(flights, ("get_sales", ()), slow_query, 5)
+        while flights.stats["executed"] + flights.stats["shared"] < 5:
+            threading.Event().wait(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{"totalSales": "$1.00"}] * 5)
+        self.assertEqual(flights.stats, {"executed": 1, "shared": 4})
+
+    def test_error_is_shared_and_not_kept(self):
+        flights = SingleFlight()
+        release = threading.Event()
+
+        def failing_query():
+            release.wait(5)
+            raise HTTPException(status_code=500, detail="Internal server error")
+
+        threads, results, errors = self.run_concurrently(flights, "key", failing_query, 3)
+        while flights.stats["executed"] + flights.stats["shared"] < 3:
+            threading.Event().wait(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(errors), 3)
+        self.assertEqual(flights.do("key", lambda: "fresh"), "fresh")
+
+
+    @patch('active_orders_api.request_flights', SingleFlight())
+    @patch('active_orders_api.get_db_connection')
+    @patch('active_orders_api.report_sales')
+    def test_joined_callers_skip_the_rate_limit(self, mock_report_sales, mock_get_db_connection):
+        from active_orders_api import get_sales, request_flights
+        release = threading.Event()
+
+        def slow_report(cursor, **kwargs):
+            release.wait(5)
+            return {"totalSales": "$1.00"}
+
+        mock_report_sales.side_effect = slow_report
+        results = []
+        # /sales allows 2 calls a minute; a limited caller would sleep instead of joining
+        with patch('ratelimit.decorators.time.sleep', side_effect=AssertionError("rate limited")):
+            threads = [threading.Thread(target=lambda: results.append(get_sales())) for _ in range(5)]
+            for thread in threads:
+                thread.start()
+            while request_flights.stats["executed"] + request_flights.stats["shared"] < 5:
+                threading.Event().wait(0.01)
+            release.set()
+            for thread in threads:
+                thread.join()
+
+        mock_report_sales.assert_called_once()
+        self.assertEqual(results, [{"totalSales": "$1.00"}] * 5)
+
+
+class TestActivityForecast(unittest.TestCase):
+
+    def test_constant_history(self):
+        weekly_counts = np.tile(np.arange(24, dtype=float), (4, 1))
+
+        expected, lower, upper = forecast_hour_of_week(weekly_counts, alpha=0.3)
+
+        np.testing.assert_allclose(expected, np.arange(24))
+        np.testing.assert_allclose(lower, np.arange(24))
+        np.testing.assert_allclose(upper, np.arange(24))
+
+    def test_recent_weeks_weigh_more(self):
+        weekly_counts = np.zeros((2, 24))
+        weekly_counts[1, 9] = 10  # only last week was busy at 09:00
+
+        expected, lower, upper = forecast_hour_of_week(weekly_counts, alpha=0.5)
+
+        self.assertAlmostEqual(expected[9], 10 / 1.5)
+        self.assertEqual(lower[9], 0)
+        self.assertGreater(upper[9], expected[9])
+
+    @patch('active_orders_api.activity_forecast', (None, None))
+    @patch('active_orders_api.get_db_connection')
+    def test_forecast_mode(self, mock_get_db_connection):
+        mock_cursor = mock_get_db_connection.return_value.cursor.return_value
+        # (day, hour_of_day, cart_count) in UTC: every hour of the last 9 weeks busy once
+        today = datetime.utcnow().date()
+        mock_cursor.fetchall.return_value = [(today - timedelta(days=days), hour, 1) for days in range(63) for hour in range(24)]
+
+        # Skip the rate limiter, the other tests already use up this minute's calls
+        result = inspect.unwrap(get_activity_probability)(api_key=API_KEY, forecast=True)
+
+        # Starts at the current UTC hour, like the ?current figures
+        now = datetime.utcnow()
+        self.assertEqual(result["weeks"], 8)
+        self.assertEqual(result["day"], store_day(now)[0].strftime("%A"))
+        self.assertEqual(next(iter(result["busy_hours"])), HOUR_LABELS[now.hour])
+        for band in result["busy_hours"].values():
+            self.assertEqual(band, {"expected": 1.0, "lower": 1.0, "upper": 1.0})
+
+
+    @patch('active_orders_api.activity_forecast', (None, None))
+    @patch('active_orders_api.STORE_TIMEZONE', 'Asia/Tokyo')
+    @patch('active_orders_api.FORECAST_WEEKS', 1)
+    @patch('active_orders_api.get_db_connection')
+    def test_forecast_follows_the_store_day(self, mock_get_db_connection):
+        mock_cursor = mock_get_db_connection.return_value.cursor.return_value
+        # Monday 2023-07-10 in Tokyo is 2023-07-09 15:00 to 2023-07-10 15:00 UTC, so the
+        # Monday before runs from 2023-07-02 15:00 UTC; 2023-07-03 16:00 UTC is already Tuesday
+        mock_cursor.fetchall.return_value = [(date(2023, 7, 2), 16, 5), (date(2023, 7, 3), 16, 7), (date(2023, 7, 3), 2, 3)]
+
+        expected, _, _ = calculate_activity_forecast(date(2023, 7, 10))
+
+        self.assertEqual(mock_cursor.execute.call_args[0][1], (datetime(2023, 7, 2, 15), datetime(2023, 7, 3, 15)))
+        self.assertEqual(expected[16], 5)
+        self.assertEqual(expected[2], 3)
+
+
+class TestProfileCache(unittest.TestCase):
+
+    def make_cursor(self, profiles, watermark):
+        cursor = MagicMock()
+        state = {"watermark": watermark, "updated": []}
+        cursor.queries = []
+
+        def mock_execute(query, params=None):
+            cursor.queries.append(query)
+            if "MAX(updatedAt)" in query:
+                cursor.fetchone.return_value = (state["watermark"],)
+            elif "updatedAt >" in query:
+                cursor.fetchall.return_value = [(profile_id,) for profile_id in state["updated"]]
+            elif "WHERE id IN" in query:
+                cursor.fetchall.return_value = [(profile_id, *profiles[profile_id]) for profile_id in params]
+
+        cursor.execute.side_effect = mock_execute
+        return cursor, state
+
+    def test_bulk_fill_then_hit(self):
+        profiles = {1: ("a@example.com", "A", "c1"), 2: ("b@example.com", "B", "c2")}
+        cursor, state = self.make_cursor(profiles, datetime(2023, 7, 1))
+        cache = ProfileCache(max_size=10, ttl=60)
+
+        self.assertEqual(cache.get_many(cursor, [1, 2]), profiles)
+        self.assertEqual(sum("WHERE id IN" in query for query in cursor.queries), 1)
+
+        self.assertEqual(cache.get_many(cursor, [1, 2]), profiles)
+        self.assertEqual(sum("WHERE id IN" in query for query in cursor.queries), 1)
+        self.assertEqual(cache.metrics()["hitRate"], 0.5)
+
+    def test_watermark_invalidates_updated_profiles(self):
+        profiles = {1: ("a@example.com", "A", "c1"), 2: ("b@example.com", "B", "c2")}
+        cursor, state = self.make_cursor(profiles, datetime(2023, 7, 1))
+        cache = ProfileCache(max_size=10, ttl=60)
+        cache.get_many(cursor, [1, 2])
+
+        profiles[2] = ("new@example.com", "B", "c2")
+        state["watermark"] = datetime(2023, 7, 1, 0, 5)
+        state["updated"] = [2]
+
+        self.assertEqual(cache.get_many(cursor, [1, 2])[2], ("new@example.com", "B", "c2"))
+        self.assertEqual(cache.stats["invalidations"], 1)
+
+    @patch('active_orders_api.time.monotonic')
+    def test_watermark_check_is_rate_limited(self, mock_monotonic):
+        profiles = {1: ("a@example.com", "A", "c1")}
+        cursor, state = self.make_cursor(profiles, datetime(2023, 7, 1))
+        cache = ProfileCache(max_size=10, ttl=60, watermark_interval=10)
+
+        mock_monotonic.return_value = 100
+        cache.get_many(cursor, [1])
+        cursor.queries.clear()
+
+        mock_monotonic.return_value = 105
+        cache.get_many(cursor, [1])
+        self.assertEqual(cursor.queries, [])
+
+        mock_monotonic.return_value = 111
+        cache.get_many(cursor, [1])
+        self.assertEqual(sum("MAX(updatedAt)" in query for query in cursor.queries), 1)
+
+    def test_lru_eviction(self):
+        profiles = {profile_id: (f"{profile_id}@example.com", str(profile_id), str(profile_id)) for profile_id in range(3)}
+        cursor, state = self.make_cursor(profiles, datetime(2023, 7, 1))
+        cache = ProfileCache(max_size=2, ttl=60)
+
+        cache.get_many(cursor, [0, 1])
+        cache.get_many(cursor, [0])
+        cache.get_many(cursor, [2])
+
+        self.assertEqual(cache.metrics()["size"], 2)
+        self.assertEqual(cache.stats["evictions"], 1)
+        cache.get_many(cursor, [0])
+        self.assertEqual(cache.stats["misses"], 3)
+
+
+@unittest.skipIf(pa is None, "pyarrow is not installed")
+class TestStreamExport(unittest.TestCase):
+
+    description = [
+        ("id", FieldType.LONG, None, None, None, None, 0, 0),
+        ("profileId", FieldType.LONG, None, None, None, None, 1, 0),
+        ("updatedAt", FieldType.DATETIME, None, None, None, None, 1, 0),
+        ("status", FieldType.VAR_STRING, None, None, None, None, 1, 0)
+    ]
+
+    def make_cursor(self, rows, batch_size):
+        cursor = MagicMock()
+        cursor.description = self.description
+        batches = [rows[i:i + batch_size] for i in range(0, len(rows), batch_size)] + [[]]
+        cursor.fetchmany.side_effect = batches
+        return cursor
+
+    def make_rows(self, count):
+        return [(i, i % 7 or None, datetime(2023, 7, 1, 10, i % 60), "COMPLETED") for i in range(count)]
+
+    @patch('active_orders_api.EXPORT_BATCH_SIZE', 10)
+    def test_arrow_stream(self):
+        rows = self.make_rows(25)
+        connection = MagicMock()
+
+        chunks = list(stream_export(connection, self.make_cursor(rows, 10), "arrow"))
+        table = pa.ipc.open_stream(b"".join(chunks)).read_all()
+
+        # One chunk per record batch plus the end of stream marker
+        self.assertEqual(len(chunks), 4)
+        self.assertEqual(table.num_rows, 25)
+        self.assertEqual(table.schema.field("updatedAt").type, pa.timestamp("us"))
+        self.assertEqual(table.column("profileId").to_pylist(), [row[1] for row in rows])
+        connection.close.assert_called_once()
+
+    @patch('active_orders_api.EXPORT_BATCH_SIZE', 10)
+    def test_parquet_file(self):
+        rows = self.make_rows(25)
+
+        data = b"".join(stream_export(MagicMock(), self.make_cursor(rows, 10), "parquet"))
+        parquet_file = pq.ParquetFile(io.BytesIO(data))
+
+        self.assertEqual(parquet_file.metadata.num_rows, 25)
+        self.assertEqual(parquet_file.metadata.num_row_groups, 3)
+        self.assertEqual(parquet_file.read().column("status").to_pylist(), ["COMPLETED"] * 25)
+
+    @patch('active_orders_api.EXPORT_BATCH_SIZE', 10)
+    def test_aborted_stream_consumes_unread_rows(self):
+        connection = MagicMock(unread_result=True)
+        cursor = self.make_cursor(self.make_rows(25), 10)
+
+        stream = stream_export(connection, cursor, "arrow")
+        next(stream)
+        stream.close()
+
+        # Read off before the pool resets the session on check-in
+        self.assertEqual([call[0] for call in connection.mock_calls], ["consume_results", "close"])
+        cursor.close.assert_called_once()
+
+
+class TestRunBatch(unittest.TestCase):
+
+    # Skip the rate limiter, it would make the tests wait
+    run_batch = staticmethod(inspect.unwrap(run_batch))
+
+    @patch('active_orders_api.get_db_connection')
+    def test_reports_share_one_snapshot(self, mock_get_db_connection):
+        mock_connection = mock_get_db_connection.return_value
+        mock_cursor = mock_connection.cursor.return_value
+
+        def mock_execute(query, params=None):
+            if "FROM ylift_api.carts" in query:
+                mock_cursor.fetchall.return_value = [(1, datetime(2023, 7, 1, 10, 30, 0), datetime(2023, 7, 1, 15, 45, 0))]
+            elif "FROM ylift_api.orders" in query:
+                mock_cursor.fetchone.return_value = (12345,)
+
+        mock_cursor.execute.side_effect = mock_execute
+
+        batch = BatchRequest(reports=[{"name": "carts"}, {"name": "sales", "params": {"month": True}}])
+        result = self.run_batch(batch, api_key=API_KEY)
+
+        mock_get_db_connection.assert_called_once_with("batch")
+        mock_connection.start_transaction.assert_called_once_with(consistent_snapshot=True, isolation_level="REPEATABLE READ", readonly=True)
+        mock_connection.rollback.assert_called_once()
+        mock_connection.close.assert_called_once()
+
+        self.assertEqual([report["name"] for report in result["reports"]], ["carts", "sales"])
+        self.assertEqual(result["reports"][0]["result"], [
+            ActiveCart(profileId=1, createdAt=datetime(2023, 7, 1, 10, 30, 0), updatedAt=datetime(2023, 7, 1, 15, 45, 0))
+        ])
+        self.assertEqual(result["reports"][1]["result"]["totalSales"], "$123.45")
+        self.assertEqual(result["reports"][1]["result"]["startDate"], datetime.now().date().replace(day=1).strftime("%Y-%m-%d"))
+
+    @patch('active_orders_api.get_db_connection')
+    def test_report_error_does_not_fail_batch(self, mock_get_db_connection):
+        mock_cursor = mock_get_db_connection.return_value.cursor.return_value
+
+        def mock_execute(query, params=None):
+            if "FROM ylift_api.orders" in query:
+                raise mysql.connector.Error("Query execution was interrupted")
+            mock_cursor.fetchall.return_value = []
+
+        mock_cursor.execute.side_effect = mock_execute
+
+        batch = BatchRequest(reports=[{"name": "sales"}, {"name": "carts"}])
+        result = self.run_batch(batch, api_key=API_KEY)
+
+        self.assertEqual(result["reports"][0]["error"], {"status": 500, "detail": "Internal server error"})
+        self.assertEqual(result["reports"][1]["result"], [])
+
+    @patch('active_orders_api.get_db_connection')
+    def test_invalid_reports(self, mock_get_db_connection):
+        for reports in ([{"name": "inventory"}], [{"name": "sales", "params": {"decade": True}}],
+                        [{"name": "accounts", "params": {"hot_set": 1}}], [{"name": "sales", "params": {"rollup": "x"}}]):
+            with self.assertRaises(HTTPException) as context:
+                self.run_batch(BatchRequest(reports=reports), api_key=API_KEY)
+
+            self.assertEqual(context.exception.status_code, 400)
+
+        mock_get_db_connection.assert_not_called()
+
+    @patch('active_orders_api.get_db_connection')
+    @patch('active_orders_api.report_active_carts', side_effect=RuntimeError("bug"))
+    def test_connection_released_when_a_report_raises(self, mock_report, mock_get_db_connection):
+        with patch.dict('active_orders_api.BATCH_REPORTS', {"carts": (None, mock_report, ())}):
+            with self.assertRaises(RuntimeError):
+                self.run_batch(BatchRequest(reports=[{"name": "carts"}]), api_key=API_KEY)
+
+        mock_connection = mock_get_db_connection.return_value
+        mock_connection.cursor.return_value.close.assert_called_once()
+        mock_connection.rollback.assert_called_once()
+        mock_connection.close.assert_called_once()
+
+
+class TestHealthProber(unittest.TestCase):
+
+    def failing_probe(self):
+        raise mysql.connector.Error("Can't connect to MySQL server")
+
+    def test_probe_results(self):
+        prober = HealthProber({"mysql": lambda: None, "authorizenet": self.failing_probe}, interval=10)
+        prober.probe_once()
+
+        self.assertEqual(prober.results["mysql"]["status"], "OK")
+        self.assertIsNone(prober.results["mysql"]["error"])
+        self.assertEqual(prober.results["authorizenet"]["status"], "Error")
+        self.assertIn("Can't connect", prober.results["authorizenet"]["error"])
+        self.assertIn("latencyMs", prober.results["authorizenet"])
+
+    def test_not_ready_before_first_probe(self):
+        prober = HealthProber({"mysql": lambda: None}, interval=10)
+
+        self.assertFalse(prober.is_ready(["mysql"]))
+        prober.probe_once()
+        self.assertTrue(prober.is_ready(["mysql"]))
+
+    def test_health_endpoints_serve_cached_results(self):
+        prober = HealthProber({"mysql": self.failing_probe, "backup_dir": lambda: None}, interval=10)
+        prober.probe_once()
+        probe_count = len(prober.results)
+
+        with patch('active_orders_api.health_prober', prober), patch('active_orders_api.get_db_connection') as mock_get_db_connection:
+            health = asyncio.run(health_check())
+            ready = asyncio.run(health_ready())
+
+            mock_get_db_connection.assert_not_called()
+
+        self.assertEqual(health["status"], "Error")
+        self.assertEqual(health["database"], "Not Connected")
+        self.assertEqual(len(health["dependencies"]), probe_count)
+        self.assertEqual(ready.status_code, 503)
+
+
 if __name__ == '__main__':
     unittest.main()